@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark of the asyncio daophot driver, run by ``driver_overhead.py``.
+It needs Python 3, so it is imported only when the benchmark runs.
+"""
+
+import time
+import asyncio
+
+from asyncdriver import AsyncDaophot
+
+
+def bench_async(imagePaths, cmd, shell, nWorkers):
+    async def measure(imagePath, semaphore):
+        async with semaphore:
+            async with AsyncDaophot(imagePath, shell=shell,
+                    cmd=cmd) as daophot:
+                await daophot.find()
+                await daophot.apphot('last')
+                await daophot.pick_psf_stars(25, 'last')
+                await daophot.make_psf('last', 'last')
+
+    async def measure_all():
+        semaphore = asyncio.Semaphore(nWorkers)
+        await asyncio.gather(*[measure(path, semaphore)
+            for path in imagePaths])
+
+    startTime = time.time()
+    asyncio.run(measure_all())
+    elapsed = time.time() - startTime
+    return {'images_per_s': len(imagePaths) / elapsed, 'elapsed': elapsed}
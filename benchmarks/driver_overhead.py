@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmarks of the daophot driver overhead, run against the simulator.
+
+Measures the throughput of the interactive session (commands/s), of session
+startup (sessions/s), and of the per-image paths: fresh sessions, pooled
+sessions, scripted runs, asyncio sessions and the process-pool driver
+(images/s). With the default zero simulator delays the numbers are pure
+driver (pexpect, shell and process) overhead.
+
+Usage::
+
+    python benchmarks/driver_overhead.py --images 20 --workers 4
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+import simulator
+from daophot import Daophot
+from pool import DaophotPool
+from script import DaophotScript
+from parallel import run_many, PSFRecipe
+
+
+def make_images(workDir, nImages):
+    """Writes `nImages` empty stand-in FITS files into `workDir`."""
+    paths = []
+    for i in range(nImages):
+        path = os.path.join(workDir, "im%03i.fits" % i)
+        open(path, 'w').close()
+        paths.append(path)
+    return paths
+
+
+def psf_recipe(daophot):
+    """FIND, PHOTOMETRY, PICK, PSF on a running session."""
+    daophot.find()
+    daophot.apphot('last')
+    daophot.pick_psf_stars(25, 'last')
+    daophot.make_psf('last', 'last')
+
+
+def bench_commands(imagePath, cmd, shell, nRepeats):
+    daophot = Daophot(imagePath, shell=shell, cmd=cmd)
+    startTime = time.time()
+    for i in range(nRepeats):
+        psf_recipe(daophot)
+    elapsed = time.time() - startTime
+    daophot.shutdown()
+    return {'commands_per_s': 4 * nRepeats / elapsed, 'elapsed': elapsed}
+
+
+def bench_sessions(imagePath, cmd, shell, nRepeats):
+    startTime = time.time()
+    for i in range(nRepeats):
+        Daophot(imagePath, shell=shell, cmd=cmd).shutdown()
+    elapsed = time.time() - startTime
+    return {'sessions_per_s': nRepeats / elapsed, 'elapsed': elapsed}
+
+
+def bench_fresh(imagePaths, cmd, shell):
+    startTime = time.time()
+    for imagePath in imagePaths:
+        daophot = Daophot(imagePath, shell=shell, cmd=cmd)
+        psf_recipe(daophot)
+        daophot.shutdown()
+    elapsed = time.time() - startTime
+    return {'images_per_s': len(imagePaths) / elapsed, 'elapsed': elapsed}
+
+
+def bench_pooled(imagePaths, cmd, shell):
+    pool = DaophotPool(size=1, maxImages=len(imagePaths) + 1, shell=shell,
+            cmd=cmd)
+    startTime = time.time()
+    for imagePath in imagePaths:
+        with pool.session(imagePath) as daophot:
+            psf_recipe(daophot)
+    elapsed = time.time() - startTime
+    pool.close()
+    result = {'images_per_s': len(imagePaths) / elapsed, 'elapsed': elapsed}
+    result.update(pool.stats())
+    return result
+
+
+def bench_scripted(imagePaths, cmd, shell):
+    startTime = time.time()
+    for imagePath in imagePaths:
+        script = DaophotScript(imagePath, shell=shell, cmd=cmd)
+        psf_recipe(script)
+        if not script.run().succeeded():
+            raise RuntimeError("scripted run of %s failed" % imagePath)
+    elapsed = time.time() - startTime
+    return {'images_per_s': len(imagePaths) / elapsed, 'elapsed': elapsed}
+
+
+def bench_async(imagePaths, cmd, shell, nWorkers):
+    # asyncio code cannot even be compiled by Python 2, so it is kept in its
+    # own module
+    try:
+        from async_overhead import bench_async as run_async
+    except (ImportError, SyntaxError):
+        return None
+    return run_async(imagePaths, cmd, shell, nWorkers)
+
+
+def bench_parallel(imagePaths, cmd, shell, nWorkers, workRoot):
+    recipe = PSFRecipe(nStars=25, shell=shell, cmd=cmd)
+    startTime = time.time()
+    nFailed = 0
+    for result in run_many(imagePaths, recipe, workers=nWorkers,
+            workRoot=workRoot):
+        if not result.succeeded():
+            nFailed += 1
+    elapsed = time.time() - startTime
+    return {'images_per_s': len(imagePaths) / elapsed, 'elapsed': elapsed,
+            'failed': nFailed}
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--images", type="int", default=10,
+            help="number of images per per-image benchmark")
+    parser.add_option("--repeats", type="int", default=10,
+            help="repetitions of the session benchmarks")
+    parser.add_option("--workers", type="int", default=4,
+            help="workers for the parallel and asyncio benchmarks")
+    parser.add_option("--delays", default="",
+            help="simulator delays, e.g. FIND=0.1,PSF=0.2")
+    parser.add_option("--stars", type="int", default=200,
+            help="synthetic stars per image")
+    parser.add_option("--shell", default="/bin/sh",
+            help="shell that the simulator is started from")
+    parser.add_option("--json", default=None,
+            help="also write the results as JSON to this path")
+    options, args = parser.parse_args()
+
+    simPath = os.path.abspath(simulator.__file__).replace(".pyc", ".py")
+    cmd = "%s %s daophot --stars %i" % (sys.executable, simPath,
+            options.stars)
+    if options.delays:
+        cmd += " --delays %s" % options.delays
+
+    workDir = tempfile.mkdtemp(prefix="daopilot_bench")
+    results = {}
+    try:
+        imagePaths = make_images(workDir, options.images)
+        results['session'] = bench_commands(imagePaths[0], cmd,
+                options.shell, options.repeats)
+        results['startup'] = bench_sessions(imagePaths[0], cmd,
+                options.shell, options.repeats)
+        results['fresh'] = bench_fresh(imagePaths, cmd, options.shell)
+        results['pooled'] = bench_pooled(imagePaths, cmd, options.shell)
+        results['scripted'] = bench_scripted(imagePaths, cmd, options.shell)
+        asyncResult = bench_async(imagePaths, cmd, options.shell,
+                options.workers)
+        if asyncResult is not None:
+            results['async'] = asyncResult
+        results['parallel'] = bench_parallel(imagePaths, cmd, options.shell,
+                options.workers, os.path.join(workDir, "runs"))
+    finally:
+        shutil.rmtree(workDir)
+
+    for name in ('session', 'startup', 'fresh', 'pooled', 'scripted',
+            'async', 'parallel'):
+        if name not in results:
+            continue
+        rates = ["%s=%.2f" % (key, value)
+                for key, value in sorted(results[name].items())]
+        print("%-9s %s" % (name, " ".join(rates)))
+    if options.json is not None:
+        f = open(options.json, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,9 +7,29 @@ Allstar class wrapper.
 """
 
 import os
-import sys
+import time
+from collections import namedtuple
+
 import pexpect
 
+from dialogue import Step, converse
+from instrument import get_instrumentation
+from optfile import changed_options, format_value, normalize_options, \
+        read_options, write_options
+
+
+class AllstarProgress(namedtuple('AllstarProgress', ['iteration', 'nStars',
+        'nConverged', 'nRejected', 'elapsed'])):
+    """Progress of an allstar run, reported after each iteration.
+
+    :param iteration: number of the iteration just completed.
+    :param nStars: number of stars still being fitted.
+    :param nConverged: number of stars whose fit has converged so far.
+    :param nRejected: number of stars rejected (disappeared) so far.
+    :param elapsed: wall time (seconds) since the fit started.
+    """
+    __slots__ = ()
+
 
 class Allstar(object):
     """Wrapper object for Peter Stetson's allstar program for doing psf
@@ -20,9 +40,29 @@ class Allstar(object):
     
     .. note:: All the inputs and output paths should be in the same directory
        as the `inputImagePath`.
+
+    :param options: mapping of allstar option names (e.g. 'FI', 'IS') to
+        values. Only options that differ from the ``allstar.opt`` file in the
+        working directory are sent at the ``OPT>`` prompt.
+    :type options: dict (optional)
+    :param instrumentation: registry that the latencies and transcript of
+        each run are recorded in; defaults to
+        :func:`instrument.get_instrumentation`.
+    :type instrumentation: :class:`instrument.Instrumentation` (optional)
+    :param supervisor: watches each run for a stalled allstar process; a
+        stalled, timed out or crashed run is killed and retried from
+        scratch. Without a supervisor, such a process is killed and the
+        error is raised.
+    :type supervisor: :class:`watchdog.Supervisor` (optional)
     """
+    # allstar's report of an iteration: iteration, stars left, converged and
+    # disappeared stars
+    progressPattern = r"[ \t]*(\d+)[ \t]+(\d+)[ \t]+(\d+)[ \t]+(\d+)" \
+            r"[ \t]*\r?\n"
+    
     def __init__(self, inputImagePath, psfPath, apPhotPath, alsOutputPath,
-            outputImagePath, shell="/bin/zsh", cmd="allstar"):
+            outputImagePath, shell="/bin/zsh", cmd="allstar", options=None,
+            instrumentation=None, supervisor=None):
         super(Allstar, self).__init__()
         self.shell = shell
         self.cmd = cmd
@@ -31,54 +71,148 @@ class Allstar(object):
         self.apPhotPath = apPhotPath  # aperture photometry input path
         self.alsOutputPath = alsOutputPath  # allstar output (photometry) path
         self.outputImagePath = outputImagePath  # star-subtracted image path
-        
-        # Delete old copies of the output files
-        if os.path.exists(self.alsOutputPath):
-            os.remove(self.alsOutputPath)
-        if os.path.exists(self.outputImagePath):
-            os.remove(self.outputImagePath)
+        self.options = normalize_options(options)
+        if instrumentation is None:
+            instrumentation = get_instrumentation()
+        self.instrumentation = instrumentation
+        self.supervisor = supervisor
+        self._stats = None  # SessionStats of the latest run
+        self.progress = None  # AllstarProgress of the latest iteration
+        self._progressCallback = None
         
         # Will be a pexpect instance running allstar
         self.allstar = None
     
-    def run(self, timeout=30. * 60):
+    def run(self, timeout=30. * 60, progress=None):
         """Runs an allstar session.
 
         :param timeout: time (seconds) to allow `allstar` to run before
-           giving up.
+           giving up; with a supervisor, its watchdog decides instead.
+        :param progress: optional callable that is passed an
+            :class:`AllstarProgress` as allstar completes each iteration
+            (also kept as the `progress` attribute). It may raise an
+            exception to abandon the run, which kills allstar.
         """
-        # need to delete the .als file, otherwise allstar will ask
-        # to overwrite it
-        if os.path.exists(self.alsOutputPath):
-            os.remove(self.alsOutputPath)
-        
-        self.allstar = pexpect.spawn('%s -c "cd %s;%s"' %
-                (self.shell, self.cmd, os.path.dirname(self.inputImagePath)))
-        self.allstar.logfile = sys.stdout  # DEBUG
-        self.allstar.expect("OPT>")
-        print self.allstar.before
+        self._progressCallback = progress
+        attempt = 0
+        while True:
+            self._remove_outputs()
+            self._stats = self.instrumentation.new_session('allstar',
+                    label=self.inputImagePath)
+            self.progress = None
+            self.allstar = self._spawn()
+            try:
+                converse(self.allstar, self._run_dialogue(timeout),
+                        self._stats, "ALLSTAR", watch=self._make_watch())
+                break
+            except (pexpect.TIMEOUT, pexpect.EOF) as error:
+                self.allstar.close(force=True)
+                self.allstar = None
+                attempt += 1
+                if self.supervisor is None or not self.supervisor.retry(
+                        self.inputImagePath, "ALLSTAR", attempt, error):
+                    raise
+            except Exception:
+                # abandoned, e.g. by the progress callback
+                self.allstar.close(force=True)
+                self.allstar = None
+                raise
+        # TODO, will this get rid of the allstar build-up?
+        # self.allstar.sendcontrol('d')
+        self.allstar = None
+    
+    def _make_watch(self):
+        """Returns the supervisor's :class:`watchdog.Watch` for a run, or
+        `None` without a supervisor.
+        """
+        if self.supervisor is None:
+            return None
+        transcript = self._stats.transcript
+        return self.supervisor.watch("ALLSTAR", lambda: transcript.nWritten,
+                imagePath=self.inputImagePath, catalogPath=self.apPhotPath)
+    
+    def _remove_outputs(self):
+        """Deletes the .als file and star-subtracted image left by an earlier
+        (or failed) run, otherwise allstar would ask to overwrite them.
+        """
+        for path in (self.alsOutputPath, self.outputImagePath):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def get_stats(self):
+        """Returns the :class:`instrument.SessionStats` of the latest run."""
+        return self._stats
+    
+    def _spawn(self, **spawnArgs):
+        """Spawns the allstar process and returns the pexpect instance.
+        `spawnArgs` are passed to :class:`pexpect.spawn`.
+        """
+        child = pexpect.spawn('%s -c "cd %s;%s"' %
+                (self.shell, os.path.dirname(self.inputImagePath), self.cmd),
+                **spawnArgs)
+        # keep only the tail of the transcript in the run's statistics
+        child.logfile = self._stats.transcript
+        return child
+    
+    def _run_dialogue(self, timeout):
+        yield Step(None, "OPT>")
         
-        # TODO add options?
+        # allstar has already loaded allstar.opt; send only the differences
+        startupOptions = read_options(self._get_options_path())
+        for name, value in changed_options(startupOptions, self.options):
+            yield Step("%s=%s" % (name, format_value(value)), "OPT>")
         
-        self.allstar.sendline("")
-        self.allstar.expect("Input image name:")
-        self.allstar.sendline(os.path.basename(self.inputImagePath))
+        yield Step("", "Input image name:")
         # asks File with the PSF
-        self.allstar.expect(":")
-        self.allstar.sendline(os.path.basename(self.psfPath))
+        yield Step(os.path.basename(self.inputImagePath), ":")
         # asks Input file .ap
-        self.allstar.expect(":")
-        self.allstar.sendline(os.path.basename(self.apPhotPath))
+        yield Step(os.path.basename(self.psfPath), ":")
         # asks for .als output path
-        self.allstar.expect(":")
-        self.allstar.sendline(os.path.basename(self.alsOutputPath))
+        yield Step(os.path.basename(self.apPhotPath), ":")
         # asks for path for output star-sub image
-        self.allstar.expect(":")
-        self.allstar.sendline(os.path.basename(self.outputImagePath))
+        yield Step(os.path.basename(self.alsOutputPath), ":")
         
-        # wait up to 30 minutes for allstar to finish
-        self.allstar.expect("Good bye.", timeout=timeout)
-        # TODO, will this get rid of the allstar build-up?
-        # self.allstar.sendcontrol('d')
-        print "finished"
-        self.allstar = None
+        # wait up to `timeout` in all for allstar to finish, reporting
+        # each iteration on the way
+        startTime = time.time()
+        send = os.path.basename(self.outputImagePath)
+        while True:
+            remaining = max(startTime + timeout - time.time(), 0.)
+            index = yield Step(send, [self.progressPattern, "Good bye."],
+                    timeout=remaining, stage="fit", watch=True)
+            if index == 1:
+                break
+            send = None
+            self._report_progress(self.allstar.match,
+                    time.time() - startTime)
+    
+    def _report_progress(self, match, elapsed):
+        """Makes the :class:`AllstarProgress` of an iteration from the match
+        of `progressPattern`, and passes it to the progress callback.
+        """
+        iteration, nStars, nConverged, nRejected = [int(match.group(i))
+                for i in range(1, 5)]
+        self.progress = AllstarProgress(iteration, nStars, nConverged,
+                nRejected, elapsed)
+        if self._progressCallback is not None:
+            self._progressCallback(self.progress)
+    
+    def save_options(self, path=None):
+        """Writes this instance's options, merged over any existing
+        ``allstar.opt``, to an option file (by default ``allstar.opt`` in the
+        working directory). Later allstar runs in that directory then start
+        already configured and need no interactive option setting.
+
+        :return: path to the option file.
+        """
+        if path is None:
+            path = self._get_options_path()
+        options = read_options(self._get_options_path())
+        options.update(self.options)
+        write_options(path, options)
+        return path
+    
+    def _get_options_path(self):
+        """Path to the allstar.opt file read by allstar on startup."""
+        return os.path.join(os.path.dirname(self.inputImagePath),
+                "allstar.opt")
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Asyncio drivers for daophot and allstar.
+
+:class:`AsyncDaophot` and :class:`AsyncAllstar` run exactly the same dialogues
+as :class:`daophot.Daophot` and :class:`allstar.Allstar`, but wait for each
+prompt with pexpect's asyncio support (``expect(..., async_=True)``) instead
+of blocking. A single event loop can therefore supervise many daophot
+processes at once::
+
+    async def measure(imagePath):
+        async with AsyncDaophot(imagePath) as daophot:
+            await daophot.find()
+            await daophot.apphot('last')
+
+    loop.run_until_complete(asyncio.gather(*[measure(p) for p in paths]))
+
+Given a :class:`watchdog.Supervisor`, stalled commands are killed and
+retried as by the blocking drivers, but the watch and the pause before a
+retry also yield to the event loop.
+
+This module requires Python 3.5+ and pexpect 4.3+ (4.9+ on Python 3.11).
+"""
+
+import time
+import asyncio
+
+import pexpect
+
+from daophot import Daophot
+from allstar import Allstar
+from dialogue import Return
+
+
+async def aconverse(child, dialogue, stats=None, command=None, watch=None):
+    """Drives a `dialogue` generator (see :mod:`dialogue`) with the pexpect
+    process `child`, yielding to the event loop while waiting on prompts.
+    Latencies are recorded in `stats`, and the steps marked with `watch` are
+    waited on by the :class:`watchdog.Watch` `watch`, as by
+    :func:`dialogue.converse`.
+
+    :return: the value of the dialogue's :class:`dialogue.Return`, or `None`.
+    """
+    startTime = time.time()
+    value = None
+    try:
+        step = next(dialogue)
+        while True:
+            stepTime = time.time()
+            if step.send is not None:
+                child.sendline(step.send)
+            if step.watch and watch is not None:
+                index = await awatch(watch, child, step.expect)
+            else:
+                index = await child.expect(step.expect,
+                        timeout=step.timeout, async_=True)
+            if stats is not None:
+                stats.record_stage(step.get_stage(command),
+                        time.time() - stepTime)
+            step = dialogue.send(index)
+    except StopIteration:
+        pass
+    except Return as result:
+        value = result.value
+    if stats is not None:
+        stats.record_command(command, time.time() - startTime)
+    return value
+
+
+async def awatch(watch, child, pattern):
+    """Waits for `pattern` from the pexpect process `child` like
+    :meth:`watchdog.Watch.expect`, yielding to the event loop.
+
+    :return: the index of the matched pattern.
+    :raises watchdog.Stalled: if the process stalls or runs out of time.
+    """
+    patterns = watch.start_wait(pattern)
+    while True:
+        index = await child.expect(patterns, timeout=watch.poll, async_=True)
+        if index < len(patterns) - 1:
+            return index
+        watch.check()
+
+
+class AsyncDaophot(Daophot):
+    """Asyncio interface to drive daophot. The commands are the same as for
+    :class:`daophot.Daophot`, but are coroutines.
+
+    The session is not started by the constructor; await :meth:`startup`,
+    or use the instance as an asynchronous context manager, which also
+    shuts the session down on exit.
+    """
+    def _startup(self):
+        # started by the startup() coroutine instead
+        pass
+
+    def _spawn(self):
+        child = super(AsyncDaophot, self)._spawn(encoding='utf-8')
+        # pexpect's delay before sending is a blocking sleep, which would
+        # stall every other session on the event loop
+        child.delaybeforesend = None
+        return child
+
+    async def _aconverse(self, command, dialogueFunc, *args):
+        """Drives the dialogue made by `dialogueFunc(*args)`, killing and
+        retrying a stalled process as :meth:`daophot.Daophot._converse`
+        does.
+        """
+        options = dict(self._options)
+        attempt = 0
+        while True:
+            try:
+                if attempt > 0:
+                    await self._arestart(command, options)
+                return await aconverse(self._daophot, dialogueFunc(*args),
+                        self._stats, command, watch=self._make_watch(command))
+            except (pexpect.TIMEOUT, pexpect.EOF) as error:
+                # never leave a hung daophot running
+                self.kill()
+                attempt += 1
+                if self._supervisor is None or command == "EXIT":
+                    raise
+                delay = self._supervisor.get_retry_delay(self.inputImagePath,
+                        command, attempt, error)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def _arestart(self, command, options):
+        """Starts a new daophot process in the state the session was in
+        before `command` (see :meth:`daophot.Daophot._restart`).
+        """
+        self._daophot = self._spawn()
+        if command == "STARTUP":
+            return  # the retried command waits for the banner
+        await aconverse(self._daophot, self._banner_dialogue(), self._stats,
+                "STARTUP")
+        await aconverse(self._daophot, self._set_options_dialogue(options),
+                self._stats, "OPTION")
+        await aconverse(self._daophot, self._attach_dialogue('last'),
+                self._stats, "ATTACH")
+
+    async def __aenter__(self):
+        return await self.startup()
+
+    async def __aexit__(self, excType, excValue, traceback):
+        await self.shutdown()
+
+    async def startup(self):
+        """Starts the daophot session and attaches the input image.
+
+        :return: this instance.
+        """
+        self._daophot = self._spawn()
+        await self._aconverse("STARTUP", self._banner_dialogue)
+        await self.set_options(self._startupOptions)
+        await self.attach('input_image')
+        return self
+
+    async def retarget(self, inputImagePath):
+        """Re-uses the running session for a new input image (see
+        :meth:`daophot.Daophot.retarget`).
+        """
+        self._set_input_image(inputImagePath)
+        await self.attach('input_image')
+
+    async def shutdown(self):
+        """Shutdown the daophot process."""
+        if self._daophot is None:
+            return
+        try:
+            await self._aconverse("EXIT", self._shutdown_dialogue)
+        except (pexpect.TIMEOUT, pexpect.EOF, OSError):
+            pass
+        self.kill()
+
+    async def set_option(self, name, value):
+        """Set the named option in daophot to a given value."""
+        await self.set_options({name: value})
+
+    async def set_options(self, options):
+        """Sets the options that differ from the session's current state
+        (see :meth:`daophot.Daophot.set_options`).
+        """
+        await self._aconverse("OPTION", self._set_options_dialogue, options)
+
+    async def attach(self, image):
+        """Attaches the given image (see :meth:`daophot.Daophot.attach`)."""
+        await self._aconverse("ATTACH", self._attach_dialogue, image)
+
+    async def find(self, nAvg=1, nSum=1, cooName=None, cooPath=None):
+        """Runs *FIND* (see :meth:`daophot.Daophot.find`)."""
+        key, outputs = self._find_step(nAvg, nSum, cooName, cooPath)
+        if self._restore_step(key, outputs) is None:
+            await self._aconverse("FIND", self._find_dialogue, nAvg, nSum,
+                    cooName, outputs[0][0])
+            self._store_step(key, outputs, command="FIND")
+
+    async def apphot(self, coordinates, apRadPath=None, photOutputPath=None,
+            photOutputName=None, options=None):
+        """Runs *PHOTOMETRY* (see :meth:`daophot.Daophot.apphot`)."""
+        key, outputs = self._apphot_step(coordinates, apRadPath,
+                photOutputPath, photOutputName, options)
+        if self._restore_step(key, outputs) is None:
+            await self._aconverse("PHOTOMETRY", self._apphot_dialogue,
+                    coordinates, apRadPath, outputs[0][0], photOutputName,
+                    options)
+            self._store_step(key, outputs, command="PHOTOMETRY")
+
+    async def pick_psf_stars(self, nStars, apPhot, starListPath=None,
+            starListName=None, magLimit=99):
+        """Runs *PICK* (see :meth:`daophot.Daophot.pick_psf_stars`)."""
+        key, outputs = self._pick_step(nStars, apPhot, starListPath,
+                starListName, magLimit)
+        if self._restore_step(key, outputs) is None:
+            await self._aconverse("PICK", self._pick_dialogue, nStars,
+                    apPhot, outputs[0][0], starListName, magLimit)
+            self._store_step(key, outputs, command="PICK")
+
+    async def make_psf(self, apPhot, starList, psfPath=None, psfName=None):
+        """Runs *PSF* (see :meth:`daophot.Daophot.make_psf`).
+
+        :return: text output of fitting routine, path to the psf file and path
+            to the neighbours file
+        """
+        key, outputs = self._psf_step(apPhot, starList, psfPath, psfName)
+        cached = self._restore_step(key, outputs)
+        if cached is not None:
+            return self._get_psf_result(cached.text, outputs)
+        result = await self._aconverse("PSF", self._psf_dialogue, apPhot,
+                starList, outputs[0][0], psfName)
+        return self._store_psf_step(key, outputs, result)
+
+    async def substar(self, substarList, psf, outputPath, keepers=None):
+        """Runs *SUBSTAR* (see :meth:`daophot.Daophot.substar`).
+
+        :return: outputPath, relative to the pipeline.
+        """
+        await self._aconverse("SUBSTAR", self._substar_dialogue,
+                substarList, psf, outputPath, keepers)
+        return outputPath
+
+
+class AsyncAllstar(Allstar):
+    """Asyncio wrapper of allstar; :meth:`run` is a coroutine. See
+    :class:`allstar.Allstar` for the parameters.
+    """
+    def _spawn(self):
+        child = super(AsyncAllstar, self)._spawn(encoding='utf-8')
+        # pexpect's delay before sending is a blocking sleep, which would
+        # stall every other session on the event loop
+        child.delaybeforesend = None
+        return child
+
+    async def run(self, timeout=30. * 60, progress=None):
+        """Runs an allstar session.
+
+        :param timeout: time (seconds) to allow `allstar` to run before
+           giving up; with a supervisor, its watchdog decides instead.
+        :param progress: optional callable passed an
+            :class:`allstar.AllstarProgress` after each iteration (see
+            :meth:`allstar.Allstar.run`).
+        """
+        self._progressCallback = progress
+        attempt = 0
+        while True:
+            self._remove_outputs()
+            self._stats = self.instrumentation.new_session('allstar',
+                    label=self.inputImagePath)
+            self.progress = None
+            self.allstar = self._spawn()
+            try:
+                await aconverse(self.allstar, self._run_dialogue(timeout),
+                        self._stats, "ALLSTAR", watch=self._make_watch())
+                break
+            except (pexpect.TIMEOUT, pexpect.EOF) as error:
+                self.allstar.close(force=True)
+                self.allstar = None
+                attempt += 1
+                if self.supervisor is None:
+                    raise
+                delay = self.supervisor.get_retry_delay(self.inputImagePath,
+                        "ALLSTAR", attempt, error)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            except Exception:
+                # abandoned, e.g. by the progress callback
+                self.allstar.close(force=True)
+                self.allstar = None
+                raise
+        self.allstar = None
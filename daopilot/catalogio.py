@@ -7,27 +7,880 @@ Classes for reading and writing Daophot files.
 """
 
 import os
+import json
+import mmap
+import hashlib
+import warnings
+from collections import namedtuple
+
 import numpy as np
 
 from regionio import PointList
+from spatialindex import GridIndex
+
+
+def _parse_table(dataLines, nColumns, widths=None, decimals=None,
+        dtype=None):
+    """Converts numeric catalog records, one per line, into a 2D float array
+    in bulk rather than line by line.
+
+    If the Fortran field `widths` are known and every record has exactly
+    that layout (as when written by daophot), the fields are converted
+    straight from the characters (see :func:`_parse_fixed_columns`).
+    Otherwise the whole block is tokenized on whitespace in one pass. If
+    that does not give `nColumns` values per record (adjacent fields can run
+    together, e.g. a large sky value after a magnitude error), the records
+    are sliced into columns by character position.
+
+    :param dataLines: the record lines; blank lines are ignored.
+    :param nColumns: number of values per record.
+    :param widths: optional widths (characters) of the fixed-width fields.
+    :param decimals: optional number of decimals of each fixed-width field
+        (see :func:`_field_offsets`) that records must have to be converted
+        by position.
+    :param dtype: optional structured dtype of the stars to convert the
+        records into, its first `nColumns` fields from the columns and the
+        others zero.
+    :return: array of shape `(nRecords, nColumns)`, or the stars if
+        `dtype` is given.
+    """
+    if widths is not None:
+        # daophot's own records need no cleaning for the fast path
+        text = "".join(dataLines)
+        if len(text) > 0 and not text.endswith("\n"):
+            text += "\n"
+        table = _parse_fixed_columns(text.encode('ascii'), widths,
+                decimals, dtype)
+        if table is not None:
+            return table
+    lines = [line for line in dataLines if len(line.strip()) > 0]
+    if len(lines) == 0:
+        table = np.empty((0, nColumns))
+    else:
+        text = "".join(lines)
+        try:
+            with warnings.catch_warnings():
+                # older numpy warns, and returns what it read, on text it
+                # cannot parse; newer numpy raises
+                warnings.simplefilter('ignore')
+                values = np.fromstring(text, dtype=np.float64, sep=" ")
+        except ValueError:
+            values = np.empty(0)
+        if values.size == len(lines) * nColumns:
+            table = values.reshape(len(lines), nColumns)
+        elif widths is None:
+            raise ValueError("Expected %i values in each of %i records"
+                    % (nColumns, len(lines)))
+        else:
+            table = _parse_fixed_width(lines, widths)
+    if dtype is None:
+        return table
+    stars = np.zeros(len(table), dtype=dtype)
+    for i, name in enumerate(dtype.names[:nColumns]):
+        stars[name] = table[:, i]
+    return stars
+
+
+def _parse_fixed_columns(text, widths, decimals=None, dtype=None):
+    """Converts records of identical fixed-width layout, one per line, given
+    as one block of bytes (see :func:`_convert_fields`).
+
+    :return: array of shape `(nRecords, len(widths))`, or stars of the
+        optional structured `dtype` (see :func:`_parse_table`), or `None`
+        if the records do not all have the layout.
+    """
+    lineLength = text.find(b"\n") + 1
+    if lineLength == 0 or len(text) % lineLength != 0:
+        return None
+    nLines = len(text) // lineLength
+    chars = np.frombuffer(text, dtype=np.uint8).reshape(nLines, lineLength)
+    width = lineLength - 1
+    if chars[0, width - 1] == ord("\r"):
+        width -= 1
+    if width != sum(widths) or not (chars[:, -1] == ord("\n")).all():
+        return None
+    fields = _field_offsets(widths, decimals=decimals)
+    if dtype is None:
+        return _convert_fields(chars, fields)
+    stars = np.zeros(nLines, dtype=dtype)
+    if _convert_fields(chars, fields, out=[stars[name]
+            for name in dtype.names[:len(widths)]]) is None:
+        return None
+    return stars
+
+
+def _convert_fields(chars, fields, chunkRows=2048, out=None):
+    """Converts fixed-width numeric fields of records with arithmetic on
+    the characters: the digits of each field are weighted by their place
+    into an exact integer mantissa (one matrix product for all fields),
+    which is then negated where a minus sign leads it and scaled by the
+    field's fixed number of decimals.
+
+    :param chars: 2D array of the character codes of the records, one
+        record per row (it may be a view of a file's bytes).
+    :param fields: `(offset, width, decimals)` of each field in a record
+        (see :func:`_field_offsets`).
+    :param chunkRows: number of records converted at a time; small blocks
+        keep the temporary arrays in the processor's cache.
+    :param out: optional 1D arrays, one per field, to convert the values
+        into (cast to their types, e.g. the fields of a structured array)
+        instead of a new 2D float array.
+    :return: array of shape `(nRecords, len(fields))`, or `out`, or `None`
+        if the records do not all have the layout of the first (decimal
+        points out of place, blanks or signs inside a number, exponents or
+        overflow asterisks...).
+    """
+    nRecords = len(chars)
+    if nRecords == 0:
+        return np.empty((0, len(fields))) if out is None else out
+    start = min(field[0] for field in fields)
+    end = max(field[0] + field[1] for field in fields)
+    if (end - start) * 2 < chars.shape[1]:
+        chars = chars[:, start:end]
+    else:
+        # whole rows are contiguous, which is faster than a narrower slice
+        start = 0
+    width = chars.shape[1]
+    # the layout, from the first record: place (power of ten) of each
+    # character in its field's mantissa, and the field's scale
+    isDot = chars[0] == ord(".")
+    isUsed = np.zeros(width, dtype=bool)
+    # whether a character is in the same field as the one before it
+    isJoined = np.zeros(width, dtype=bool)
+    weights = np.zeros((width, len(fields)))
+    scales = np.ones(len(fields))
+    isLast = np.zeros(width, dtype=bool)
+    minusChars = np.empty((min(chunkRows, nRecords), width), dtype=bool)
+    # the characters of each field before its last (a minus sign cannot
+    # be last) as few unsigned integers, nonzero where there is a sign
+    signWords = []
+    for i, (offset, w, decimals) in enumerate(fields):
+        offset -= start
+        dots = np.nonzero(isDot[offset:offset + w])[0]
+        if len(dots) > 1:
+            return None
+        point = dots[0] if len(dots) == 1 else w
+        if decimals is not None \
+                and point != (w - 1 - decimals if decimals >= 0 else w):
+            return None
+        for j in range(w):
+            if j != point:
+                weights[offset + j, i] = 10. ** (w - 1 - j
+                        - (1 if j < point < w else 0))
+        scales[i] = 10. ** (w - 1 - point if point < w else 0)
+        isUsed[offset:offset + w] = True
+        isJoined[offset + 1:offset + w] = True
+        isLast[offset + w - 1] = True
+        if w > 1:
+            size = min(8, 2 ** int(np.log2(w - 1)))
+            signWords.append((i, [np.ndarray((len(minusChars),),
+                    dtype=np.dtype('u%i' % size), buffer=minusChars,
+                    offset=offset + j, strides=(width,))
+                    for j in sorted(set(list(range(0, w - 1 - size, size))
+                    + [w - 1 - size]))]))
+    isDot &= isUsed
+    dotColumns = np.nonzero(isDot)[0]
+    # the masks repeated for a whole block, to test it as one run of
+    # characters: those that need not be digits, blanks or signs
+    isFreeRun = np.tile(isDot | ~isUsed, len(minusChars))
+    isJoinedRun = np.tile(isJoined, len(minusChars))[1:]
+    isLastRun = np.tile(isLast, len(minusChars))
+    isNegative = np.zeros((len(minusChars), len(fields)), dtype=bool)
+    values = np.empty((len(minusChars), width))
+    # codes of the characters less that of "0", as in `digits` below
+    blankCode, minusCode, dotCode = [np.uint8((ord(c) - ord("0")) % 256)
+            for c in " -."]
+    if out is None:
+        table = np.empty((nRecords, len(fields)))
+    for first in range(0, nRecords, chunkRows):
+        digits = chars[first:first + chunkRows] - np.uint8(ord("0"))
+        nRows = len(digits)
+        isDigit = digits < 10
+        isMinus = np.equal(digits, minusCode, out=minusChars[:nRows])
+        hasSigns = isMinus.any()
+        isBlank = digits == blankCode
+        isPadding = isBlank | isMinus
+        nChars = nRows * width
+        # every character of the fields is a digit, blank or sign, except
+        # for the decimal points where the first record has them
+        if not ((isDigit | isPadding).ravel() | isFreeRun[:nChars]).all() \
+                or not (digits[:, dotColumns] == dotCode).all() \
+                or (hasSigns and (isMinus.ravel()
+                        & isLastRun[:nChars]).any()):
+            return None
+        # blanks only pad a number on the left, and the sign leads it, so
+        # misaligned records (e.g. "9 3.03") are not read as one number;
+        # compared across the whole block, each character after the one
+        # before it
+        isBroken = isPadding.ravel()[1:] > isBlank.ravel()[:-1]
+        if (isBroken & isJoinedRun[:nChars - 1]).any():
+            return None
+        np.multiply(digits, isDigit, out=values[:nRows], casting='unsafe')
+        mantissas = np.dot(values[:nRows], weights)
+        if hasSigns:
+            for i, words in signWords:
+                np.not_equal(words[0][:nRows], 0, out=isNegative[:nRows, i])
+                for word in words[1:]:
+                    isNegative[:nRows, i] |= word[:nRows] != 0
+            np.negative(mantissas, out=mantissas, where=isNegative[:nRows])
+        if out is None:
+            np.divide(mantissas, scales, out=table[first:first + nRows])
+        else:
+            for i, column in enumerate(out):
+                np.divide(mantissas[:, i], scales[i],
+                        out=column[first:first + nRows], casting='unsafe')
+    return table if out is None else out
+
+
+def _parse_fixed_width(lines, widths):
+    """Slices fixed-width records into columns by character position, and
+    converts each column to floats at once.
+
+    :return: array of shape `(len(lines), len(widths))`.
+    """
+    lines = [line.rstrip("\r\n") for line in lines]
+    width = max(sum(widths), max(len(line) for line in lines))
+    text = "".join([line.ljust(width) for line in lines]).encode('ascii')
+    chars = np.frombuffer(text, dtype='S1').reshape(len(lines), width)
+    table = np.empty((len(lines), len(widths)))
+    start = 0
+    for i, w in enumerate(widths):
+        column = np.ascontiguousarray(chars[:, start:start + w])
+        table[:, i] = column.view('S%i' % w).ravel().astype(np.float64)
+        start += w
+    return table
+
+
+def _format_column(values, width=0, decimals=None, flag=""):
+    """Formats a column of numbers as ``"%<flag><width>.<decimals>f"`` would
+    (or ``"%<flag><width>i"`` if `decimals` is `None`, for integers), but
+    with arithmetic on whole arrays. Numbers whose rounding cannot be
+    decided exactly this way (near ties), and non-finite ones, are formatted
+    by Python.
+
+    :param flag: ``""``, ``" "`` (a blank in place of a plus sign) or
+        ``"#"`` (a decimal point even without decimals, as Fortran's
+        ``Fw.0`` writes).
+    :return: 2D array of character codes with one row per number, aligned
+        to the right and padded on the left with zeros (no character).
+    """
+    values = np.asarray(values)
+    n = len(values)
+    nDecimals = decimals or 0
+    hasPoint = nDecimals > 0 or (flag == "#" and decimals is not None)
+    special = np.zeros(n, dtype=bool)
+    if values.dtype.kind in 'iu':
+        mantissas = values.astype(np.int64)
+        negative = mantissas < 0
+        mantissas = np.abs(mantissas) * 10 ** nDecimals
+    else:
+        scaled = np.abs(values.astype(np.float64)) * 10. ** nDecimals
+        negative = np.signbit(values)
+        special = ~(scaled < 2. ** 52)
+        scaled[special] = 0.
+        mantissas = np.rint(scaled)
+        if values.dtype.itemsize > 4 or nDecimals > 4:
+            # the product may be rounded, so printf's rounding of the exact
+            # value is only certain away from ties (products of single
+            # precision numbers are exact)
+            special |= np.abs(np.abs(scaled - mantissas) - 0.5) \
+                    <= scaled * 2. ** -50
+        mantissas = mantissas.astype(np.int64)
+    integers = mantissas // 10 ** nDecimals
+    nDigits = np.ones(n, dtype=np.int8)
+    power = 10
+    while True:
+        isLonger = integers >= power
+        if not isLonger.any():
+            break
+        nDigits += isLonger
+        power *= 10
+    bodyLengths = nDigits + (nDecimals + 1 if hasPoint else 0)
+    lengths = np.maximum(bodyLengths + (negative | (flag == " ")), width)
+    fmt = "%" + flag + (str(width) if width > 0 else "") \
+            + ("i" if decimals is None else ".%if" % decimals)
+    specialText = [(i, (fmt % values[i].item()).encode('ascii'))
+            for i in np.nonzero(special)[0]]
+    nChars = max([int(lengths.max()) if n > 0 else 0]
+            + [len(text) for i, text in specialText])
+    chars = np.zeros((n, nChars), dtype=np.uint8)
+    lengths = lengths.astype(np.int8)
+    bodyLengths = bodyLengths.astype(np.int8)
+    # (division by a constant is much faster on narrow integers)
+    if n > 0 and mantissas.max() < 2 ** 32:
+        remainders = mantissas.astype(np.uint32)
+    else:
+        remainders = mantissas
+    ten = remainders.dtype.type(10)
+    for place in range(nChars):
+        column = chars[:, nChars - 1 - place]
+        if hasPoint and place == nDecimals:
+            np.copyto(column, ord("."), where=place < lengths)
+            continue
+        np.copyto(column, ord(" "), where=place < lengths)
+        if negative.any():
+            np.copyto(column, ord("-"),
+                    where=(place == bodyLengths) & negative)
+        quotients = remainders // ten
+        digits = (remainders - quotients * ten).astype(np.uint8)
+        np.copyto(column, digits + np.uint8(ord("0")),
+                where=place < bodyLengths)
+        remainders = quotients
+    for i, text in specialText:
+        chars[i] = 0
+        chars[i, nChars - len(text):] = np.frombuffer(text, dtype=np.uint8)
+    return chars
+
+
+def _format_table(fields):
+    """Joins formatted columns (see :func:`_format_column`) and literal
+    strings, field by field, into the text of all the records.
+    """
+    fields = [np.frombuffer(field.encode('ascii'), dtype=np.uint8)
+            if isinstance(field, str) else field for field in fields]
+    nRows = max([len(field) for field in fields if field.ndim == 2])
+    widths = [field.shape[-1] for field in fields]
+    chars = np.empty((nRows, sum(widths)), dtype=np.uint8)
+    start = 0
+    for field, width in zip(fields, widths):
+        chars[:, start:start + width] = field
+        start += width
+    return chars.tobytes().replace(b"\0", b"").decode('ascii')
+
+
+def _field_offsets(widths, start=0, decimals=None):
+    """Returns the `(offset, width, decimals)` of consecutive fixed-width
+    fields. The optional `decimals` of each field (-1 for an integer) are
+    checked against the decimal points of the records when they are
+    converted; they are not checked where `None`.
+    """
+    if decimals is None:
+        decimals = (None,) * len(widths)
+    fields = []
+    for width, places in zip(widths, decimals):
+        fields.append((start, width, places))
+        start += width
+    return fields
+
+
+def _aperture_count(dtype):
+    """Returns the number of aperture magnitudes (``mag``, ``mag_2``...)
+    among the fields of an .ap catalog's `dtype`.
+    """
+    return len([name for name in dtype.names if name == 'mag'
+            or name.startswith('mag_') and not name.startswith('mag_err')])
+
+
+def get_file_identity(path, digest=True):
+    """Returns the identity of the file at `path` that a catalog's binary
+    sidecar is valid for: its absolute path, size, modification time and
+    SHA-1 digest of its content (left out if `digest` is `False`).
+    """
+    status = os.stat(path)
+    identity = {'path': os.path.abspath(path), 'size': status.st_size,
+        'mtime': status.st_mtime}
+    if digest:
+        identity['sha1'] = get_file_digest(path)
+    return identity
+
+
+def get_file_digest(path):
+    """Returns the SHA-1 hex digest of the content of the file at `path`."""
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(1 << 20)
+            if len(block) == 0:
+                break
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def _map_file(f):
+    """Returns a read-only memory map of the open file `f`, or `None` if it
+    cannot be mapped (e.g. if it is empty).
+    """
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, mmap.error):
+        return None
+
+
+def _close_map(buf):
+    """Closes a memory map, unless arrays still view it."""
+    try:
+        buf.close()
+    except BufferError:
+        # the arrays are held by a traceback; the map closes once they are
+        # collected
+        pass
+
+
+class _RecordMap(namedtuple('_RecordMap', ['offset', 'nRecords',
+        'recordLength', 'period', 'dtype', 'names', 'fields'])):
+    """Fixed-width records in the bytes of a catalog file: `nRecords` of
+    `recordLength` bytes, one every `period` bytes from byte `offset`, with
+    the dtype of the stars and the name and `(offset, width, decimals)` of
+    each column.
+    """
+    __slots__ = ()
+    
+    def view(self, buf):
+        """Returns the records as a 2D array of characters viewing `buf`."""
+        data = np.frombuffer(buf, dtype=np.uint8)[self.offset:]
+        return np.lib.stride_tricks.as_strided(data,
+                shape=(self.nRecords, self.recordLength),
+                strides=(self.period, 1))
+
+
+class CatalogBuilder(object):
+    """Gathers the stars of many catalogs into one array. Stars are copied
+    once, into an array whose capacity grows geometrically, rather than the
+    whole catalog being copied on every append.
+    
+    :param dtype: dtype of the stars; by default, that of the first stars
+        appended.
+    :param capacity: number of stars that room is first made for.
+    """
+    # factor by which the capacity grows when it is exceeded
+    growthFactor = 2
+    
+    def __init__(self, dtype=None, capacity=1024):
+        super(CatalogBuilder, self).__init__()
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        self.capacity = capacity
+        self.nStars = 0
+        # largest id of the stars appended so far
+        self.maxID = 0
+        self._stars = None
+    
+    def reserve(self, nStars):
+        """Makes room for at least `nStars` stars in all. Until the dtype is
+        known, the room is made when the first stars are appended.
+        """
+        if self.dtype is None:
+            self.capacity = max(self.capacity, nStars)
+            return
+        size = len(self._stars) if self._stars is not None else 0
+        if self._stars is not None and nStars <= size:
+            return
+        stars = np.empty(max(nStars, int(self.growthFactor * size),
+                self.capacity), dtype=self.dtype)
+        if self._stars is not None:
+            stars[:self.nStars] = self._stars[:self.nStars]
+        self._stars = stars
+    
+    def append(self, stars, renumber=False):
+        """Copies `stars` after the stars gathered so far.
+        
+        :param renumber: if `True`, the copied stars' ids are offset by the
+            largest id gathered so far, so that they are continuous with
+            the earlier stars'. `stars` itself is left unchanged.
+        :return: slice of the builder's rows that the stars were copied to.
+        """
+        self._check_dtype(stars)
+        nStars = len(stars)
+        self.reserve(self.nStars + nStars)
+        rows = slice(self.nStars, self.nStars + nStars)
+        self._stars[rows] = stars
+        if nStars > 0:
+            if renumber:
+                self._stars['id'][rows] += self.maxID
+            self.maxID = max(self.maxID, int(self._stars['id'][rows].max()))
+        self.nStars += nStars
+        return rows
+    
+    def merge(self, parts, renumber=False):
+        """Appends every array of stars in `parts` (see :meth:`append`),
+        making room for all of them at once.
+        """
+        parts = list(parts)
+        for part in parts:
+            self._check_dtype(part)
+        self.reserve(self.nStars + sum([len(part) for part in parts]))
+        for part in parts:
+            self.append(part, renumber=renumber)
+    
+    def _check_dtype(self, stars):
+        """Adopts the dtype of `stars` if the builder has none yet, or raises
+        `ValueError` if its fields differ from the builder's.
+        """
+        if self.dtype is None:
+            self.dtype = stars.dtype
+        elif stars.dtype.names != self.dtype.names:
+            raise ValueError("Stars with fields %s cannot be appended to "
+                    "stars with fields %s" % (stars.dtype.names,
+                    self.dtype.names))
+    
+    def number_stars(self, first=1):
+        """Renumbers the stars gathered so far consecutively from `first`."""
+        self._stars['id'][:self.nStars] = np.arange(first,
+                first + self.nStars)
+        self.maxID = max(first + self.nStars - 1, 0)
+    
+    def get_stars(self):
+        """Returns the stars gathered so far, as a view of the builder's
+        array. Later appends do not change the rows it views.
+        """
+        if self._stars is None:
+            if self.dtype is None:
+                return None
+            return np.empty(0, dtype=self.dtype)
+        return self._stars[:self.nStars]
+
+
+class MatchStats(namedtuple('MatchStats', ['nStars', 'nMatched',
+        'nAppended', 'radius', 'medianSeparation'])):
+    """Statistics of a positional cross-match of `nStars` new stars against
+    a catalog (see :meth:`DaoCatalogBase.append_unmatched`): `nMatched` were
+    within `radius` of a star of the catalog, with a median separation of
+    `medianSeparation` (`nan` if none matched), and `nAppended` were not.
+    """
+    __slots__ = ()
 
 
 class DaoCatalogBase(object):
     """Base class for the suite of DAOPHOT I/O catalogs."""
+    # attributes, besides the stars and header, saved in binary sidecars
+    cachedAttributes = ()
+    # non-blank lines of each record
+    linesPerRecord = 1
+    # whether the last record is followed by a newline, like the others
+    finalNewline = False
+    # header written before the records of a catalog without one of its own
+    defaultHeader = None
+    
     def __init__(self):
         super(DaoCatalogBase, self).__init__()
         self.stars = None
         self.headerText = None
         self.nStars = 0
         self.nHeaderLines = 2
+        # stars array the id index was built from, its row order by id and
+        # the sorted ids
+        self._idIndex = None
+        # CatalogBuilder of appended catalogs and the stars it last returned
+        self._builder = None
+        # stars array the spatial index was built from, and the GridIndex
+        self._spatialIndex = None
 
-    def open(self, path):
-        """docstring for open"""
+    def open(self, path, columns=None, cache=False):
+        """Reads the catalog file at `path`. Files in daophot's own
+        fixed-width layout are read through a memory map (see
+        :meth:`read_mapped`), others line by line.
+        
+        :param columns: optional names of the only columns to convert; the
+            others are left at zero.
+        :param cache: if `True`, the stars and header are also saved in a
+            binary sidecar next to the file, and later opens reload them from
+            it, as a copy-on-write memory map, for as long as the file is
+            unchanged (see :meth:`get_cache_paths`). The file is unchanged if
+            its path, size and modification time are those the sidecar was
+            made from; its content is only hashed when its modification time
+            (but not its size) differs, e.g. after it was copied.
+        """
+        if cache:
+            identity = get_file_identity(path, digest=False)
+            if not self._load_cache(path, identity):
+                if 'sha1' not in identity:
+                    identity['sha1'] = get_file_digest(path)
+                self._read(path, None)
+                self._save_cache(path, identity)
+            if columns is not None:
+                self._clear_columns(columns)
+        else:
+            self._read(path, columns)
+    
+    def _read(self, path, columns):
+        """Parses the catalog file at `path`."""
+        if self.read_mapped(path, columns):
+            return
         catfile = open(path)
         headerLines, dataLines = self._split_header(catfile)
         catfile.close()
         self.parse(dataLines)
         self.headerText = "".join(headerLines)
+        if columns is not None:
+            self._clear_columns(columns)
+    
+    def _clear_columns(self, columns):
+        """Sets the columns of the stars not named in `columns` to zero."""
+        for name in self.stars.dtype.names:
+            if name not in columns:
+                self.stars[name] = 0
+    
+    def get_cache_paths(self, path):
+        """Returns the paths of the binary sidecar of the catalog file at
+        `path`: the stars as a ``.npy`` array, and a JSON file of the file
+        identity they were read from, the header and other state.
+        """
+        return path + ".cache.npy", path + ".cache.json"
+    
+    def _load_cache(self, path, identity):
+        """Loads the catalog from the sidecar of `path` if it was made from a
+        file with the same `identity` (see :func:`get_file_identity`). If
+        only the modification time differs, the file's digest is added to
+        `identity` and compared; the sidecar is then kept for the new time.
+        
+        :return: `True` if the sidecar was loaded.
+        """
+        arrayPath, statePath = self.get_cache_paths(path)
+        try:
+            f = open(statePath)
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+            if state.get('catalogClass') != self.__class__.__name__:
+                return False
+            cached = state['identity']
+            if any(cached.get(key) != identity[key]
+                    for key in ('path', 'size')):
+                return False
+            if cached.get('mtime') != identity['mtime']:
+                identity['sha1'] = get_file_digest(path)
+                if cached.get('sha1') != identity['sha1']:
+                    return False
+                state['identity'] = identity
+                self._save_cache_state(statePath, state)
+            if state['nStars'] > 0:
+                stars = np.load(arrayPath, mmap_mode='c')
+            else:
+                stars = np.load(arrayPath)
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        if len(stars) != state['nStars']:
+            return False
+        self.stars = stars
+        self.nStars = len(stars)
+        self.headerText = str(state['headerText'])
+        for name, value in state['attributes'].items():
+            setattr(self, str(name), value)
+        return True
+    
+    def _save_cache(self, path, identity):
+        """Saves the catalog in the sidecar of `path`, made from a file with
+        `identity`. Failures to write (e.g. in a read-only directory) are
+        ignored.
+        """
+        arrayPath, statePath = self.get_cache_paths(path)
+        state = {'identity': identity,
+            'catalogClass': self.__class__.__name__,
+            'nStars': int(self.nStars),
+            'headerText': self.headerText,
+            'attributes': dict((name, getattr(self, name))
+                for name in self.cachedAttributes)}
+        try:
+            # written aside, then renamed, so that a sidecar is never read
+            # half-written
+            f = open(arrayPath + ".tmp", 'wb')
+            try:
+                np.save(f, np.ascontiguousarray(self.stars))
+            finally:
+                f.close()
+            os.rename(arrayPath + ".tmp", arrayPath)
+        except (IOError, OSError):
+            return
+        self._save_cache_state(statePath, state)
+    
+    def _save_cache_state(self, statePath, state):
+        """Writes the JSON `state` of a sidecar to `statePath`, ignoring
+        failures to write.
+        """
+        try:
+            f = open(statePath + ".tmp", 'w')
+            try:
+                json.dump(state, f)
+            finally:
+                f.close()
+            os.rename(statePath + ".tmp", statePath)
+        except (IOError, OSError):
+            pass
+    
+    def read_mapped(self, path, columns=None, chunkRecords=65536):
+        """Reads the catalog file at `path` through a memory map. Each
+        column is converted straight from the bytes of the records, which
+        are never copied into Python strings, so large catalogs are read
+        with little more memory than the array of stars. Chunks of records
+        that cannot be converted this way (e.g. with overflowed fields) are
+        parsed as text.
+        
+        :param columns: optional names of the only columns to convert; the
+            others are left at zero.
+        :param chunkRecords: number of records converted at a time.
+        :return: `True` if the file was read, `False` if its records are not
+            in a fixed-width layout known to the catalog (see
+            :meth:`get_record_layout`); the catalog is then unchanged.
+        """
+        f = open(path, 'rb')
+        try:
+            buf = _map_file(f)
+            if buf is None:
+                return False
+            try:
+                records = self._map_records(buf)
+                if records is None:
+                    return False
+                stars = np.zeros(records.nRecords, dtype=records.dtype)
+                for first in range(0, records.nRecords, chunkRecords):
+                    last = min(first + chunkRecords, records.nRecords)
+                    stars[first:last] = self._convert_records(buf, records,
+                            first, last, columns)
+                self.stars = stars
+                self.nStars = records.nRecords
+                self.headerText = buf[:records.offset].decode('ascii')
+                return True
+            finally:
+                _close_map(buf)
+        finally:
+            f.close()
+    
+    def iter_chunks(self, path, rows=65536, columns=None):
+        """Reads the catalog file at `path` in chunks of stars, for catalogs
+        too large to hold in memory at once; `stars` is left unset. The
+        header is kept in `headerText` from the first chunk on, so that the
+        chunks can be streamed to another file with :meth:`write_chunks`::
+        
+            catalog = ApPhotCatalog()
+            chunks = catalog.iter_chunks("survey.ap")
+            catalog.write_chunks("bright.ap",
+                    (stars[stars['mag'] < 18.] for stars in chunks))
+        
+        :param rows: largest number of stars in a chunk.
+        :param columns: optional names of the only columns to convert; the
+            others are left at zero.
+        :return: iterator of structured arrays, in the dtype of the catalog.
+        """
+        f = open(path, 'rb')
+        try:
+            buf = _map_file(f)
+            records = None
+            if buf is not None:
+                try:
+                    records = self._map_records(buf)
+                    if records is not None:
+                        self.headerText = buf[:records.offset].decode(
+                                'ascii')
+                        for first in range(0, records.nRecords, rows):
+                            last = min(first + rows, records.nRecords)
+                            yield self._convert_records(buf, records, first,
+                                    last, columns)
+                finally:
+                    _close_map(buf)
+        finally:
+            f.close()
+        if records is None:
+            for stars in self._iter_text_chunks(path, rows, columns):
+                yield stars
+    
+    def _iter_text_chunks(self, path, rows, columns):
+        """Parses the catalog file at `path` as text, `rows` records at a
+        time (see :meth:`iter_chunks`).
+        """
+        catfile = open(path)
+        try:
+            headerLines = [catfile.readline()
+                    for i in range(self.nHeaderLines + 1)]
+            self.headerText = "".join(headerLines)
+            lines = []
+            nRecords = 0
+            nRecordLines = 0
+            for line in catfile:
+                if nRecords == rows and len(line.strip()) > 0:
+                    yield self._parse_chunk(lines, columns)
+                    lines = []
+                    nRecords = 0
+                lines.append(line)
+                if len(line.strip()) > 0:
+                    nRecordLines += 1
+                    if nRecordLines == self.linesPerRecord:
+                        nRecords += 1
+                        nRecordLines = 0
+            if nRecords > 0:
+                yield self._parse_chunk(lines, columns)
+        finally:
+            catfile.close()
+    
+    def _parse_chunk(self, dataLines, columns):
+        """Returns the stars parsed from the lines of some records, with
+        the columns not named in `columns` set to zero.
+        """
+        chunk = self.__class__()
+        chunk.parse(dataLines)
+        if columns is not None:
+            chunk._clear_columns(columns)
+        for name in self.cachedAttributes:
+            setattr(self, name, getattr(chunk, name))
+        return chunk.stars
+    
+    def _map_records(self, buf):
+        """Finds the records in the bytes of a catalog file.
+        
+        :return: a :class:`_RecordMap`, or `None` if the records are not all
+            in the fixed-width layout of the catalog.
+        """
+        offset = 0
+        for i in range(self.nHeaderLines + 1):
+            offset = buf.find(b"\n", offset) + 1
+            if offset == 0:
+                return None
+        layout = self.get_record_layout(buf[offset:offset + 4096])
+        if layout is None:
+            return None
+        dtype, names, fields, lineWidths, nBlankLines = layout
+        recordLength = sum(lineWidths) + len(lineWidths) - 1
+        period = recordLength + 1 + nBlankLines
+        size = len(buf) - offset
+        if size < recordLength:
+            return None
+        nRecords = (size - recordLength) // period + 1
+        tail = offset + (nRecords - 1) * period + recordLength
+        if len(buf[tail:].strip()) > 0:
+            return None
+        records = _RecordMap(offset, nRecords, recordLength, period, dtype,
+                names, fields)
+        data = np.frombuffer(buf, dtype=np.uint8)[offset:]
+        separators = np.lib.stride_tricks.as_strided(data[recordLength:],
+                shape=(nRecords - 1, period - recordLength),
+                strides=(period, 1))
+        lineEnds = np.cumsum(np.array(lineWidths[:-1], dtype=int) + 1) - 1
+        if not (separators == ord("\n")).all() or not (records.view(buf)[
+                :, lineEnds] == ord("\n")).all():
+            return None
+        return records
+    
+    def _convert_records(self, buf, records, first, last, columns):
+        """Returns the stars of records `first` to `last` of a mapped file,
+        converted from their bytes, or else parsed as text.
+        """
+        wanted = [i for i, name in enumerate(records.names)
+                if columns is None or name in columns]
+        stars = np.zeros(last - first, dtype=records.dtype)
+        if _convert_fields(records.view(buf)[first:last],
+                [records.fields[i] for i in wanted],
+                out=[stars[records.names[i]] for i in wanted]) is None:
+            start = records.offset + first * records.period
+            end = records.offset + (last - 1) * records.period \
+                    + records.recordLength
+            stars = self._parse_chunk(
+                    buf[start:end].decode('ascii').splitlines(True), columns)
+            if stars.dtype != records.dtype or len(stars) != last - first:
+                raise ValueError("Records %i to %i do not match the layout"
+                        " of the catalog" % (first + 1, last))
+        return stars
+    
+    def get_record_layout(self, head):
+        """Returns the fixed-width layout of the catalog's records, given the
+        first bytes after the header, as a tuple of the dtype of the stars,
+        the dtype field of each column, the `(offset, width, decimals)` of
+        each column in a record (see :func:`_field_offsets`), the width of
+        each line of a record and the number of blank lines between records.
+        Catalogs without a fixed-width layout return `None`.
+        """
+        return None
     
     def _split_header(self, f):
         """Given a catalog file descriptor, returns lists of text lines, split
@@ -39,6 +892,82 @@ class DaoCatalogBase(object):
     def get_header(self):
         return self.headerText
     
+    def get_rows(self, ids):
+        """Returns the rows of the stars with the serial numbers `ids` (a
+        number or an array of them), looked up in an index of the stars
+        sorted by id. The index is made on the first lookup and remade when
+        `stars` is replaced; after changing ids in place, call
+        :meth:`index_ids`.
+        
+        :raises KeyError: if an id is not in the catalog.
+        """
+        stars, order, sortedIds, isDense = self._get_id_index()
+        ids = np.asarray(ids)
+        if len(sortedIds) == 0:
+            positions = np.zeros(ids.shape, dtype=np.intp)
+            found = np.zeros(ids.shape, dtype=bool)
+        elif isDense:
+            # consecutive ids are found by subtraction
+            positions = ids.astype(np.int64) - int(sortedIds[0])
+            found = (positions >= 0) & (positions < len(sortedIds)) \
+                    & (ids == np.floor(ids))
+            positions = np.where(found, positions, 0)
+        else:
+            positions = np.searchsorted(sortedIds, ids)
+            positions = np.minimum(positions, len(sortedIds) - 1)
+            found = sortedIds[positions] == ids
+        if not np.all(found):
+            raise KeyError(ids[~found].flat[0].item())
+        return order[positions]
+    
+    def select(self, ids):
+        """Returns a copy of the stars with the serial numbers `ids`, in that
+        order (see :meth:`get_rows`).
+        """
+        return self.stars[self.get_rows(ids)]
+    
+    def index_ids(self):
+        """Remakes the index of the stars by id used by :meth:`get_rows`."""
+        ids = self.stars['id']
+        order = np.argsort(ids, kind='mergesort')
+        sortedIds = ids[order]
+        isDense = len(ids) > 0 \
+                and int(sortedIds[-1]) - int(sortedIds[0]) == len(ids) - 1 \
+                and bool(np.all(np.diff(sortedIds) == 1))
+        self._idIndex = (self.stars, order, sortedIds, isDense)
+    
+    def _get_id_index(self):
+        """Returns the id index, made afresh if `stars` has been replaced."""
+        if self._idIndex is None or self._idIndex[0] is not self.stars:
+            self.index_ids()
+        return self._idIndex
+    
+    def get_spatial_index(self):
+        """Returns a :class:`spatialindex.GridIndex` of the positions of the
+        stars, whose rows are rows of `stars`, for radius, nearest-neighbour
+        and box queries. The index is made on first use and remade when
+        `stars` is replaced; after moving stars in place, call
+        :meth:`index_positions`.
+        """
+        if self._spatialIndex is None \
+                or self._spatialIndex[0] is not self.stars:
+            self.index_positions()
+        return self._spatialIndex[1]
+    
+    def index_positions(self, cellSize=None):
+        """Remakes the spatial index of the stars (see
+        :meth:`get_spatial_index`), optionally with cells of `cellSize`
+        pixels.
+        """
+        self._spatialIndex = (self.stars, GridIndex(self.stars['x'],
+                self.stars['y'], cellSize=cellSize))
+    
+    def select_box(self, x0, x1, y0, y1):
+        """Returns a copy of the stars with `x0 <= x <= x1` and
+        `y0 <= y <= y1`, in catalog order.
+        """
+        return self.stars[self.get_spatial_index().query_box(x0, x1, y0, y1)]
+    
     def set_header(self, headerText):
         self.headerText = headerText
     
@@ -56,25 +985,111 @@ class DaoCatalogBase(object):
     
     def append_catalog(self, newCatalog):
         """Appends a catalog to the end of the current catalog. The serial
-        numbers of stars in the `newCatalog` are updated to be continuous
-        with the current catalog's.
+        numbers of the appended stars are updated to be continuous with the
+        current catalog's; `newCatalog` itself is left unchanged.
+        
+        Successive appends gather the stars with one :class:`CatalogBuilder`,
+        so that each copies only the new stars.
         """
-        maxExistingID = self.stars['id'].max()
-        newCatalog.stars['id'] = newCatalog.stars['id'] + maxExistingID
-        self.stars = np.concatenate((self.stars, newCatalog.stars))
+        self.append_stars(newCatalog.stars)
+    
+    def append_stars(self, stars):
+        """Appends a copy of the array `stars`, with serial numbers updated
+        to be continuous with the current catalog's (see
+        :meth:`append_catalog`).
+        """
+        if self._builder is not None and self._builder[1] is self.stars:
+            builder = self._builder[0]
+        else:
+            builder = CatalogBuilder()
+            if self.stars is not None:
+                builder.append(self.stars)
+        builder.append(stars, renumber=True)
+        self.stars = builder.get_stars()
         self.nStars = len(self.stars)
+        self._builder = (builder, self.stars)
+    
+    def match_positions(self, x, y, radius):
+        """Cross-matches the positions `x`, `y` with the stars through the
+        spatial index (see :meth:`get_spatial_index`).
+        
+        :return: arrays of the row of the nearest star within `radius` of
+            each position (-1 where there is none) and its separation
+            (`inf` where there is none).
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        rows = np.empty(len(x), dtype=np.int64)
+        rows.fill(-1)
+        separations = np.empty(len(x))
+        separations.fill(np.inf)
+        if self.stars is None or self.nStars == 0:
+            return rows, separations
+        queries, matches, distances = self.get_spatial_index().query_radius(
+                x, y, radius)
+        # matches are sorted by position, then by distance
+        isNearest = np.ones(len(queries), dtype=bool)
+        isNearest[1:] = queries[1:] != queries[:-1]
+        rows[queries[isNearest]] = matches[isNearest]
+        separations[queries[isNearest]] = distances[isNearest]
+        return rows, separations
     
-    def write(self, outputPath):
-        """Saves the catalog data in the .ap format to `outputPath`."""
-        catalogLines = self.make_catalog_lines()
-        catalogText = self.headerText + "\n".join(catalogLines)
+    def append_unmatched(self, newCatalog, radius):
+        """Appends the stars of `newCatalog` that are farther than `radius`
+        pixels from every star of the catalog (see :meth:`append_catalog`);
+        the others are dropped as duplicates of the stars they match.
         
+        :return: a :class:`MatchStats` of the cross-match.
+        """
+        rows, separations = self.match_positions(newCatalog.stars['x'],
+                newCatalog.stars['y'], radius)
+        isMatched = rows >= 0
+        nMatched = int(isMatched.sum())
+        if nMatched > 0:
+            medianSeparation = float(np.median(separations[isMatched]))
+        else:
+            medianSeparation = float('nan')
+        self.append_stars(newCatalog.stars[~isMatched])
+        return MatchStats(len(rows), nMatched, len(rows) - nMatched, radius,
+                medianSeparation)
+    
+    def write(self, outputPath, chunkRows=65536):
+        """Saves the catalog to `outputPath`, after its header. The records
+        are formatted a column at a time (see :meth:`format_records`) and
+        written in chunks of `chunkRows` stars.
+        """
+        self.write_chunks(outputPath, (self.stars[first:first + chunkRows]
+                for first in range(0, self.nStars, chunkRows)))
+    
+    def write_chunks(self, outputPath, chunks):
+        """Writes a catalog file of the catalog's header followed by the
+        stars of each array in `chunks`, which is consumed as it is written
+        (see :meth:`iter_chunks`).
+        """
         if os.path.exists(outputPath):
             os.remove(outputPath)
         
+        chunks = iter(chunks)
+        # the first chunk is read before the header, which an iterator
+        # from iter_chunks sets as it starts
+        pending = next(chunks, None)
         f = open(outputPath, 'w')
-        f.write(catalogText)
-        f.close()
+        try:
+            if self.headerText is not None:
+                f.write(self.headerText)
+            elif self.defaultHeader is not None:
+                f.write(self.defaultHeader)
+            text = ""
+            while pending is not None:
+                if len(pending) > 0:
+                    f.write(text)
+                    text = self.format_records(pending)
+                pending = next(chunks, None)
+            if not self.finalNewline:
+                # records are separated, not terminated, by a newline
+                text = text[:-1]
+            f.write(text)
+        finally:
+            f.close()
     
     def right_align_int(self, number, length):
         """docstring for integerLine"""
@@ -124,6 +1139,8 @@ class CoordCatalog(DaoCatalogBase):
     """For managing (reading/writing) .coo files, like produced by
     daophot FIND
     """
+    cachedAttributes = ('fullCatalog',)
+    
     def __init__(self):
         super(CoordCatalog, self).__init__()
         self.fullCatalog = False  # True if it has 6 data records per line
@@ -132,23 +1149,37 @@ class CoordCatalog(DaoCatalogBase):
             ('y', np.float32), ('mag', np.float32), ('sharpness', np.float32),
             ('roundness', np.float32), ('marginal_roundness', np.float32)])
     
+    # Fortran format of the records: (I7, 6F9.3)
+    widths = (7, 9, 9, 9, 9, 9, 9)
+    
+    def _map_records(self, buf):
+        records = super(CoordCatalog, self)._map_records(buf)
+        if records is not None:
+            self.fullCatalog = True
+        return records
+    
+    def get_record_layout(self, head):
+        # only full catalogs, as written by FIND, have a fixed width
+        if len(head.split(b"\n")[0]) != sum(self.widths):
+            return None
+        return (self.dt, self.dt.names, _field_offsets(self.widths),
+                (sum(self.widths),), 0)
+    
     def parse(self, dataLines):
-        """docstring for parse"""
-        self.nStars = len(dataLines)
-        self.stars = np.empty(self.nStars, dtype=self.dt)
-        
-        for i, line in enumerate(dataLines):
-            items = line.split()
-            self.stars['id'][i] = int(items[0])
-            self.stars['x'][i] = float(items[1])
-            self.stars['y'][i] = float(items[2])
-            if len(items) > 3:
-                # expect a full catalog
-                self.stars['mag'][i] = float(items[3])
-                self.stars['sharpness'][i] = float(items[4])
-                self.stars['roundness'][i] = float(items[5])
-                self.stars['marginal_roundness'][i] = float(items[6])
-                self.fullCatalog = True
+        """Parses the records of a .coo file in bulk. Both full catalogs (7
+        columns, as written by FIND) and short ones with only the id, x and
+        y of each star are read; the missing columns of a short catalog are
+        set to zero.
+        """
+        nColumns = 3
+        for line in dataLines:
+            if len(line.strip()) > 0:
+                nColumns = 7 if len(line.split()) > 3 else 3
+                break
+        self.fullCatalog = nColumns == 7
+        self.stars = _parse_table(dataLines, nColumns,
+                self.widths[:nColumns], dtype=self.dt)
+        self.nStars = len(self.stars)
     
     def set_stars(self, newIDs, newX, newY, newMag, newSharpness, newRoundness,
             newMarginalRoundness):
@@ -167,139 +1198,274 @@ class CoordCatalog(DaoCatalogBase):
         if newMarginalRoundness is not None:
             self.stars['marginal_roundness'] = newMarginalRoundness
     
-    def make_catalog_lines(self):
-        catalogLines = []
-        for i in xrange(self.nStars):
-            line = "% *i % *.3f % *.3f %.3f %.3f %.3f %.3f" \
-                    % (3, self.stars['id'][i], 4, self.stars['x'][i],
-                    4, self.stars['y'][i], self.stars['mag'][i],
-                    self.stars['sharpness'][i],
-                    self.stars['roundness'][i],
-                    self.stars['marginal_roundness'][i])
-            catalogLines.append(line)
-        return catalogLines
+    def format_records(self, stars):
+        """Returns the text of the records of `stars`, each followed by a
+        newline, as ``"% 3i % 4.3f % 4.3f %.3f %.3f %.3f %.3f"``.
+        """
+        fields = [_format_column(stars['id'], 3, flag=" "), " ",
+            _format_column(stars['x'], 4, 3, flag=" "), " ",
+            _format_column(stars['y'], 4, 3, flag=" ")]
+        for name in ('mag', 'sharpness', 'roundness', 'marginal_roundness'):
+            fields += [" ", _format_column(stars[name], decimals=3)]
+        return _format_table(fields + ["\n"])
 
 
 class ApPhotCatalog(DaoCatalogBase):
     """A revised class for reading .ap catalogs produced by Daophot:Photometry.
+
+    Each star's record spans two lines (after a blank line): the id,
+    position and the magnitude in each aperture, then the sky, its standard
+    deviation and skewness and the error of each magnitude. The first
+    aperture's magnitude is the ``mag`` column (and ``mag_err`` its error),
+    and those of the others are ``mag_2``, ``mag_err_2``, and so on.
     """
+    # Fortran formats of the two record lines: (I7, 14F9.3) and
+    # (4X, F9.3, 2F6.2, F8.4, 11F9.4); the widths and decimals (-1 for an
+    # integer) of their fields, besides those of further apertures
+    firstWidths = (7, 9, 9)
+    firstDecimals = (-1, 3, 3)
+    apertureWidth = 9
+    secondWidths = (13, 6, 6, 8)
+    secondDecimals = (3, 2, 2, 4)
+    # decimals of the magnitudes, and of their errors, of further apertures
+    magDecimals = 3
+    errDecimals = 4
+    linesPerRecord = 2
+    
     def __init__(self):
         super(ApPhotCatalog, self).__init__()
         self.nHeaderLines = 3
     
-    def parse(self, dataLines):
-        """docstring for parse"""
-        dt = np.dtype([('id', np.uint), ('x', np.float32), ('y', np.float32),
+    def make_dtype(self, nApertures=1):
+        """Returns the dtype of the stars of a catalog with `nApertures`
+        apertures.
+        """
+        names = [('id', np.uint), ('x', np.float32), ('y', np.float32),
             ('mag', np.float32), ("modal_sky", np.float32),
             ("sky_sigma", np.float32), ("sky_skew", np.float32),
-            ("mag_err", np.float32)])
-        
-        # In .ap catalogs, each star has data on two lines; lets split text
-        # into this grouping so that we can enumerate over the stars themselves
-        dataText = "".join(dataLines)
-        # double newline separates stars
-        groupedStarLines = dataText.split("\n\n")
-        
-        self.nStars = len(groupedStarLines)
-        self.stars = np.empty(self.nStars, dtype=dt)
+            ("mag_err", np.float32)]
+        for i in range(2, nApertures + 1):
+            names.append(('mag_%i' % i, np.float32))
+            names.append(('mag_err_%i' % i, np.float32))
+        return np.dtype(names)
+    
+    def get_line_layouts(self, nApertures):
+        """Returns the widths and decimals of the fields of the first record
+        line, then of the second, for `nApertures` apertures.
+        """
+        return (self.firstWidths + (self.apertureWidth,) * nApertures,
+                self.firstDecimals + (self.magDecimals,) * nApertures,
+                self.secondWidths + (self.apertureWidth,) * (nApertures - 1),
+                self.secondDecimals + (self.errDecimals,) * (nApertures - 1))
+    
+    def get_aperture_count(self):
+        """Returns the number of apertures measured in the catalog."""
+        if self.stars is None:
+            return 0
+        return _aperture_count(self.stars.dtype)
+    
+    def get_record_layout(self, head):
+        lines = head.split(b"\n")
+        if len(lines) < 2:
+            return None
+        nApertures = (len(lines[0]) - sum(self.firstWidths)) \
+                // self.apertureWidth
+        firstWidths, firstDecimals, secondWidths, secondDecimals = \
+                self.get_line_layouts(nApertures)
+        if nApertures < 1 or len(lines[0]) != sum(firstWidths) \
+                or len(lines[1]) != sum(secondWidths):
+            return None
+        suffixes = [""] + ["_%i" % i for i in range(2, nApertures + 1)]
+        names = ['id', 'x', 'y'] + ['mag' + suffix for suffix in suffixes] \
+                + ['modal_sky', 'sky_sigma', 'sky_skew'] \
+                + ['mag_err' + suffix for suffix in suffixes]
+        fields = _field_offsets(firstWidths, decimals=firstDecimals) \
+                + _field_offsets(secondWidths, len(lines[0]) + 1,
+                secondDecimals)
+        return (self.make_dtype(nApertures), names, fields,
+                (len(lines[0]), len(lines[1])), 1)
+    
+    def parse(self, dataLines):
+        """Parses the records of an .ap file in bulk. The number of
+        apertures is found from the width of the first record (or, if it
+        was not written by daophot, from its number of values).
+        """
+        start = 0
+        while start < len(dataLines) and len(dataLines[start].strip()) == 0:
+            start += 1
+        nLines = 0
+        while start + nLines < len(dataLines) \
+                and len(dataLines[start + nLines].strip()) > 0:
+            nLines += 1
+        if nLines == 0:
+            self.nStars = 0
+            self.stars = np.empty(0, dtype=self.make_dtype())
+            return
+        recordLines = dataLines[start:start + nLines]
+        # daophot separates the records with single blank lines, so the
+        # lines of each kind can be sliced out directly
+        period = nLines + 1
+        groups = [dataLines[start + i::period] for i in range(nLines)]
+        blanks = dataLines[start + nLines::period]
+        if len(set(len(group) for group in groups)) != 1 \
+                or len(blanks) < len(groups[0]) - 1 \
+                or len("".join(blanks).strip()) > 0:
+            lines = [line for line in dataLines if len(line.strip()) > 0]
+            if len(lines) % nLines != 0:
+                raise ValueError("Expected %i lines in each .ap record"
+                        % nLines)
+            groups = [lines[i::nLines] for i in range(nLines)]
+        nApertures = self._count_apertures(recordLines)
+        layouts = self.get_line_layouts(nApertures)
+        # parse each line of the records at once, and join the values in
+        # record order: id, x, y, mags, sky, sigma, skew, errors; lines
+        # are converted by position only if they have daophot's layout
+        tables = []
+        for i in range(nLines):
+            nValues = len(recordLines[i].split())
+            widths, decimals = None, None
+            if nLines == 2:
+                nValues = 3 + nApertures
+                widths, decimals = layouts[2 * i], layouts[2 * i + 1]
+            tables.append(_parse_table(groups[i], nValues, widths,
+                    decimals))
+        table = np.hstack(tables)
+        if table.shape[1] != 6 + 2 * nApertures:
+            raise ValueError("Expected %i values in each .ap record"
+                    % (6 + 2 * nApertures))
         
-        for i, groupedStarLine in enumerate(groupedStarLines):
-            lines = groupedStarLine.split("\n")
-            firstLineItems = lines[0].split()
-            secondLineItems = lines[1].split()
-            
-            self.stars['id'][i] = int(firstLineItems[0])
-            self.stars['x'][i] = float(firstLineItems[1])
-            self.stars['y'][i] = float(firstLineItems[2])
-            self.stars['mag'][i] = float(firstLineItems[3])
-            
-            self.stars['modal_sky'][i] = float(secondLineItems[0])
-            self.stars['sky_sigma'][i] = float(secondLineItems[1])
-            self.stars['sky_skew'][i] = float(secondLineItems[2])
-            self.stars['mag_err'][i] = float(secondLineItems[3])
-    
-    def make_catalog_lines(self):
-        catalogLines = []
-        for i in xrange(self.nStars):
-            firstLine = "%s %s %s %s" % \
-                    (self.right_align_int(self.stars[i]['id'], 7),
-                    self.right_align_F3(self.stars[i]['x'], 4),
-                    self.right_align_F3(self.stars[i]['y'], 4),
-                    self.mag_str(self.stars[i]['mag']))
-            secondLine = "%s %s %s %s" % \
-                    (self.right_align_F3(self.stars[i]['modal_sky'], 10),
-                    self.right_align_F2(self.stars[i]['sky_sigma'], 2),
-                    self.right_align_F2(self.stars[i]['sky_skew'], 2),
-                    self.mag_err_str(self.stars[i]['mag_err']))
-            catalogLines.append(firstLine + "\n" + secondLine + "\n")
-        return catalogLines
-
-
-class PickCatalog(object):
+        self.nStars = len(table)
+        self.stars = np.empty(self.nStars, dtype=self.make_dtype(nApertures))
+        for i, name in enumerate(['id', 'x', 'y']):
+            self.stars[name] = table[:, i]
+        for i, name in enumerate(['modal_sky', 'sky_sigma', 'sky_skew']):
+            self.stars[name] = table[:, 3 + nApertures + i]
+        for i in range(nApertures):
+            suffix = "_%i" % (i + 1) if i > 0 else ""
+            self.stars['mag' + suffix] = table[:, 3 + i]
+            self.stars['mag_err' + suffix] = table[:, 6 + nApertures + i]
+    
+    def _count_apertures(self, recordLines):
+        """Returns the number of apertures of a record, from the width of
+        its first line if it has daophot's layout, or else from its number
+        of values.
+        """
+        fixedWidth = sum(self.firstWidths)
+        line = recordLines[0].rstrip("\r\n")
+        if len(recordLines) == 2 and len(line) > fixedWidth \
+                and (len(line) - fixedWidth) % self.apertureWidth == 0:
+            nApertures = (len(line) - fixedWidth) // self.apertureWidth
+            widths, decimals = self.get_line_layouts(nApertures)[:2]
+            if all([line[offset + width - 1 - places] == "."
+                    for offset, width, places in _field_offsets(widths,
+                    decimals=decimals) if places >= 0]):
+                return nApertures
+        nValues = sum(len(line.split()) for line in recordLines)
+        return max((nValues - 6) // 2, 1)
+    
+    def format_records(self, stars):
+        """Returns the text of the two-line records of `stars`, each
+        followed by a blank line, in daophot's layout (see
+        :meth:`get_line_layouts`). Magnitudes are clipped at 99.999 and
+        their errors at 9.9999.
+        """
+        nApertures = _aperture_count(stars.dtype)
+        firstWidths, firstDecimals, secondWidths, secondDecimals = \
+                self.get_line_layouts(nApertures)
+        suffixes = [""] + ["_%i" % i for i in range(2, nApertures + 1)]
+        mags = [np.where(stars['mag' + suffix] >= 99.999, 99.999,
+                stars['mag' + suffix]) for suffix in suffixes]
+        errors = [np.where(stars['mag_err' + suffix] >= 9.9999, 9.9999,
+                stars['mag_err' + suffix]) for suffix in suffixes]
+        columns = [stars['id'], stars['x'], stars['y']] + mags + ["\n"] \
+                + [stars['modal_sky'], stars['sky_sigma'],
+                stars['sky_skew']] + errors + ["\n\n"]
+        layouts = list(zip(firstWidths, firstDecimals)) + [None] \
+                + list(zip(secondWidths, secondDecimals)) + [None]
+        fields = []
+        for column, layout in zip(columns, layouts):
+            if layout is None:
+                fields.append(column)
+            else:
+                width, decimals = layout
+                fields.append(_format_column(column, width,
+                        decimals if decimals >= 0 else None))
+        return _format_table(fields)
+
+
+class PickCatalog(DaoCatalogBase):
     """Reads the .lst catalogs produced by DAOPHOT's PICK routine."""
+    # Fortran format of the records: (I7, 4F9.3)
+    widths = (7, 9, 9, 9, 9)
+    finalNewline = True
+    # PICK's header, for lists made with set_stars; the parameters of the
+    # image are not known, and are left at zero
+    defaultHeader = (" NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU"
+            "  RNOISE    FRAD\n  3     0     0     0.0     0.0    0.00    0.00"
+            "    0.00    0.00    0.00\n\n")
+    
     def __init__(self):
         super(PickCatalog, self).__init__()
-        self.stars = None
+        self.nHeaderLines = 2
+        self.dt = np.dtype([('id', np.uint), ('x', np.float32),
+            ('y', np.float32), ('mag', np.float32), ('mag_err', np.float32)])
     
     def read_from_daophot(self, daophot, lstName):
-        """Reads the named list from teh daophot instance."""
-        lstPath = daophot.getPath(lstName, 'lst')
+        """Reads the named list from the daophot instance."""
+        lstPath = daophot.get_path(lstName, 'lst')
         self.read(lstPath)
     
     def read(self, lstPath):
         """Loads the .lst file at lstPath into the instance memory."""
-        self.stars = {}
-        
-        f = open(lstPath, 'rU')
-        for lineNumber, line in enumerate(f):
-            if lineNumber < 3:
-                continue  # I presume these are header lines
-            items = line.split()
-            serial = int(items[0])
-            self.stars[serial] = {'x': float(items[1]),
-                                  'y': float(items[2]),
-                                  'mag': float(items[3]),
-                                  'mag_err': float(items[4])}
-        f.close()
+        self.open(lstPath)
+    
+    def get_record_layout(self, head):
+        if len(head.split(b"\n")[0]) != sum(self.widths):
+            return None
+        return (self.dt, self.dt.names, _field_offsets(self.widths),
+                (sum(self.widths),), 0)
+    
+    def parse(self, dataLines):
+        """Parses the records of a .lst file in bulk."""
+        self.stars = _parse_table(dataLines, len(self.dt.names),
+                self.widths, dtype=self.dt)
+        self.nStars = len(self.stars)
     
     def get_star_ids(self):
         """Returns a list of the ID serial numbers of all stars in the catalog.
         """
-        return self.stars.keys()
+        return self.stars['id'].tolist()
     
     def set_stars(self, serial, x, y, mag, magErr):
-        """Sets the self.stars dictionary by providing lists of the star ID,
-        position and magnitudes."""
-        self.stars = {}
-        for i, star in enumerate(serial):
-            self.stars[star] = {'x': x[i], 'y': y[i], 'mag': mag[i],
-                    'mag_err': mag[i]}
+        """Sets the stars from arrays (or lists) of the star ID, position and
+        magnitudes.
+        """
+        self.nStars = len(serial)
+        self.stars = np.empty(self.nStars, dtype=self.dt)
+        self.stars['id'] = serial
+        self.stars['x'] = x
+        self.stars['y'] = y
+        self.stars['mag'] = mag
+        self.stars['mag_err'] = magErr
     
-    def write(self, outputPath):
-        """Writes a .lst file to the output path, based on the stars in the
-        instance.
+    def format_records(self, stars):
+        """Returns the text of the records of `stars`, each followed by a
+        newline, as ``"% 8i %.3f %.3f %.3f %.4f"``.
         """
-        if os.path.exists(outputPath):
-            os.remove(outputPath)
-        f = open(outputPath, 'w')
-        for idnum, star in self.stars.iteritems():
-            line = "% 8i %.3f %.3f %.3f %.4f\n" % (idnum, star['x'], star['y'],
-                    star['mag'], star['mag_err'])
-            f.write(line)
-        f.close()
+        fields = [_format_column(stars['id'], 8, flag=" ")]
+        for name, decimals in (('x', 3), ('y', 3), ('mag', 3),
+                ('mag_err', 4)):
+            fields += [" ", _format_column(stars[name], decimals=decimals)]
+        return _format_table(fields + ["\n"])
     
     def write_regions(self, outputPath):
         """Creates a DS9-compatible .reg file with the locations of the PSF
         candidates.
         """
-        serials = self.stars.keys()
-        x = [self.stars[idnum]['x'] for idnum in self.stars.keys()]
-        y = [self.stars[idnum]['y'] for idnum in self.stars.keys()]
-        
         psfPoints = PointList()
         psfPoints.setFrame('image')
-        psfPoints.setPoints(x, y, size=15, shapes="x", labels=serials,
-                colours="red")
+        psfPoints.setPoints(self.stars['x'], self.stars['y'], size=15,
+                shapes="x", labels=self.get_star_ids(), colours="red")
         psfPoints.writeTo(outputPath)
     
     def write_wcs_regions(self, outputPath, header):
@@ -349,3 +1515,44 @@ class PSFModel(object):
         meanHWHM = (self.hwhmX + self.hwhmY) / 2.
         fwhm = meanHWHM * 2.
         return fwhm * pixelScale
+
+
+class AllstarCatalog(DaoCatalogBase):
+    """For managing (reading/writing) the .als files of PSF photometry made
+    by allstar.
+    """
+    # Fortran format of the records: (I7, 3F9.3, F9.4, F9.3, F9.0, 2F9.3)
+    widths = (7, 9, 9, 9, 9, 9, 9, 9, 9)
+    finalNewline = True
+    
+    def __init__(self):
+        super(AllstarCatalog, self).__init__()
+        self.nHeaderLines = 2
+        self.dt = np.dtype([('id', np.uint), ('x', np.float32),
+            ('y', np.float32), ('mag', np.float32), ('mag_err', np.float32),
+            ('sky', np.float32), ('niter', np.int32), ('chi', np.float32),
+            ('sharpness', np.float32)])
+    
+    def get_record_layout(self, head):
+        if len(head.split(b"\n")[0]) != sum(self.widths):
+            return None
+        return (self.dt, self.dt.names, _field_offsets(self.widths),
+                (sum(self.widths),), 0)
+    
+    def parse(self, dataLines):
+        """Parses the records of an .als file in bulk."""
+        self.stars = _parse_table(dataLines, len(self.dt.names),
+                self.widths, dtype=self.dt)
+        self.nStars = len(self.stars)
+    
+    def format_records(self, stars):
+        """Returns the text of the records of `stars`, each followed by a
+        newline, in the format of allstar.
+        """
+        fields = []
+        for name, width, decimals in zip(self.dt.names, self.widths,
+                (None, 3, 3, 3, 4, 3, 0, 3, 3)):
+            # niter is written as F9.0, with a trailing decimal point
+            fields.append(_format_column(stars[name], width, decimals,
+                flag="#" if decimals == 0 else ""))
+        return _format_table(fields + ["\n"])
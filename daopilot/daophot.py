@@ -7,25 +7,50 @@ Class wrapper to daophot.
 """
 
 import os
-import sys
 
 import pexpect
 
+from dialogue import Step, Return, converse
+from instrument import get_instrumentation
+from optfile import changed_options, format_value, normalize_options, \
+        read_options, write_options
+
 
 class Daophot(object):
     """Object-oriented interface to drive daophot.
     
     :param inputImagePath: is the path to the FITS image that will be measured.
         This is a real (filesystem) path. All paths should be supplied, and
-        will be returned to the user as filesystem paths. The class internally
-        converts these into shortened (symlinked) paths.
+        will be returned to the user as filesystem paths. Daophot runs in the
+        image's directory, and refers to files by their names there; to run
+        on fast local storage with short (symlinked) names, stage the image
+        in a :class:`workspace.Workspace`.
     :type inputImagePath: str
     :param shell: name of the shell that `daophot` will run in
     :type shell: str (optional)
     :param cmd: name of the `daophot` executable
     :type shell: str (optional)
+    :param options: mapping of daophot option names to values that are set
+        when the session starts (see :meth:`set_options`).
+    :type options: dict (optional)
+    :param instrumentation: registry that the session's command latencies
+        and transcript are recorded in; defaults to
+        :func:`instrument.get_instrumentation`.
+    :type instrumentation: :class:`instrument.Instrumentation` (optional)
+    :param stepCache: cache that the outputs of *FIND*, *PHOTOMETRY*, *PICK*
+        and *PSF* are stored in and, when the inputs, options and parameters
+        of a command are unchanged, restored from instead of running daophot.
+    :type stepCache: :class:`stepcache.StepCache` (optional)
+    :param supervisor: watches each command for a stalled daophot process;
+        a stalled, timed out or crashed process is killed, and the command is
+        retried in a fresh session restored to the state after the last
+        completed command. Without a supervisor, such a process is killed
+        and the error is raised.
+    :type supervisor: :class:`watchdog.Supervisor` (optional)
     """
-    def __init__(self, inputImagePath, shell="/bin/zsh", cmd="daophot"):
+    def __init__(self, inputImagePath, shell="/bin/zsh", cmd="daophot",
+            options=None, instrumentation=None, stepCache=None,
+            supervisor=None):
         super(Daophot, self).__init__()
         self.inputImagePath = inputImagePath
         self.cmd = cmd
@@ -33,16 +58,18 @@ class Daophot(object):
         self._workDir = os.path.dirname(self.inputImagePath)
         # a pexpect process running daophot, None when shutdown
         self._daophot = None
+        # options currently in effect in the daophot session
+        self._options = {}
+        self._startupOptions = {'WA': -2}  # turn off extraneous printing
+        self._startupOptions.update(normalize_options(options))
+        if instrumentation is None:
+            instrumentation = get_instrumentation()
+        self._stats = instrumentation.new_session('daophot',
+                label=self.inputImagePath)
+        self._stepCache = stepCache
+        self._supervisor = supervisor
         
-        # Cache for paths; two levels of dictionaries. First level is keyed
-        # to the types of files (represented by file extension strings). Second
-        # level is keyed by the path names themselves
-        self._pathCache = {'fits': {},
-                'coo': {}, 'lst': {}, 'ap': {}, 'psf': {}, 'nei': {}}
-        self._pathCache['fits']['input_image'] \
-                = os.path.basename(self.inputImagePath)
-        self._pathCache['fits']['last'] \
-                = os.path.basename(self.inputImagePath)
+        self._reset_path_cache()
 
         self._startup()
     
@@ -51,34 +78,199 @@ class Daophot(object):
 
         Automatically called by :meth:`__init__`.
         """
+        self._daophot = self._spawn()
+        self._converse("STARTUP", self._banner_dialogue)
+        self.set_options(self._startupOptions)
+        self.attach('input_image')
+    
+    def _spawn(self, **spawnArgs):
+        """Spawns the daophot process and returns the pexpect instance.
+        `spawnArgs` are passed to :class:`pexpect.spawn`.
+        """
         # We start daophot from the working directory (the directory of the
         # input image.) All output will be placed in this directory. From
         # the user's perspective, the returned paths will still be relative
         # to the pipeline's base directory.
-        startupCommand = '/bin/tcsh -c "cd %s;daophot"' % self._workDir
-        self._daophot = pexpect.spawn(startupCommand)
-        self._daophot.logfile = sys.stdout  # DEBUG
-        self._daophot.expect("Command:")
-        # print self._daophot.before
-        self.set_option("WA", "-2")  # turn off extraneous printing
+        startupCommand = '%s -c "cd %s;%s"' % (self.shell, self._workDir,
+                self.cmd)
+        child = pexpect.spawn(startupCommand, **spawnArgs)
+        # keep only the tail of the transcript, see get_transcript()
+        child.logfile = self._stats.transcript
+        return child
+    
+    def _converse(self, command, dialogueFunc, *args):
+        """Drives the dialogue made by `dialogueFunc(*args)` with the daophot
+        process, recording latencies under the name of the daophot `command`.
+
+        If the process stalls, times out or dies, it is killed. With a
+        supervisor, the session is then restarted and a new dialogue is run,
+        until it succeeds or the supervisor gives up.
+        """
+        options = dict(self._options)
+        attempt = 0
+        while True:
+            try:
+                if attempt > 0:
+                    self._restart(command, options)
+                return converse(self._daophot, dialogueFunc(*args),
+                        self._stats, command, watch=self._make_watch(command))
+            except (pexpect.TIMEOUT, pexpect.EOF) as error:
+                self.kill()
+                attempt += 1
+                if self._supervisor is None or command == "EXIT" \
+                        or not self._supervisor.retry(self.inputImagePath,
+                        command, attempt, error):
+                    raise
+    
+    def _restart(self, command, options):
+        """Starts a new daophot process in the state the session was in
+        before `command`: same `options`, and the same image attached.
+        """
+        self._daophot = self._spawn()
+        if command == "STARTUP":
+            return  # the retried command waits for the banner
+        converse(self._daophot, self._banner_dialogue(), self._stats,
+                "STARTUP")
+        converse(self._daophot, self._set_options_dialogue(options),
+                self._stats, "OPTION")
+        converse(self._daophot, self._attach_dialogue('last'), self._stats,
+                "ATTACH")
+    
+    def _make_watch(self, command):
+        """Returns the supervisor's :class:`watchdog.Watch` for `command`,
+        scaled by the attached image and the catalog the command most likely
+        reads, or `None` without a supervisor.
+        """
+        if self._supervisor is None:
+            return None
+        catalogPath = None
+        ext = {'PHOTOMETRY': 'coo', 'PICK': 'ap', 'PSF': 'ap',
+                'SUBSTAR': 'ap'}.get(command)
+        if ext is not None and 'last' in self._pathCache[ext]:
+            catalogPath = os.path.join(self._workDir,
+                    self._pathCache[ext]['last'])
+        transcript = self._stats.transcript
+        return self._supervisor.watch(command, lambda: transcript.nWritten,
+                imagePath=self.get_path('last', 'fits'),
+                catalogPath=catalogPath)
+    
+    def _banner_dialogue(self):
+        """Waits for daophot's first command prompt."""
+        yield Step(None, "Command:")
+        # daophot has loaded daophot.opt from the working directory, so only
+        # options that differ from it need to be sent
+        self._options = read_options(
+                os.path.join(self._workDir, "daophot.opt"))
+    
+    def retarget(self, inputImagePath):
+        """Re-uses the running daophot session for a new input image.
+
+        The path cache is reset and the new image is attached, so the session
+        behaves as if it had been freshly started on `inputImagePath`. Since
+        daophot cannot change its working directory, the new image must live
+        in the same directory as the session's current image.
+
+        :param inputImagePath: path to the next FITS image to be measured.
+        :type inputImagePath: str
+        """
+        self._set_input_image(inputImagePath)
         self.attach('input_image')
     
+    def _set_input_image(self, inputImagePath):
+        """Makes `inputImagePath` the session's input image, resetting the
+        path cache.
+        """
+        workDir = os.path.dirname(inputImagePath)
+        if workDir != self._workDir:
+            raise ValueError("Cannot retarget a daophot session in %s to %s"
+                    % (self._workDir, inputImagePath))
+        self.inputImagePath = inputImagePath
+        self._reset_path_cache()
+
+    def is_alive(self):
+        """Returns `True` if the daophot process is still running."""
+        return self._daophot is not None and self._daophot.isalive()
+
+    def get_work_dir(self):
+        """Returns the working directory that daophot was started in."""
+        return self._workDir
+    
+    def get_stats(self):
+        """Returns the session's :class:`instrument.SessionStats`, with
+        latency histograms of each command and prompt stage.
+        """
+        return self._stats
+    
+    def get_transcript(self):
+        """Returns the most recent part of the daophot transcript (the size
+        is set by the session's :class:`instrument.Instrumentation`).
+        """
+        return self._stats.get_transcript()
+
     def shutdown(self):
         """Shutdown the daophot process."""
-        self._daophot.sendline("exit")
+        if self._daophot is None:
+            return
+        try:
+            self._converse("EXIT", self._shutdown_dialogue)
+        except (pexpect.TIMEOUT, pexpect.EOF, OSError):
+            pass
+        self.kill()
+    
+    def kill(self):
+        """Kills the daophot process without asking it to exit."""
+        if self._daophot is None:
+            return
+        self._daophot.close(force=True)
         self._daophot = None
     
+    def _shutdown_dialogue(self):
+        yield Step("exit", pexpect.EOF, timeout=10)
+    
     def set_option(self, name, value):
         """Set the named option in daophot to a given value."""
-        self._daophot.sendline("OPTION")
-        self._daophot.expect(":")  # asks for the file with parameter values
-        self._daophot.sendline("")  # accept the defaults
-        self._daophot.expect("OPT>")
-        self._daophot.sendline("%s=%s" % (name, value))
-        self._daophot.expect("OPT>")
-        self._daophot.sendline("")
-        self._daophot.expect("Command:")
-        print self._daophot.before
+        self.set_options({name: value})
+    
+    def set_options(self, options):
+        """Sets daophot options from a mapping of option names (e.g. 'VA')
+        to values.
+
+        The session keeps track of the options in effect, so only values that
+        differ from the current state are sent, all in a single *OPTION*
+        round trip. Nothing is sent if no option changes.
+        """
+        self._converse("OPTION", self._set_options_dialogue, options)
+    
+    def _set_options_dialogue(self, options):
+        changes = changed_options(self._options, options)
+        if len(changes) == 0:
+            return
+        yield Step("OPTION", ":")  # asks for the file with parameter values
+        yield Step("", "OPT>")  # accept the defaults
+        for name, value in changes:
+            yield Step("%s=%s" % (name, format_value(value)), "OPT>")
+        yield Step("", "Command:")
+        self._options.update(changes)
+    
+    def get_options(self):
+        """Returns a dictionary of the options known to be in effect in the
+        session (those read from ``daophot.opt`` at startup and those set
+        since).
+        """
+        return dict(self._options)
+    
+    def save_options(self, path=None):
+        """Writes the options currently in effect to an option file, by
+        default ``daophot.opt`` in the working directory. A daophot session
+        started later in that directory reads the file on startup, and so
+        needs no interactive *OPTION* traffic to be configured.
+
+        :return: path to the option file.
+        """
+        if path is None:
+            path = os.path.join(self._workDir, "daophot.opt")
+        write_options(path, self._options)
+        return path
     
     def attach(self, image):
         """Attaches the given image to daophot. *image* will be resolved
@@ -92,12 +284,14 @@ class Daophot(object):
         1. If a name in the imageCache, that path will be used
         2. If not in the imageCache, then it will be used as a path itself
         """
+        self._converse("ATTACH", self._attach_dialogue, image)
+    
+    def _attach_dialogue(self, image):
         imagePath = self._resolve_path(image, 'fits')
         self._set_last_path(imagePath, 'fits')
         
         command = "ATTACH %s" % imagePath
-        self._daophot.sendline(command)
-        self._daophot.expect("Command:")
+        yield Step(command, "Command:")
     
     def find(self, nAvg=1, nSum=1, cooName=None, cooPath=None):
         """Runs the *FIND* command on the previously attached image.
@@ -108,21 +302,33 @@ class Daophot(object):
             otherwise a default path is made.
         :type cooPath: str (optional)
         """
+        key, outputs = self._find_step(nAvg, nSum, cooName, cooPath)
+        if self._restore_step(key, outputs) is None:
+            self._converse("FIND", self._find_dialogue, nAvg, nSum, cooName,
+                    outputs[0][0])
+            self._store_step(key, outputs, command="FIND")
+    
+    def _find_step(self, nAvg, nSum, cooName, cooPath):
+        """Returns the step cache key and outputs of *FIND* (see
+        :meth:`_restore_step`).
+        """
+        cooPath = self._get_output_path(cooPath, cooName, "coo")
+        key = self._get_step_key("FIND", [self._resolve_path('last', 'fits')],
+                (nAvg, nSum))
+        return key, [(cooPath, cooName, 'coo')]
+    
+    def _find_dialogue(self, nAvg, nSum, cooName, cooPath):
         cooPath = self._make_output_path(cooPath, cooName, "coo")
         self._name_path(cooName, cooPath, 'coo')
         self._set_last_path(cooPath, 'coo')
         
-        self._daophot.sendline("FIND")
         # asks 'Number of frames averaged, summed:'
-        self._daophot.expect(":")
-        self._daophot.sendline("%i,%i" % (nAvg, nSum))
+        yield Step("FIND", ":")
         # asks 'File for positions (default ???.coo):'
-        self._daophot.expect(":")
-        self._daophot.sendline(cooPath)
-        self._daophot.expect("Are you happy with this?", timeout=60 * 20)
-        # print self._daophot.before
-        self._daophot.sendline("Y")
-        self._daophot.expect("Command:")
+        yield Step("%i,%i" % (nAvg, nSum), ":")
+        yield Step(cooPath, "Are you happy with this?", timeout=60 * 20,
+                watch=True)
+        yield Step("Y", "Command:")
     
     def apphot(self, coordinates, apRadPath=None, photOutputPath=None,
             photOutputName=None, options=None):
@@ -141,37 +347,54 @@ class Daophot(object):
         :param options: Sequence of `(optionName, optionValue)` pairs (both str
             values) passed to the PHOTOMETRY sub routine.
         """
-        self._daophot.sendline("PHOTOMETRY")
+        key, outputs = self._apphot_step(coordinates, apRadPath,
+                photOutputPath, photOutputName, options)
+        if self._restore_step(key, outputs) is None:
+            self._converse("PHOTOMETRY", self._apphot_dialogue, coordinates,
+                    apRadPath, outputs[0][0], photOutputName, options)
+            self._store_step(key, outputs, command="PHOTOMETRY")
+    
+    def _apphot_step(self, coordinates, apRadPath, photOutputPath,
+            photOutputName, options):
+        """Returns the step cache key and outputs of *PHOTOMETRY* (see
+        :meth:`_restore_step`).
+        """
+        photOutputPath = self._get_output_path(photOutputPath,
+                photOutputName, "ap")
+        apRadFile = os.path.basename(apRadPath or "photo.opt")
+        params = sorted(options.items()) if options is not None else ()
+        key = self._get_step_key("PHOTOMETRY",
+                [self._resolve_path('last', 'fits'),
+                self._resolve_path(coordinates, 'coo'), apRadFile], params)
+        return key, [(photOutputPath, photOutputName, 'ap')]
+    
+    def _apphot_dialogue(self, coordinates, apRadPath, photOutputPath,
+            photOutputName, options):
         # asks for 'File with aperture radii (default photo.opt)'
-        self._daophot.expect(":")
+        yield Step("PHOTOMETRY", ":")
         
         if apRadPath is not None:
-            self._daophot.sendline(os.path.basename(apRadPath))
+            yield Step(os.path.basename(apRadPath), "PHO>")
         else:
-            self._daophot.sendline("")  # assume default photo.opt file
+            yield Step("", "PHO>")  # assume default photo.opt file
         
-        self._daophot.expect("PHO>")
         if options is not None:
-            for optionName, optionValue in options.iteritems():
-                self._daophot.sendline(optionName + "=" + optionValue)
-                self._daophot.expect("PHO>")
-        self._daophot.sendline("")
+            for optionName, optionValue in options.items():
+                yield Step(optionName + "=" + optionValue, "PHO>")
         
         # asks 'Input position file (default source/sky28k.coo):'
-        self._daophot.expect(":")
+        yield Step("", ":")
         
         cooPath = self._resolve_path(coordinates, 'coo')
-        self._daophot.sendline(cooPath)
         # asks 'Output file (default source/sky28k.ap):'
-        self._daophot.expect(":")
+        yield Step(cooPath, ":")
         
         photOutputPath = self._make_output_path(photOutputPath,
                 photOutputName, "ap")
         self._name_path(photOutputName, photOutputPath, 'ap')
         self._set_last_path(photOutputPath, 'ap')
         
-        self._daophot.sendline(photOutputPath)
-        self._daophot.expect("Command:", timeout=60 * 20)
+        yield Step(photOutputPath, "Command:", timeout=60 * 20, watch=True)
     
     def pick_psf_stars(self, nStars, apPhot, starListPath=None,
             starListName=None, magLimit=99):
@@ -188,6 +411,27 @@ class Daophot(object):
         :param magLimit: is the limiting instrumental magnitude that can be
             used as a PSF prototype. Can be a str object.
         """
+        key, outputs = self._pick_step(nStars, apPhot, starListPath,
+                starListName, magLimit)
+        if self._restore_step(key, outputs) is None:
+            self._converse("PICK", self._pick_dialogue, nStars, apPhot,
+                    outputs[0][0], starListName, magLimit)
+            self._store_step(key, outputs, command="PICK")
+    
+    def _pick_step(self, nStars, apPhot, starListPath, starListName,
+            magLimit):
+        """Returns the step cache key and outputs of *PICK* (see
+        :meth:`_restore_step`).
+        """
+        starListPath = self._get_output_path(starListPath, starListName,
+                'lst')
+        key = self._get_step_key("PICK", [self._resolve_path('last', 'fits'),
+                self._resolve_path(apPhot, 'ap')],
+                (str(int(nStars)), str(magLimit)))
+        return key, [(starListPath, starListName, 'lst')]
+    
+    def _pick_dialogue(self, nStars, apPhot, starListPath, starListName,
+            magLimit):
         magLimit = str(magLimit)
         nStars = str(int(nStars))
         apPhotPath = self._resolve_path(apPhot, 'ap')
@@ -197,18 +441,14 @@ class Daophot(object):
         self._name_path(starListName, starListPath, 'lst')
         self._set_last_path(starListPath, 'lst')
         
-        self._daophot.sendline("PICK")
         # ask for input file name to .ap file
-        self._daophot.expect(":")
-        self._daophot.sendline(apPhotPath)
+        yield Step("PICK", ":")
         # asks for 'Desired number of stars, faintest magnitude:'
-        self._daophot.expect(":")
-        self._daophot.sendline(",".join((nStars, magLimit)))
+        yield Step(apPhotPath, ":")
         # asks for output file path, .lst
-        self._daophot.expect(":")
+        yield Step(",".join((nStars, magLimit)), ":")
         # TODO implement output filepath
-        self._daophot.sendline("")
-        self._daophot.expect("Command:", timeout=60 * 10)
+        yield Step("", "Command:", timeout=60 * 10, watch=True)
     
     def make_psf(self, apPhot, starList, psfPath=None, psfName=None):
         """Computes a PSF model with the daophot *PSF* command.
@@ -218,9 +458,48 @@ class Daophot(object):
             to the .ap file
         :param starList: points to the psf prototype star list.
         
-        :return: text output of fitting routine, path to the psf file and path
-            to the neighbours file
+        :return: text output of fitting routine (a `str`, also when restored
+            from the step cache), path to the psf file and path to the
+            neighbours file; all three are `None` if the fit did not
+            converge.
+        """
+        key, outputs = self._psf_step(apPhot, starList, psfPath, psfName)
+        cached = self._restore_step(key, outputs)
+        if cached is not None:
+            return self._get_psf_result(cached.text, outputs)
+        result = self._converse("PSF", self._psf_dialogue, apPhot, starList,
+                outputs[0][0], psfName)
+        return self._store_psf_step(key, outputs, result)
+    
+    def _psf_step(self, apPhot, starList, psfPath, psfName):
+        """Returns the step cache key and outputs of *PSF* (see
+        :meth:`_restore_step`).
         """
+        psfPath = self._get_output_path(psfPath, psfName, 'psf')
+        neiPath = ".".join((os.path.splitext(psfPath)[0], 'nei'))
+        key = self._get_step_key("PSF", [self._resolve_path('last', 'fits'),
+                self._resolve_path(apPhot, 'ap'),
+                self._resolve_path(starList, 'lst')])
+        return key, [(psfPath, psfName, 'psf'), (neiPath, None, 'nei')]
+    
+    def _get_psf_result(self, fittingText, outputs):
+        """Returns the result of :meth:`make_psf`, given the fitting text and
+        the outputs of :meth:`_psf_step`.
+        """
+        return (fittingText, os.path.join(self._workDir, outputs[0][0]),
+                os.path.join(self._workDir, outputs[1][0]))
+    
+    def _store_psf_step(self, key, outputs, result):
+        """Stores the outputs of a *PSF* run that converged in the step
+        cache; a fit that failed is not cached, so it is run again next time.
+
+        :return: `result`.
+        """
+        if result[0] is not None:
+            self._store_step(key, outputs, text=result[0], command="PSF")
+        return result
+    
+    def _psf_dialogue(self, apPhot, starList, psfPath, psfName):
         apPhotPath = self._resolve_path(apPhot, 'ap')
         
         starListPath = self._resolve_path(starList, 'lst')
@@ -237,39 +516,34 @@ class Daophot(object):
         if os.path.exists(neiPath):
             os.remove(neiPath)
         
-        self._daophot.sendline("PSF")
         # asks for file with aperture phot results
-        self._daophot.expect(":")
-        self._daophot.sendline(apPhotPath)
+        yield Step("PSF", ":")
         # asks for file with PSF prototype star list
-        self._daophot.expect(":")
-        self._daophot.sendline(starListPath)
+        yield Step(apPhotPath, ":")
         # asks for file for the psf output file
-        self._daophot.expect(":")
-        self._daophot.sendline(psfPath)
+        yield Step(starListPath, ":")
         # funny hack; pexpect has trouble here, but works
         # self._daophot.expect(".nei", timeout=120)
         
         # send a CR to make sure we're clean before leaving
         # self._daophot.sendline("")
-        result = self._daophot.expect(["nei", "Failed to converge.",
-            "Command:"], timeout=60 * 10)
-        # save daophot's output of fit quality
+        result = yield Step(psfPath, ["nei", "Failed to converge.",
+            "Command:"], timeout=60 * 10, stage="fit", watch=True)
+        # save daophot's output of fit quality, as text whether or not it
+        # comes back from the step cache
         fittingText = self._daophot.before
+        if isinstance(fittingText, bytes) and not isinstance(fittingText, str):
+            fittingText = fittingText.decode('utf-8', 'replace')
         if result == 1 or result == 2:
             # failed to converge
-            print "didn't converge. now what?"
             # raise PSFNotConverged
-            return None, None, None
+            raise Return((None, None, None))
         
         # otherwise we should have good convergence
-        print result,
-        print "Ok convergence?"
-        self._daophot.sendline("")
-        self._daophot.expect("Command:")
+        yield Step("", "Command:")
         
-        return fittingText, os.path.join(self._workDir, psfPath), \
-            os.path.join(self._workDir, neiPath)
+        raise Return((fittingText, os.path.join(self._workDir, psfPath),
+            os.path.join(self._workDir, neiPath)))
     
     def substar(self, substarList, psf, outputPath, keepers=None):
         """Subtracts stars in `substarList` from the attached image using the
@@ -287,49 +561,63 @@ class Daophot(object):
             
         :return: outputPath, relative to the pipeline.
         """
+        self._converse("SUBSTAR", self._substar_dialogue, substarList, psf,
+                outputPath, keepers)
+        return outputPath
+    
+    def _substar_dialogue(self, substarList, psf, outputPath, keepers):
         psfPath = self._resolve_path(psf, 'psf')
         if os.path.exists(outputPath):
             os.remove(outputPath)
         
-        self._daophot.sendline("SUBSTAR")
-        self._daophot.expect(":")  # File with the PSF (*)
-        self._daophot.sendline(os.path.basename(psfPath))
-        self._daophot.expect(":")  # File with photometry (*)
-        self._daophot.sendline(os.path.basename(substarList))
-        # print "send substarList"
-        # print self._daophot.interact()
-        self._daophot.expect("in\?")  # Do you have stars to leave in
+        yield Step("SUBSTAR", ":")  # File with the PSF (*)
+        yield Step(os.path.basename(psfPath), ":")  # File with photometry (*)
+        # Do you have stars to leave in
+        yield Step(os.path.basename(substarList), "in\?")
         if keepers is not None:
-            self._daophot.sendline("Y")
-            # print self._daophot.before
-            self._daophot.expect(":")  # File with star list (*)
-            self._daophot.sendline(os.path.basename(keepers))
+            yield Step("Y", ":")  # File with star list (*)
+            yield Step(os.path.basename(keepers), ":")
         else:
-            self._daophot.sendline("N")
-        self._daophot.expect(":")  # Name for subtracted image (*)
-        self._daophot.sendline(os.path.basename(outputPath))
-        self._daophot.expect("Command:", timeout=60 * 10)
-        
-        return outputPath
+            yield Step("N", ":")  # Name for subtracted image (*)
+        yield Step(os.path.basename(outputPath), "Command:", timeout=60 * 10,
+                watch=True)
+    
+    def register_path(self, path, ext, name=None):
+        """Files an existing file of type `ext` (e.g. made by an earlier
+        session) as the 'last' of its type, and under `name` if given, as if
+        this session had made it.
+        """
+        path = os.path.basename(path)
+        self._name_path(name, path, ext)
+        self._set_last_path(path, ext)
     
     def get_path(self, name, ext):
         """Returns the named path of type ext. The path will be relative
         to the pipeline's base... as the user would expect."""
         return os.path.join(self._workDir, self._resolve_path(name, ext))
     
+    def _reset_path_cache(self):
+        """Empties the path cache, leaving only the input image."""
+        # Cache for paths; two levels of dictionaries. First level is keyed
+        # to the types of files (represented by file extension strings). Second
+        # level is keyed by the path names themselves
+        self._pathCache = {'fits': {},
+                'coo': {}, 'lst': {}, 'ap': {}, 'psf': {}, 'nei': {}}
+        self._pathCache['fits']['input_image'] \
+                = os.path.basename(self.inputImagePath)
+        self._pathCache['fits']['last'] \
+                = os.path.basename(self.inputImagePath)
+    
     def _resolve_path(self, path, ext):
         """Resolves path into a path to the given type (via ext extension)
         of file if it is name. Or if it is a path already, that
         path will be passed through. The returned path is relative to the
         workDir (working directory) of this Daophot.
         """
-        print path,
-        print ext
         try:
             resolvedPath = self._pathCache[ext][path]
-        except:
-            print "This is a path"
-            print path
+        except KeyError:
+            # This is a path
             resolvedPath = os.path.basename(path)
         return resolvedPath
     
@@ -344,7 +632,51 @@ class Daophot(object):
         """Makes the path be filed under 'last' in its type's cache."""
         self._pathCache[ext]['last'] = path
     
-    def _make_output_path(self, path, name, ext):
+    def _get_step_key(self, command, inputs, params=()):
+        """Returns the step cache key of a daophot `command` that reads the
+        files `inputs` (relative to `workDir`) with the options currently in
+        effect, or `None` if the session has no step cache.
+        """
+        if self._stepCache is None:
+            return None
+        inputPaths = [os.path.join(self._workDir, path)
+                for path in list(inputs) + ["daophot.opt"]]
+        return self._stepCache.make_key(command, inputPaths, self._options,
+                params)
+    
+    def _restore_step(self, key, outputs):
+        """Restores the outputs of a cached command, filing their paths in
+        the path cache as the command itself would have.
+
+        :param outputs: list of `(path, name, ext)` of the command's output
+            files, with paths relative to `workDir`.
+        :return: the :class:`stepcache.CachedStep`, or `None` on a miss (or
+            if `key` is `None`).
+        """
+        if key is None:
+            return None
+        cached = self._stepCache.get(key,
+                [os.path.join(self._workDir, path) for path, name, ext
+                in outputs])
+        if cached is not None:
+            for path, name, ext in outputs:
+                self.register_path(path, ext, name=name)
+        return cached
+    
+    def _store_step(self, key, outputs, text=None, command=None):
+        """Stores the output files of a command in the step cache under
+        `key`.
+
+        :param outputs: list of `(path, name, ext)` of the command's output
+            files, as for :meth:`_restore_step`.
+        """
+        if key is None:
+            return
+        self._stepCache.put(key,
+                [os.path.join(self._workDir, path) for path, name, ext
+                in outputs], text=text, command=command)
+    
+    def _get_output_path(self, path, name, ext):
         """Forms an output file path. If path is None, then a path is made
         using the name. If both path and name are None, then a path is formed
         from the inputImagePath and the filename extension *ext*.
@@ -360,10 +692,16 @@ class Daophot(object):
             path = ".".join((fileRoot, ext))
         else:
             path = os.path.basename(path)
-        
+        return path
+    
+    def _make_output_path(self, path, name, ext):
+        """Forms an output file path (see :meth:`_get_output_path`) and
+        deletes any existing file there, so that daophot does not ask to
+        overwrite it.
+        """
+        path = self._get_output_path(path, name, ext)
         fullpath = os.path.join(self._workDir, path)
         if os.path.exists(fullpath):
-            print "removing existing %s" % fullpath
             os.remove(fullpath)
         
         return path
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Prompt/response dialogues with daophot and allstar.
+
+Each daophot command is written once as a *dialogue*: a generator that
+yields :class:`Step` objects (a line to send and the prompt(s) to wait for)
+and is sent back the index of the prompt that matched. A dialogue may end
+early with ``raise Return(value)`` to hand a value back to its caller.
+
+Separating the dialogue from the I/O lets the same command description be
+driven by different drivers; :func:`converse` drives a dialogue with a
+blocking pexpect process. Drivers time every step and whole command into an
+optional :class:`instrument.SessionStats`, and may hand the step where the
+command does its work (marked with `watch`) to a :class:`watchdog.Watch`.
+"""
+
+import time
+
+
+class Step(object):
+    """One exchange in a dialogue.
+
+    :param send: line to send to the process, or `None` to send nothing and
+        only wait for the prompt.
+    :param expect: pattern, or list of patterns, to wait for after sending.
+        The index of the matched pattern is sent back into the dialogue.
+    :param timeout: seconds to wait for the pattern; -1 uses the process's
+        default timeout.
+    :param stage: name of the step for latency statistics; by default the
+        expected pattern is used.
+    :param watch: `True` for the step where the process does the command's
+        work, which a driver's :class:`watchdog.Watch` (if any) waits on
+        instead of waiting `timeout` seconds.
+    """
+    def __init__(self, send, expect, timeout=-1, stage=None, watch=False):
+        super(Step, self).__init__()
+        self.send = send
+        self.expect = expect
+        self.timeout = timeout
+        self.stage = stage
+        self.watch = watch
+
+    def get_stage(self, command):
+        """Returns the name of the step within `command`, e.g.
+        ``'FIND:Are you happy with this?'``.
+        """
+        stage = self.stage
+        if stage is None:
+            patterns = self.expect if isinstance(self.expect, list) \
+                    else [self.expect]
+            stage = "|".join(getattr(p, '__name__', str(p))
+                    for p in patterns)
+        return "%s:%s" % (command, stage)
+
+    def __repr__(self):
+        return "Step(%r, %r, timeout=%r)" % (self.send, self.expect,
+                self.timeout)
+
+
+class Return(Exception):
+    """Raised by a dialogue to finish and return `value` to the driver."""
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+def converse(child, dialogue, stats=None, command=None, watch=None):
+    """Drives a `dialogue` generator with the pexpect process `child`,
+    blocking on each prompt.
+
+    :param stats: optional :class:`instrument.SessionStats` that the wall
+        time of each step, and of the completed command, is recorded in.
+    :param command: name of the command for the statistics, e.g. 'FIND'.
+    :param watch: optional :class:`watchdog.Watch` that waits on the steps
+        marked with `watch`, raising :class:`watchdog.Stalled` if the process
+        stops making progress.
+    :return: the value of the dialogue's :class:`Return`, or `None`.
+    """
+    startTime = time.time()
+    value = None
+    try:
+        step = next(dialogue)
+        while True:
+            stepTime = time.time()
+            if step.send is not None:
+                child.sendline(step.send)
+            if step.watch and watch is not None:
+                index = watch.expect(child, step.expect)
+            else:
+                index = child.expect(step.expect, timeout=step.timeout)
+            if stats is not None:
+                stats.record_stage(step.get_stage(command),
+                        time.time() - stepTime)
+            step = dialogue.send(index)
+    except StopIteration:
+        pass
+    except Return as result:
+        value = result.value
+    if stats is not None:
+        stats.record_command(command, time.time() - startTime)
+    return value
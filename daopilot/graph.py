@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Incremental, concurrent execution of a dependency graph of pipeline steps.
+
+A :class:`TaskGraph` is a set of :class:`Task` objects, each declaring the
+files it reads (`inputs`) and writes (`outputs`). A task depends on the tasks
+that write its inputs. Running the graph executes only the tasks that are out
+of date (as with `make`): a task is re-run if one of its outputs is missing,
+or if the contents of its inputs or its parameters changed since it last ran
+successfully. A re-run that rewrites identical files does not invalidate the
+tasks downstream. The state of the last run is kept in a JSON file::
+
+    graph = TaskGraph("image_pipeline.json")
+    graph.add(Task('find', runFind, inputs=[imagePath], outputs=[cooPath]))
+    graph.add(Task('regions', writeRegions, inputs=[cooPath],
+        outputs=[regPath]))
+    graph.run(workers=2)
+
+Tasks whose dependencies are done run concurrently, on up to `workers`
+threads, except that tasks sharing a `resource` (e.g. one daophot session)
+run one at a time.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import traceback
+
+from stepcache import file_digest
+
+
+class TaskFailed(Exception):
+    """Raised by :meth:`TaskGraph.run` when a task raised an exception.
+
+    :param taskName: name of the task that failed.
+    :param error: the exception raised by the task.
+    :param traceback: the formatted traceback of the failure.
+    """
+    def __init__(self, taskName, error, traceback):
+        super(TaskFailed, self).__init__("task %s failed: %s"
+                % (taskName, repr(error)))
+        self.taskName = taskName
+        self.error = error
+        self.traceback = traceback
+
+
+class Task(object):
+    """A step of a :class:`TaskGraph`.
+
+    :param name: unique name of the task in its graph.
+    :param func: callable, taking no arguments, that makes the outputs. Its
+        return value is kept in the graph's state (and so must be
+        JSON-serializable) and is available from
+        :meth:`TaskGraph.get_result` even on runs where the task is skipped.
+    :param inputs: paths of the files that the task reads.
+    :param outputs: paths of the files that the task writes.
+    :param after: names of tasks that must be done first, even though none
+        of their outputs is an input of this task.
+    :param params: JSON-serializable parameters of the task; the task is
+        re-run when they change.
+    :param resource: name of a resource used by the task; tasks sharing a
+        resource never run at the same time.
+    :param restore: optional callable, taking no arguments, that is called
+        instead of `func` when the task is up to date, to re-establish any
+        in-memory state that later tasks expect.
+    """
+    def __init__(self, name, func, inputs=(), outputs=(), after=(),
+            params=None, resource=None, restore=None):
+        super(Task, self).__init__()
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.params = params
+        self.resource = resource
+        self.restore = restore
+
+    def __repr__(self):
+        return "Task(%r)" % self.name
+
+
+class TaskGraph(object):
+    """A dependency graph of :class:`Task` objects.
+
+    :param statePath: path of the JSON file that the stamps and results of
+        completed tasks are kept in. Without it, every task runs every time.
+    :type statePath: str (optional)
+    """
+    def __init__(self, statePath=None):
+        super(TaskGraph, self).__init__()
+        self.statePath = statePath
+        self.tasks = {}
+        self._order = []  # task names in the order they were added
+        self._state = self._read_state()
+        self._lock = threading.Lock()
+        # digests keyed by (path, size, mtime)
+        self._digests = {}
+        # names of the tasks run and skipped by the last run(), in order
+        self.ran = []
+        self.skipped = []
+
+    def add(self, task):
+        """Adds a :class:`Task` to the graph and returns it."""
+        if task.name in self.tasks:
+            raise ValueError("Duplicate task name %s" % task.name)
+        self.tasks[task.name] = task
+        self._order.append(task.name)
+        return task
+
+    def get_result(self, name):
+        """Returns the value returned by the task `name` when it last ran,
+        or `None`.
+        """
+        entry = self._state.get(name)
+        if entry is None:
+            return None
+        return entry.get('result')
+
+    def get_dependencies(self, name):
+        """Returns the names of the tasks that task `name` depends on."""
+        task = self.tasks[name]
+        inputs = set(os.path.abspath(path) for path in task.inputs)
+        deps = [other for other in self._order if other != name
+                and any(os.path.abspath(path) in inputs
+                for path in self.tasks[other].outputs)]
+        for other in task.after:
+            if other not in self.tasks:
+                raise ValueError("Task %s runs after unknown task %s"
+                        % (name, other))
+            if other not in deps:
+                deps.append(other)
+        return deps
+
+    def get_order(self, targets=None):
+        """Returns the names of `targets` (by default, every task) and of all
+        the tasks they depend on, in an order where each task follows its
+        dependencies.
+
+        :raises ValueError: if the graph has a cycle.
+        """
+        if targets is None:
+            targets = self._order
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError("Task graph has a cycle through %s" % name)
+            visiting.add(name)
+            for dep in self.get_dependencies(name):
+                visit(dep)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in targets:
+            visit(name)
+        return order
+
+    def is_stale(self, name):
+        """Returns `True` if task `name` needs to run: it has not run, an
+        output is missing, or its inputs or parameters have changed since it
+        last ran.
+        """
+        task = self.tasks[name]
+        entry = self._state.get(name)
+        if entry is None:
+            return True
+        if not all(os.path.exists(path) for path in task.outputs):
+            return True
+        return entry.get('stamp') != self._make_stamp(task)
+
+    def _make_stamp(self, task):
+        """Hashes the parameters and input file contents of `task`."""
+        digests = [self._digest(path) for path in task.inputs]
+        text = json.dumps({'params': task.params, 'inputs': digests},
+                sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _digest(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        memo = (os.path.abspath(path), st.st_size, st.st_mtime)
+        with self._lock:
+            if memo in self._digests:
+                return self._digests[memo]
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[memo] = digest
+        return digest
+
+    def run(self, targets=None, workers=1):
+        """Runs the out-of-date tasks among `targets` (by default, all
+        tasks) and their dependencies.
+
+        :param workers: number of tasks that may run at once.
+        :return: the names of the tasks that ran.
+        :raises TaskFailed: if a task raised an exception. Tasks already
+            running are allowed to finish first; no new task is started.
+        """
+        order = self.get_order(targets)
+        deps = dict((name, self.get_dependencies(name)) for name in order)
+        pending = list(order)
+        done = set()
+        running = set()
+        busy = set()  # resources in use
+        failures = []
+        cond = threading.Condition()
+        self.ran = []
+        self.skipped = []
+
+        def execute(name):
+            task = self.tasks[name]
+            try:
+                if self.is_stale(name):
+                    stamp = self._make_stamp(task)
+                    result = task.func()
+                    self._record(name, stamp, result)
+                    with cond:
+                        self.ran.append(name)
+                else:
+                    if task.restore is not None:
+                        task.restore()
+                    with cond:
+                        self.skipped.append(name)
+            except Exception as e:
+                with cond:
+                    failures.append((name, e, traceback.format_exc()))
+            with cond:
+                running.discard(name)
+                busy.discard(task.resource)
+                done.add(name)
+                cond.notify_all()
+
+        with cond:
+            while len(pending) > 0 and len(failures) == 0:
+                ready = [name for name in pending
+                        if all(dep in done for dep in deps[name])
+                        and (self.tasks[name].resource is None
+                        or self.tasks[name].resource not in busy)]
+                if len(ready) == 0 or len(running) >= workers:
+                    cond.wait(1.)
+                    continue
+                name = ready[0]
+                pending.remove(name)
+                running.add(name)
+                if self.tasks[name].resource is not None:
+                    busy.add(self.tasks[name].resource)
+                thread = threading.Thread(target=execute, args=(name,))
+                thread.daemon = True
+                thread.start()
+            while len(running) > 0:
+                cond.wait(1.)
+        if len(failures) > 0:
+            name, error, text = failures[0]
+            raise TaskFailed(name, error, text)
+        return list(self.ran)
+
+    def _record(self, name, stamp, result):
+        """Saves the stamp and result of a completed task."""
+        with self._lock:
+            self._state[name] = {'stamp': stamp, 'result': result}
+            self._write_state()
+
+    def invalidate(self, name=None):
+        """Forgets that task `name` (by default, every task) has run, so
+        that it runs again.
+        """
+        with self._lock:
+            if name is None:
+                self._state = {}
+            else:
+                self._state.pop(name, None)
+            self._write_state()
+
+    def _read_state(self):
+        if self.statePath is None or not os.path.exists(self.statePath):
+            return {}
+        f = open(self.statePath)
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}  # unreadable; run everything again
+        finally:
+            f.close()
+
+    def _write_state(self):
+        if self.statePath is None:
+            return
+        tempPath = self.statePath + ".tmp"
+        f = open(tempPath, 'w')
+        json.dump(self._state, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(tempPath, self.statePath)
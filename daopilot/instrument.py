@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Latency instrumentation and bounded transcripts for daophot/allstar sessions.
+
+Every :class:`daophot.Daophot` and :class:`allstar.Allstar` session records
+the wall time of each command (``FIND``, ``PSF``, ...) and of each prompt
+stage within a command (e.g. ``FIND:Are you happy with this?``) into a
+:class:`SessionStats`, and keeps the tail of its transcript in a
+:class:`TranscriptBuffer` instead of streaming it to stdout. Sessions report
+to an :class:`Instrumentation` registry (by default the module-wide one from
+:func:`get_instrumentation`), which also keeps aggregate histograms over all
+sessions::
+
+    from instrument import get_instrumentation
+    print(get_instrumentation().to_json(indent=2))
+"""
+
+import json
+import math
+import threading
+from collections import deque
+
+
+class TranscriptBuffer(object):
+    """File-like ring buffer that keeps the last `maxBytes` of text written
+    to it. Suitable as a pexpect ``logfile``.
+    """
+    def __init__(self, maxBytes=64 * 1024):
+        super(TranscriptBuffer, self).__init__()
+        self.maxBytes = maxBytes
+        self._chunks = deque()
+        self._size = 0
+        # total number of characters ever written, a measure of progress
+        self.nWritten = 0
+
+    def write(self, data):
+        if isinstance(data, bytes) and not isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        if len(data) == 0:
+            return
+        self.nWritten += len(data)
+        if len(data) >= self.maxBytes:
+            self._chunks.clear()
+            data = data[-self.maxBytes:]
+            self._size = 0
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size > self.maxBytes:
+            excess = self._size - self.maxBytes
+            oldest = self._chunks[0]
+            if len(oldest) <= excess:
+                self._chunks.popleft()
+                self._size -= len(oldest)
+            else:
+                self._chunks[0] = oldest[excess:]
+                self._size -= excess
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        """Returns the buffered tail of the transcript."""
+        return "".join(self._chunks)
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies (seconds) in logarithmic bins, `binsPerDecade`
+    per factor of ten between `minLatency` and `maxLatency`. Latencies outside
+    that range are counted in the first or last bin.
+    """
+    def __init__(self, minLatency=1e-4, maxLatency=1e5, binsPerDecade=4):
+        super(LatencyHistogram, self).__init__()
+        self.minLatency = minLatency
+        self.maxLatency = maxLatency
+        self.binsPerDecade = binsPerDecade
+        nBins = int(round(math.log10(maxLatency / minLatency)
+                * binsPerDecade))
+        self.counts = [0] * nBins
+        self.n = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def _bin_index(self, seconds):
+        if seconds <= self.minLatency:
+            return 0
+        i = int(math.log10(seconds / self.minLatency) * self.binsPerDecade)
+        return min(i, len(self.counts) - 1)
+
+    def get_bin_edges(self):
+        """Returns the `len(counts) + 1` bin edges, in seconds."""
+        return [self.minLatency * 10. ** (float(i) / self.binsPerDecade)
+                for i in range(len(self.counts) + 1)]
+
+    def add(self, seconds):
+        """Records one latency measurement."""
+        self.counts[self._bin_index(seconds)] += 1
+        self.n += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """Adds the counts of another histogram with the same binning."""
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.n += other.n
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def mean(self):
+        if self.n == 0:
+            return None
+        return self.total / self.n
+
+    def percentile(self, q):
+        """Estimates the `q`-th percentile (0-100) as the upper edge of the
+        bin containing it, clipped to the largest latency seen.
+        """
+        if self.n == 0:
+            return None
+        edges = self.get_bin_edges()
+        target = q / 100. * self.n
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count > 0:
+                return min(edges[i + 1], self.max)
+        return self.max
+
+    def to_dict(self):
+        """Summary of the histogram; only non-empty bins are listed, as
+        `[lower edge, upper edge, count]`.
+        """
+        edges = self.get_bin_edges()
+        bins = [[edges[i], edges[i + 1], count]
+                for i, count in enumerate(self.counts) if count > 0]
+        return {'n': self.n, 'total': self.total, 'mean': self.mean(),
+                'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'bins': bins}
+
+
+class LatencyTable(object):
+    """A set of :class:`LatencyHistogram`, keyed by name."""
+    def __init__(self):
+        super(LatencyTable, self).__init__()
+        self.histograms = {}
+
+    def add(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = LatencyHistogram()
+        self.histograms[name].add(seconds)
+
+    def get(self, name):
+        """Returns the histogram for `name`, or `None`."""
+        return self.histograms.get(name)
+
+    def to_dict(self):
+        return dict((name, hist.to_dict())
+                for name, hist in self.histograms.items())
+
+
+class SessionStats(object):
+    """Latencies and transcript tail of one daophot or allstar session.
+
+    :param name: unique name of the session in its registry.
+    :param label: free-form description, e.g. the input image path.
+    """
+    def __init__(self, name, label=None, transcriptBytes=64 * 1024,
+            registry=None):
+        super(SessionStats, self).__init__()
+        self.name = name
+        self.label = label
+        self.transcript = TranscriptBuffer(transcriptBytes)
+        self.commands = LatencyTable()
+        self.stages = LatencyTable()
+        self._registry = registry
+
+    def record_command(self, command, seconds):
+        """Records the wall time of a whole command."""
+        self.commands.add(command, seconds)
+        if self._registry is not None:
+            self._registry._record('commands', command, seconds)
+
+    def record_stage(self, stage, seconds):
+        """Records the wall time spent waiting on one prompt."""
+        self.stages.add(stage, seconds)
+        if self._registry is not None:
+            self._registry._record('stages', stage, seconds)
+
+    def get_transcript(self):
+        """Returns the buffered tail of the session's transcript."""
+        return self.transcript.getvalue()
+
+    def to_dict(self, transcript=False):
+        d = {'name': self.name, 'label': self.label,
+                'commands': self.commands.to_dict(),
+                'stages': self.stages.to_dict()}
+        if transcript:
+            d['transcript'] = self.get_transcript()
+        return d
+
+
+class Instrumentation(object):
+    """Registry of :class:`SessionStats`, with aggregate latency histograms
+    over every session ever registered. Only the most recent `maxSessions`
+    sessions are kept individually, so memory use stays bounded on long
+    surveys.
+
+    :param transcriptBytes: size of each session's transcript ring buffer.
+    :param maxSessions: number of recent sessions to keep.
+    """
+    def __init__(self, transcriptBytes=64 * 1024, maxSessions=100):
+        super(Instrumentation, self).__init__()
+        self.transcriptBytes = transcriptBytes
+        self.maxSessions = maxSessions
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets all sessions and aggregate statistics."""
+        with self._lock:
+            self._sessions = deque(maxlen=self.maxSessions)
+            self._nSessions = 0
+            self._aggregate = {'commands': LatencyTable(),
+                    'stages': LatencyTable()}
+
+    def new_session(self, kind, label=None):
+        """Registers and returns a new :class:`SessionStats`.
+
+        :param kind: type of session, e.g. 'daophot'; used in its name.
+        :param label: free-form description, e.g. the input image path.
+        """
+        with self._lock:
+            self._nSessions += 1
+            stats = SessionStats("%s-%i" % (kind, self._nSessions),
+                    label=label, transcriptBytes=self.transcriptBytes,
+                    registry=self)
+            self._sessions.append(stats)
+        return stats
+
+    def _record(self, table, name, seconds):
+        with self._lock:
+            self._aggregate[table].add(name, seconds)
+
+    def get_sessions(self):
+        """Returns the list of recent sessions, oldest first."""
+        with self._lock:
+            return list(self._sessions)
+
+    def get_command_histogram(self, command):
+        """Aggregate latency histogram of `command` over all sessions."""
+        return self._aggregate['commands'].get(command)
+
+    def get_stage_histogram(self, stage):
+        """Aggregate latency histogram of a prompt `stage` over all
+        sessions.
+        """
+        return self._aggregate['stages'].get(stage)
+
+    def to_dict(self, sessions=True, transcripts=False):
+        with self._lock:
+            d = {'nSessions': self._nSessions,
+                    'commands': self._aggregate['commands'].to_dict(),
+                    'stages': self._aggregate['stages'].to_dict()}
+            recent = list(self._sessions)
+        if sessions:
+            d['sessions'] = [s.to_dict(transcript=transcripts)
+                    for s in recent]
+        return d
+
+    def to_json(self, sessions=True, transcripts=False, indent=None):
+        """Returns the aggregate (and optionally per-session) statistics as
+        a JSON string.
+        """
+        return json.dumps(self.to_dict(sessions=sessions,
+                transcripts=transcripts), indent=indent, sort_keys=True)
+
+    def dump(self, path, sessions=True, transcripts=False):
+        """Writes :meth:`to_json` output to `path`."""
+        f = open(path, 'w')
+        f.write(self.to_json(sessions=sessions, transcripts=transcripts,
+                indent=2))
+        f.close()
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation():
+    """Returns the module-wide :class:`Instrumentation` that sessions report
+    to by default.
+    """
+    return _instrumentation
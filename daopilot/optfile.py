@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Reading, writing and comparing daophot/allstar option sets.
+
+Both daophot and allstar read their options (``daophot.opt`` and
+``allstar.opt``) from the working directory when they start up. Options are
+named by two-letter abbreviations (e.g. ``VA``, ``WA``, ``FI``), and only the
+first two characters of a name are significant to the programs.
+"""
+
+import os
+
+
+def normalize_name(name):
+    """Returns the canonical (upper case, two letter) form of an option
+    name.
+    """
+    return str(name).strip().upper()[:2]
+
+
+def normalize_value(value):
+    """Returns an option value as a float if it is numeric, so that e.g.
+    ``'-1'``, ``-1`` and ``-1.0`` compare as equal. Other values are returned
+    as stripped strings.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value).strip()
+
+
+def format_value(value):
+    """Formats an option value the way it is sent to daophot/allstar."""
+    value = normalize_value(value)
+    if isinstance(value, float):
+        if value == int(value):
+            return "%i" % value
+        return "%g" % value
+    return value
+
+
+def normalize_options(options):
+    """Returns a new dictionary of the `options` mapping with canonical names
+    and values.
+    """
+    if options is None:
+        return {}
+    normalized = {}
+    for name, value in options.items():
+        normalized[normalize_name(name)] = normalize_value(value)
+    return normalized
+
+
+def changed_options(current, requested):
+    """Returns a list of `(name, value)` pairs from `requested` whose values
+    differ from the `current` option state, sorted by option name.
+    Both mappings may use any name/value form.
+    """
+    current = normalize_options(current)
+    requested = normalize_options(requested)
+    changes = []
+    for name in sorted(requested.keys()):
+        value = requested[name]
+        if name not in current or current[name] != value:
+            changes.append((name, value))
+    return changes
+
+
+def read_options(path):
+    """Reads an option file (such as ``daophot.opt``) into a dictionary of
+    normalized option names and values. Returns an empty dictionary if the
+    file does not exist.
+    """
+    options = {}
+    if not os.path.exists(path):
+        return options
+    f = open(path)
+    for line in f:
+        if "=" not in line:
+            continue
+        name, value = line.split("=", 1)
+        if len(name.strip()) == 0:
+            continue
+        options[normalize_name(name)] = normalize_value(value)
+    f.close()
+    return options
+
+
+def write_options(path, options):
+    """Writes the `options` mapping to an option file at `path`, replacing
+    any existing file.
+    """
+    options = normalize_options(options)
+    if os.path.exists(path):
+        os.remove(path)
+    f = open(path, 'w')
+    for name in sorted(options.keys()):
+        f.write("%s = %s\n" % (name, format_value(options[name])))
+    f.close()
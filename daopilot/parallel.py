@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Running daophot/allstar recipes on many images with a process pool.
+
+Each image is processed in its own working directory, where the image (and
+any option files) are symlinked, so that the output files of different images
+can never collide. Results are streamed back as images finish.
+
+:func:`run_many` runs a recipe on each image in a pool of processes;
+:class:`AllstarBatch` runs a queue of allstar jobs on a pool of threads
+(allstar does the work in its own process, so threads only wait on it).
+"""
+
+import os
+import time
+import threading
+import traceback
+import multiprocessing
+from collections import namedtuple
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from daophot import Daophot
+from allstar import Allstar
+from workspace import Workspace
+
+
+class ImageResult(namedtuple('ImageResult', ['imagePath', 'workDir',
+        'result', 'error', 'traceback', 'elapsed'])):
+    """Outcome of running a recipe on one image.
+
+    :param imagePath: the original path of the image.
+    :param workDir: the working directory the recipe ran in.
+    :param result: the recipe's return value, or `None` on failure.
+    :param error: a short description of the exception raised by the recipe,
+        or `None` on success.
+    :param traceback: the formatted traceback of the failure, or `None`.
+    :param elapsed: wall time (seconds) spent on the image.
+    """
+    __slots__ = ()
+
+    def succeeded(self):
+        """Returns `True` if the recipe finished without an exception."""
+        return self.error is None
+
+
+class PSFRecipe(object):
+    """Standard per-image recipe: runs daophot FIND, PHOTOMETRY, PICK and PSF,
+    and optionally ALLSTAR.
+
+    Calling the recipe with an image path returns a dictionary of the paths
+    of the `coo`, `ap`, `lst`, `psf` and `nei` files (and of the `als`
+    catalog and star-subtracted image `sub` made by ALLSTAR). Recipes are
+    pickled to the worker processes, so custom recipes must be module-level
+    functions or instances of module-level classes.
+
+    :param apRadPath: aperture radii file for PHOTOMETRY (default
+        ``photo.opt``). It is linked into each image's working directory.
+    :param nStars: number of PSF stars to PICK.
+    :param magLimit: faintest instrumental magnitude of PSF stars.
+    :param options: daophot options for the session.
+    :param runAllstar: also fit every star in the .ap file with the PSF.
+    :param allstarOptions: allstar options for the ALLSTAR run.
+    :param allstarCmd: name of the `allstar` executable.
+    """
+    def __init__(self, apRadPath=None, nStars=100, magLimit=99, options=None,
+            shell="/bin/zsh", cmd="daophot", runAllstar=False,
+            allstarOptions=None, allstarCmd="allstar"):
+        super(PSFRecipe, self).__init__()
+        self.apRadPath = apRadPath
+        self.nStars = nStars
+        self.magLimit = magLimit
+        self.options = options
+        self.shell = shell
+        self.cmd = cmd
+        self.runAllstar = runAllstar
+        self.allstarOptions = allstarOptions
+        self.allstarCmd = allstarCmd
+
+    def get_aux_paths(self):
+        """Files that need to be present in the working directory."""
+        if self.apRadPath is None:
+            return []
+        return [self.apRadPath]
+
+    def __call__(self, imagePath):
+        daophot = Daophot(imagePath, shell=self.shell, cmd=self.cmd,
+                options=self.options)
+        try:
+            daophot.find()
+            daophot.apphot('last', apRadPath=self.apRadPath)
+            daophot.pick_psf_stars(self.nStars, 'last',
+                    magLimit=self.magLimit)
+            fitText, psfPath, neiPath = daophot.make_psf('last', 'last')
+            if psfPath is None:
+                raise RuntimeError("PSF of %s did not converge" % imagePath)
+            result = {'coo': daophot.get_path('last', 'coo'),
+                    'ap': daophot.get_path('last', 'ap'),
+                    'lst': daophot.get_path('last', 'lst'),
+                    'psf': psfPath, 'nei': neiPath}
+        finally:
+            daophot.shutdown()
+        if self.runAllstar:
+            root = os.path.splitext(imagePath)[0]
+            result['als'] = root + ".als"
+            result['sub'] = root + "s.fits"
+            allstar = Allstar(imagePath, psfPath, result['ap'],
+                    result['als'], result['sub'], shell=self.shell,
+                    cmd=self.allstarCmd, options=self.allstarOptions)
+            allstar.run()
+        return result
+
+
+def run_many(images, recipe, workers=None, workRoot=None, auxPaths=None,
+        scratchRoot=None):
+    """Runs `recipe` on every image in `images` using a pool of worker
+    processes. This is a generator that yields an :class:`ImageResult` for
+    each image as soon as it finishes (so not in input order); failures are
+    yielded as results too, rather than raised.
+
+    :param images: sequence of FITS image paths.
+    :param recipe: picklable callable taking the path of the image (staged
+        in its working directory) and returning the image's result, e.g.
+        a :class:`PSFRecipe`.
+    :param workers: number of worker processes (default: number of CPUs).
+    :param workRoot: directory under which each image's working directory is
+        made. By default the working directory is made next to the image.
+    :param auxPaths: extra files (e.g. option files) to link into every
+        working directory. Any ``*.opt`` files next to the image, and the
+        recipe's ``get_aux_paths()``, are linked automatically.
+    :param scratchRoot: directory on fast local storage (see
+        :class:`workspace.Workspace`). If given, each image is run in a
+        temporary workspace there, and the files named in the recipe's
+        result are moved to the working directory when the recipe is done;
+        the result refers to the moved files.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    auxPaths = list(auxPaths or [])
+    if hasattr(recipe, 'get_aux_paths'):
+        auxPaths.extend(recipe.get_aux_paths())
+    tasks = []
+    for i, imagePath in enumerate(images):
+        workDir = _make_work_dir_path(imagePath, i, workRoot)
+        tasks.append((imagePath, workDir, recipe, auxPaths, scratchRoot))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(_run_image, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _make_work_dir_path(imagePath, index, workRoot):
+    """Path of the working directory for the `index`-th image."""
+    imageRoot = os.path.splitext(os.path.basename(imagePath))[0]
+    if workRoot is None:
+        return os.path.join(os.path.dirname(os.path.abspath(imagePath)),
+                imageRoot + "_work")
+    return os.path.join(workRoot, "%05i_%s" % (index, imageRoot))
+
+
+def _stage(imagePath, workDir, auxPaths):
+    """Makes `workDir` and symlinks the image and auxiliary files into it.
+    Returns the path of the staged image.
+    """
+    workspace = Workspace(path=workDir, maxRootLength=None)
+    return workspace.stage_image(imagePath, auxPaths)
+
+
+def _run_image(task):
+    """Worker function: stages one image and runs the recipe on it."""
+    imagePath, workDir, recipe, auxPaths, scratchRoot = task
+    startTime = time.time()
+    try:
+        if scratchRoot is None:
+            result = recipe(_stage(imagePath, workDir, auxPaths))
+        else:
+            with Workspace(scratchRoot) as workspace:
+                result = recipe(workspace.stage_image(imagePath, auxPaths))
+                result = workspace.collect_result(result, workDir)
+    except Exception as e:
+        return ImageResult(imagePath, workDir, None,
+                "%s: %s" % (e.__class__.__name__, e), traceback.format_exc(),
+                time.time() - startTime)
+    return ImageResult(imagePath, workDir, result, None, None,
+            time.time() - startTime)
+
+
+class AllstarJob(namedtuple('AllstarJob', ['imagePath', 'psfPath',
+        'apPhotPath', 'alsOutputPath', 'outputImagePath', 'options'])):
+    """An allstar run for :class:`AllstarBatch`.
+
+    :param imagePath: path of the FITS image.
+    :param psfPath: path of the PSF model.
+    :param apPhotPath: path of the photometry (.ap) file of the stars to fit.
+    :param alsOutputPath: path that the .als catalog is written to.
+    :param outputImagePath: path that the star-subtracted image is written
+        to.
+    :param options: allstar options of the job, over those of the batch
+        (optional).
+    """
+    __slots__ = ()
+
+    def __new__(cls, imagePath, psfPath, apPhotPath, alsOutputPath,
+            outputImagePath, options=None):
+        return super(AllstarJob, cls).__new__(cls, imagePath, psfPath,
+                apPhotPath, alsOutputPath, outputImagePath, options)
+
+
+class AllstarBatch(object):
+    """Runs many allstar jobs, several at a time.
+
+    Each job runs in its own working directory, where the image, PSF and
+    photometry files (and the ``*.opt`` files next to the image) are
+    symlinked; the .als catalog and the star-subtracted image are then moved
+    to the job's output paths. Working directories are temporary
+    :class:`workspace.Workspace` directories in `scratchRoot`, unless
+    `workRoot` is given, in which case they are kept there.
+
+    :param workers: number of allstar processes run at once (default:
+        number of CPUs).
+    :param workRoot: directory under which each job's working directory is
+        made and kept (optional).
+    :param scratchRoot: directory in which temporary working directories are
+        made when there is no `workRoot` (default: see
+        :class:`workspace.Workspace`).
+    :param shell: name of the shell that `allstar` will run in.
+    :param cmd: name of the `allstar` executable.
+    :param options: allstar options of every job.
+    :param supervisor: :class:`watchdog.Supervisor` that kills and retries
+        stalled runs (optional).
+    :param instrumentation: registry that the latencies and transcript of
+        each run are recorded in (optional).
+    """
+    def __init__(self, workers=None, workRoot=None, scratchRoot=None,
+            shell="/bin/zsh", cmd="allstar", options=None, supervisor=None,
+            instrumentation=None):
+        super(AllstarBatch, self).__init__()
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.workRoot = workRoot
+        self.scratchRoot = scratchRoot
+        self.shell = shell
+        self.cmd = cmd
+        self.options = options
+        self.supervisor = supervisor
+        self.instrumentation = instrumentation
+
+    def run(self, jobs, timeout=30. * 60, progress=None):
+        """Runs `jobs`. This is a generator that yields a
+        :class:`ImageResult` for each job as soon as it finishes (so not in
+        input order). The `result` of a successful job is a dictionary of
+        the paths of its `als` catalog and star-subtracted image `sub`;
+        failures are yielded as results too, rather than raised.
+
+        :param jobs: sequence of :class:`AllstarJob` (or tuples of their
+            fields).
+        :param timeout: time (seconds) allowed for each allstar run.
+        :param progress: optional callable that is passed the job and an
+            :class:`allstar.AllstarProgress` after each iteration of each
+            run. It is called from the worker threads, and may raise an
+            exception to abandon a job.
+
+        If the caller stops iterating before every result is yielded (by
+        breaking out of the loop, an exception or closing the generator),
+        no further jobs are started. Jobs that are already running finish
+        first, in the background, and their results are dropped.
+        """
+        jobs = [job if isinstance(job, AllstarJob) else AllstarJob(*job)
+                for job in jobs]
+        pending = queue.Queue()
+        for i, job in enumerate(jobs):
+            pending.put((i, job))
+        done = queue.Queue()
+        # set when the caller stops iterating, to start no more jobs
+        stopped = threading.Event()
+
+        def work():
+            while not stopped.is_set():
+                try:
+                    i, job = pending.get_nowait()
+                except queue.Empty:
+                    return
+                done.put(self._run_job(i, job, timeout, progress))
+
+        for i in range(min(self.workers, len(jobs))):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+        try:
+            for i in range(len(jobs)):
+                yield done.get()
+        finally:
+            stopped.set()
+
+    def _make_workspace(self, index, job):
+        if self.workRoot is None:
+            return Workspace(self.scratchRoot)
+        return Workspace(path=_make_work_dir_path(job.imagePath, index,
+                self.workRoot))
+
+    def _run_job(self, index, job, timeout, progress):
+        """Runs one job in its own workspace."""
+        startTime = time.time()
+        workspace = self._make_workspace(index, job)
+        try:
+            for path in (job.imagePath, job.psfPath, job.apPhotPath):
+                if not os.path.exists(path):
+                    raise IOError("No such file: %s" % path)
+            imagePath = workspace.stage_image(job.imagePath)
+            root = os.path.splitext(imagePath)[0]
+            options = dict(self.options or {})
+            options.update(job.options or {})
+            allstar = Allstar(imagePath, workspace.stage(job.psfPath),
+                    workspace.stage(job.apPhotPath), root + ".als",
+                    root + "s.fits", shell=self.shell, cmd=self.cmd,
+                    options=options, instrumentation=self.instrumentation,
+                    supervisor=self.supervisor)
+            callback = None
+            if progress is not None:
+                callback = lambda event: progress(job, event)
+            allstar.run(timeout=timeout, progress=callback)
+            for path, dest in ((root + ".als", job.alsOutputPath),
+                    (root + "s.fits", job.outputImagePath)):
+                workspace.collect({path: dest},
+                        os.path.dirname(os.path.abspath(dest)))
+            result = {'als': job.alsOutputPath, 'sub': job.outputImagePath}
+        except Exception as e:
+            return ImageResult(job.imagePath, workspace.path, None,
+                    "%s: %s" % (e.__class__.__name__, e),
+                    traceback.format_exc(), time.time() - startTime)
+        finally:
+            workspace.close()
+        return ImageResult(job.imagePath, workspace.path, result, None,
+                None, time.time() - startTime)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Pool of warm daophot sessions that are reused across images.
+
+Starting daophot means spawning a shell, waiting for the banner, setting
+options and attaching an image. For a survey of many frames that startup
+chatter is a real fraction of the wall time, so :class:`DaophotPool` keeps
+sessions alive and simply re-ATTACHes the next image.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+from daophot import Daophot
+
+
+class DaophotPool(object):
+    """Keeps up to `size` daophot sessions alive and hands them out for
+    successive images.
+
+    Daophot cannot change its working directory once started, so an idle
+    session is only reused (a *hit*) for an image in the same directory as
+    the session's previous image. Otherwise a new session is started (a
+    *miss*), evicting the least-recently used idle session if the pool is
+    full. A session is *recycled* (shut down) once it has processed
+    `maxImages` images, or if an exception was raised while it was in use.
+
+    Usage::
+
+        pool = DaophotPool(size=4)
+        for imagePath in imagePaths:
+            with pool.session(imagePath) as daophot:
+                daophot.find()
+        pool.close()
+
+    The pool is thread-safe; when all sessions are busy, :meth:`acquire`
+    blocks until one is released.
+
+    :param size: maximum number of live daophot sessions.
+    :type size: int
+    :param maxImages: number of images a session may process before it is
+        shut down and replaced by a fresh session.
+    :type maxImages: int
+    :param shell: name of the shell that `daophot` will run in
+    :type shell: str (optional)
+    :param cmd: name of the `daophot` executable
+    :type cmd: str (optional)
+    :param options: daophot options that every session is started with.
+        They are re-asserted when a session is reused, so options changed by
+        a previous user do not leak into the next image; since sessions track
+        their option state, only values that were changed are re-sent.
+    :type options: dict (optional)
+    :param stepCache: step cache that every session stores and restores
+        command outputs with.
+    :type stepCache: :class:`stepcache.StepCache` (optional)
+    :param supervisor: supervisor that watches every session, and restarts
+        those whose daophot process stalls.
+    :type supervisor: :class:`watchdog.Supervisor` (optional)
+    """
+    def __init__(self, size=4, maxImages=100, shell="/bin/zsh",
+            cmd="daophot", options=None, stepCache=None, supervisor=None):
+        super(DaophotPool, self).__init__()
+        if size < 1:
+            raise ValueError("DaophotPool size must be at least 1")
+        self.size = size
+        self.maxImages = maxImages
+        self.shell = shell
+        self.cmd = cmd
+        self.options = options
+        self.stepCache = stepCache
+        self.supervisor = supervisor
+        # idle sessions, least-recently used first
+        self._idle = []
+        # number of images processed by each live session, keyed by id()
+        self._nImages = {}
+        self._nLive = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.recycles = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    @contextmanager
+    def session(self, inputImagePath):
+        """Context manager that yields a :class:`daophot.Daophot` session
+        with `inputImagePath` attached. The session is returned to the pool
+        on exit, or recycled if the block raised an exception.
+        """
+        daophot = self.acquire(inputImagePath)
+        failed = True
+        try:
+            yield daophot
+            failed = False
+        finally:
+            self.release(daophot, failed=failed)
+
+    def acquire(self, inputImagePath):
+        """Returns a daophot session with `inputImagePath` attached. Sessions
+        obtained this way must be handed back with :meth:`release`.
+        """
+        workDir = os.path.dirname(inputImagePath)
+        evicted = None
+        daophot = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("DaophotPool is closed")
+                daophot = self._pop_idle(workDir)
+                if daophot is not None:
+                    # counted as a hit once it is re-attached
+                    break
+                if self._nLive < self.size:
+                    self._nLive += 1
+                    self.misses += 1
+                    break
+                if len(self._idle) > 0:
+                    # reuse the slot of the least-recently used session
+                    evicted = self._idle.pop(0)
+                    self.misses += 1
+                    break
+                self._cond.wait()
+
+        if evicted is not None:
+            self._shutdown(evicted)
+        if daophot is not None:
+            try:
+                if self.options is not None:
+                    daophot.set_options(self.options)
+                daophot.retarget(inputImagePath)
+            except Exception:
+                # a session that fails to re-attach is replaced by a new one
+                self._shutdown(daophot)
+                with self._cond:
+                    self.misses += 1
+            else:
+                with self._cond:
+                    self.hits += 1
+                return daophot
+        return self._spawn(inputImagePath)
+
+    def release(self, daophot, failed=False):
+        """Returns a session to the pool.
+
+        :param failed: set to `True` if the session raised an error; it will
+            be shut down rather than reused.
+        """
+        key = id(daophot)
+        with self._cond:
+            self._nImages[key] = self._nImages.get(key, 0) + 1
+            recycle = failed or self._closed \
+                    or self._nImages[key] >= self.maxImages \
+                    or not daophot.is_alive()
+            if not recycle:
+                self._idle.append(daophot)
+                self._cond.notify()
+                return
+        self._shutdown(daophot)
+        with self._cond:
+            self._nLive -= 1
+            self._cond.notify()
+
+    def close(self):
+        """Shuts down all idle sessions. Sessions that are still in use are
+        shut down when they are released.
+        """
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._nLive -= len(idle)
+            self._cond.notify_all()
+        for daophot in idle:
+            self._shutdown(daophot)
+
+    def stats(self):
+        """Returns a dictionary of pool usage counts: `hits` (sessions
+        reused), `misses` (sessions started), `recycles` (sessions shut down),
+        and the current number of `live` and `idle` sessions.
+        """
+        with self._cond:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'recycles': self.recycles, 'live': self._nLive,
+                    'idle': len(self._idle)}
+
+    def _pop_idle(self, workDir):
+        """Removes and returns the most-recently used idle session running in
+        `workDir`, or `None` if there is no such session.
+        """
+        for i in range(len(self._idle) - 1, -1, -1):
+            if self._idle[i].get_work_dir() == workDir:
+                return self._idle.pop(i)
+        return None
+
+    def _spawn(self, inputImagePath):
+        """Starts a new daophot session in an already-reserved pool slot."""
+        try:
+            return Daophot(inputImagePath, shell=self.shell, cmd=self.cmd,
+                    options=self.options, stepCache=self.stepCache,
+                    supervisor=self.supervisor)
+        except Exception:
+            with self._cond:
+                self._nLive -= 1
+                self._cond.notify()
+            raise
+
+    def _shutdown(self, daophot):
+        """Shuts down a session that has been taken out of the pool."""
+        with self._cond:
+            self._nImages.pop(id(daophot), None)
+            self.recycles += 1
+        try:
+            daophot.shutdown()
+        except Exception:
+            pass
@@ -1,6 +1,7 @@
 import os
 import re
 import glob
+import logging
 import numpy
 import pyfits
 from astLib import astWCS
@@ -11,23 +12,60 @@ import owl.Match
 
 from daophot import Daophot
 from allstar import Allstar
+from graph import TaskGraph, Task
+from catalogio import ApPhotCatalog
+
+
+log = logging.getLogger(__name__)
 
 
 class PSFFactory(object):
     """Factory class for creating PSFs from a single image.
+
+    :param workDir: directory where region files are written.
+    :param pool: optional :class:`pool.DaophotPool`; if given, daophot
+        sessions are borrowed from the pool instead of being started (and
+        shut down) for every image.
+    :param stepCache: optional :class:`stepcache.StepCache`; if given,
+        re-making a PSF restores the outputs of the daophot steps whose
+        inputs are unchanged instead of re-running them. Sessions borrowed
+        from a pool use the pool's cache instead.
+    :param supervisor: optional :class:`watchdog.Supervisor` that kills and
+        retries stalled daophot and allstar runs. Sessions borrowed from a
+        pool use the pool's supervisor instead.
     """
-    def __init__(self, workDir):
+    def __init__(self, workDir, pool=None, stepCache=None, supervisor=None):
         super(PSFFactory, self).__init__()
         self.workDir = workDir
+        self.pool = pool
+        self.stepCache = stepCache
+        self.supervisor = supervisor
     
     def make(self, imageName, imagePath, flagPath, band, maxVarPSF,
-            runAllstar=False, findHiddenStars=False, clean=False):
+            runAllstar=False, findHiddenStars=False, clean=False,
+            brightRadius=40., brightMagLimit=14., workers=4,
+            hiddenMatchRadius=2.):
         """Makes the PSF model.
         
+        The pipeline is run as a :class:`graph.TaskGraph` of steps (FIND,
+        PHOTOMETRY, PICK, the StarPicker filters, a PSF fit for each level
+        of PSF variability, allstar and hidden-star detection). The state of
+        the graph is kept in `workDir`, so making the PSF of the same image
+        again only re-runs the steps whose inputs or parameters changed
+        (e.g. the StarPicker filters when the flag map changes) and the steps
+        that depend on them. Steps that do not need the daophot session, such
+        as region files and allstar runs, run concurrently with it.
+        
         :param maxVarPSF: the maximum degrees of freedom in the PSF. Maximum
             is 2.
         :param runAllstar: set to True if you want an allstar star-subtracted
             image documenting each step of the psf subtraction process.
+        :param brightRadius: radius (pixels) around bright 2MASS stars in
+            which PSF candidates are rejected.
+        :param brightMagLimit: 2MASS magnitude of the stars considered bright.
+        :param workers: number of pipeline steps that may run at once.
+        :param hiddenMatchRadius: radius (pixels) within which a hidden-star
+            detection of a known star is dropped as a duplicate.
         """
         self.imageName = imageName
         self.imagePath = imagePath
@@ -35,93 +73,238 @@ class PSFFactory(object):
         self.band = band
         
         self.findHiddenStars = findHiddenStars
+        self.hiddenMatchRadius = hiddenMatchRadius
+        self._picker = None
+        
+        self.daophot = self._openDaophot(self.imagePath)
+        try:
+            graph, paths = self._buildGraph(maxVarPSF, runAllstar,
+                    brightRadius, brightMagLimit)
+            graph.run(workers=workers)
+        except Exception:
+            self._closeDaophot(self.daophot, failed=True)
+            raise
+        self._closeDaophot(self.daophot)
         
-        self.daophot = Daophot(self.imagePath)
+        if clean:
+            self._clean()
         
-        # Initial DAOPHOT run
-        # FIND
-        self.daophot.set_option('VA', '-1')  # full analytic psf
-        self.daophot.find(nAvg=1, nSum=1)
-        coordFilePath = self.daophot.get_path('last', 'coo')
-        findN, findX, findY = owl.dao.parseCoordFile(coordFilePath)
-        findPoints = owl.region.PointList()
-        findPoints.setFrame('image')
-        findPoints.setPoints(findX, findY, size=6, shapes="circle",
-                labels=None, colours="yellow")
-        findPoints.writeTo(os.path.join(self.workDir,
-                self.imageName + "_find.reg"))
+        return (paths['psf'], paths['pick'], paths['coo'], paths['ap'])
+    
+    def _buildGraph(self, maxVarPSF, runAllstar, brightRadius,
+            brightMagLimit):
+        """Builds the :class:`graph.TaskGraph` of the PSF pipeline.
         
-        # PICK PSF stars
+        :return: the graph, and a dictionary of the paths of the final
+            `psf`, star list (`pick`), coordinate (`coo`) and aperture
+            photometry (`ap`) files.
+        """
+        imageRoot = os.path.splitext(self.imagePath)[0]
+        cooPath = imageRoot + ".coo"
+        apPath = imageRoot + ".ap"
+        lstPath = imageRoot + ".lst"
+        apRadPath = os.path.join(os.path.dirname(self.imagePath),
+                "wirphoto.opt")
+        pickPath = os.path.join(self.workDir, self.imageName + "rev.lst")
+        graph = TaskGraph(os.path.join(self.workDir,
+            self.imageName + "_pipeline.json"))
+        self._graph = graph
+        
+        # Initial DAOPHOT run
+        graph.add(Task('find', self._find, inputs=[self.imagePath],
+            outputs=[cooPath], resource='daophot',
+            restore=lambda: self.daophot.register_path(cooPath, 'coo')))
+        graph.add(Task('find_regions',
+            lambda: self._writePoints(cooPath, "_find.reg", 6, "circle",
+                "yellow"),
+            inputs=[cooPath],
+            outputs=[os.path.join(self.workDir,
+                self.imageName + "_find.reg")]))
         # TODO need to generalize this apRadPath
-        self.daophot.apphot(coordinates='last', apRadPath='wirphoto.opt')
-        apFilePath = self.daophot.get_path('last', 'ap')
-        self.daophot.pickPSFStars(100, apPhot='last')
+        graph.add(Task('apphot',
+            lambda: self.daophot.apphot(coordinates=cooPath,
+                apRadPath=apRadPath),
+            inputs=[self.imagePath, cooPath, apRadPath], outputs=[apPath],
+            resource='daophot',
+            restore=lambda: self.daophot.register_path(apPath, 'ap')))
         
-        psfN, psfX, psfY = owl.dao.parseCoordFile(
-            self.daophot.get_path('last', 'lst'))
-        psfPoints = owl.region.PointList()
-        psfPoints.setFrame('image')
-        psfPoints.setPoints(psfX, psfY, size=15, shapes="diamond",
-                labels=None, colours="red")
-        psfPoints.writeTo(os.path.join(self.workDir,
-            self.imageName + "_psf.reg"))
+        # PICK PSF stars
+        graph.add(Task('pick',
+            lambda: self.daophot.pick_psf_stars(100, apPhot=apPath),
+            inputs=[self.imagePath, apPath], outputs=[lstPath],
+            params={'nStars': 100}, resource='daophot',
+            restore=lambda: self.daophot.register_path(lstPath, 'lst')))
+        graph.add(Task('psf_regions',
+            lambda: self._writePoints(lstPath, "_psf.reg", 15, "diamond",
+                "red"),
+            inputs=[lstPath],
+            outputs=[os.path.join(self.workDir,
+                self.imageName + "_psf.reg")]))
         
         # Make custom picks
-        picker = StarPicker(self.daophot, 'last', self.imagePath)
+        pickerInputs = [apPath, lstPath]
+        if self.flagPath is not None:
+            pickerInputs.append(self.flagPath)
+        graph.add(Task('picker',
+            lambda: self._pickStars(pickPath, brightRadius, brightMagLimit),
+            inputs=pickerInputs,
+            outputs=[pickPath, os.path.join(self.workDir,
+                self.imageName + "_psfrev.reg")],
+            params={'band': self.band, 'radius': brightRadius,
+                'magLimit': brightMagLimit},
+            resource='daophot'))
+        
+        # Make PSF, run allstar
+        initPsfPath = imageRoot + "_init.psf"
+        initNeiPath = imageRoot + "_init.nei"
+        graph.add(Task('psf_init',
+            lambda: self._makeInitialPSF(apPath, pickPath),
+            inputs=[self.imagePath, apPath, pickPath],
+            outputs=[initPsfPath, initNeiPath], resource='daophot'))
+        if runAllstar:
+            self._addAllstarTask(graph, "init", initPsfPath, apPath)
+        
+        # iterative DAOPHOT runs with increasing psf variability, then a
+        # final psf on the clean image, keeping the last-used varPSF
+        levels = [("var%i" % varPSF, varPSF)
+                for varPSF in range(0, maxVarPSF + 1)]
+        levels.append(('fin', None))
+        sourcePath, prevPsfPath, prevLstPath = self.imagePath, \
+                initPsfPath, pickPath
+        prevLevel = None
+        for name, varPSF in levels:
+            psfPath = "_".join((imageRoot, name)) + ".psf"
+            neiPath = "_".join((imageRoot, name)) + ".nei"
+            levelLstPath = "_".join((imageRoot, name)) + ".lst"
+            neiSubPath = self._makeAllstarPaths(name)[2]
+            graph.add(Task('psf_' + name,
+                self._makeLevelTask(name, varPSF, prevLevel, sourcePath,
+                    prevPsfPath, initNeiPath, prevLstPath, levelLstPath,
+                    apPath),
+                inputs=[sourcePath, prevPsfPath, initNeiPath, prevLstPath,
+                    apPath],
+                outputs=[psfPath, neiPath, neiSubPath, levelLstPath],
+                params={'VA': varPSF}, resource='daophot'))
+            if runAllstar or self.findHiddenStars:
+                alsPath, alsStarSubPath = self._addAllstarTask(graph, name,
+                        psfPath, apPath)
+            if self.findHiddenStars:
+                hiddenApPath = "_".join((imageRoot, name, "hidden.ap"))
+                graph.add(Task('hidden_' + name,
+                    self._makeHiddenTask(psfPath, apPath, alsPath,
+                        alsStarSubPath, hiddenApPath),
+                    inputs=[apPath, alsPath, alsStarSubPath],
+                    outputs=[hiddenApPath],
+                    params={'matchRadius': self.hiddenMatchRadius}))
+                # later PSF fits use the catalog with the hidden stars
+                apPath = hiddenApPath
+            sourcePath, prevPsfPath, prevLstPath = neiSubPath, psfPath, \
+                    levelLstPath
+            prevLevel = 'psf_' + name
+        
+        return graph, {'psf': prevPsfPath, 'pick': prevLstPath,
+                'coo': cooPath, 'ap': apPath}
+    
+    def _find(self):
+        # the full analytic psf, until the psf iterations
+        self.daophot.set_option('VA', '-1')
+        self.daophot.find(nAvg=1, nSum=1)
+    
+    def _writePoints(self, catalogPath, suffix, size, shape, colour):
+        """Writes a region file of the stars in a .coo or .lst catalog."""
+        n, x, y = owl.dao.parseCoordFile(catalogPath)
+        points = owl.region.PointList()
+        points.setFrame('image')
+        points.setPoints(x, y, size=size, shapes=shape, labels=None,
+                colours=colour)
+        points.writeTo(os.path.join(self.workDir, self.imageName + suffix))
+    
+    def _getPicker(self):
+        """Returns the StarPicker of the image, made from the daophot
+        session's latest photometry and PICK list.
+        """
+        if self._picker is None:
+            self._picker = StarPicker(self.daophot, 'last', self.imagePath)
+        return self._picker
+    
+    def _pickStars(self, pickPath, brightRadius, brightMagLimit):
+        """Applies the StarPicker filters to the daophot PICK list and
+        writes the resulting star list to `pickPath`.
+        """
+        self._picker = None
+        picker = self._getPicker()
         picker.useDaophotPicks()
         if self.flagPath is not None:
             picker.filterOnFlagMap(self.flagPath)
-        picker.filterBright2MASSByDistance(40., 14., self.band)
-        pickPath = os.path.join(self.workDir, self.imageName + "rev.lst")
+        picker.filterBright2MASSByDistance(brightRadius, brightMagLimit,
+                self.band)
         picker.write(pickPath)
         picker.writeRegions(os.path.join(self.workDir,
             self.imageName + "_psfrev.reg"))
-        
-        # Make PSF, run allstar
-        fitText, psfPath, neiPath = self.daophot.make_psf(apPhot='last',
+    
+    def _makeInitialPSF(self, apPath, pickPath):
+        self.daophot.set_option('VA', '-1')  # full analytic psf
+        self.daophot.attach('input_image')
+        fitText, psfPath, neiPath = self.daophot.make_psf(apPhot=apPath,
                 starList=pickPath, psfName='init')
-        alsPath, alsStarSubPath, neiSubPath = self._makeAllstarPaths("init")
-        if runAllstar:
-            allstar = Allstar(self.imagePath,
-                self.daophot.get_path('last', 'psf'),
-                self.daophot.get_path('last', 'ap'), alsPath, alsStarSubPath)
-            allstar.run()
-        
-        # iterative DAOPHOT runs with increasing psf variability
-        # psfStarListPath = self.daophot.get_path('last', 'lst')
-        for varPSF in range(0, maxVarPSF + 1):
-            itername = "var%i" % varPSF
+        if fitText is None:
+            raise PSFNotConverged("The initial PSF did not converge")
+    
+    def _makeLevelTask(self, name, varPSF, prevLevel, sourcePath, psfPath,
+            neiPath, prevLstPath, lstPath, apPath):
+        """Returns the function of the pipeline task that fits the PSF at
+        one level of variability `varPSF` (or, if `None`, at the level that
+        the previous task ended with). The function returns the level used,
+        which is -1 if the fit fell back to the analytic PSF.
+        """
+        def run():
+            if varPSF is None:
+                level = self._graph.get_result(prevLevel)
+            else:
+                level = varPSF
+            picker = self._getPicker()
+            picker.useStarList(prevLstPath)
             try:
-                self._iteratePSF(varPSF, picker, neiPath, runAllstar,
-                        name=itername)
+                self._iteratePSF(level, picker, sourcePath, psfPath, neiPath,
+                        apPath, lstPath, name=name)
             except PSFNotConverged:
-                varPSF = -1
-                self._makeAnalyticPSF(picker)
-        
-        # make final psf on clean image, keeping last-used varPSF
-        success = self._iteratePSF(varPSF, picker, neiPath, runAllstar,
-                name='fin')
-        print success
-        
-        # Get path to the final psf
-        psfPath = self.daophot.get_path("fin", "psf")
+                self._makeAnalyticPSF(picker, apPath, lstPath, name)
+                level = -1
+            return level
+        return run
+    
+    def _addAllstarTask(self, graph, name, psfPath, apPath):
+        """Adds a task running allstar with a PSF model to `graph`.
         
-        self.daophot.shutdown()
+        :return: paths to the .als file and the star-subtracted image.
+        """
+        alsPath, alsStarSubPath, neiSubPath = self._makeAllstarPaths(name)
         
-        if clean:
-            self._clean()
+        def run():
+            allstar = Allstar(self.imagePath, psfPath, apPath, alsPath,
+                    alsStarSubPath, supervisor=self.supervisor)
+            allstar.run()
         
-        return (psfPath, pickPath, coordFilePath, apFilePath)
+        graph.add(Task('allstar_' + name, run,
+            inputs=[self.imagePath, psfPath, apPath],
+            outputs=[alsPath, alsStarSubPath]))
+        return alsPath, alsStarSubPath
+    
+    def _makeHiddenTask(self, psfPath, apPath, alsPath, alsStarSubPath,
+            hiddenApPath):
+        def run():
+            self.detectHiddenStars(psfPath, apPath, alsPath, alsStarSubPath,
+                    outputApPath=hiddenApPath, runAllstar=False,
+                    matchRadius=self.hiddenMatchRadius)
+        return run
     
-    def _makeAnalyticPSF(self, picker):
-        """This is a bailout method to return the path to the analytic PSF.
+    def _makeAnalyticPSF(self, picker, apPath, lstPath, name):
+        """This is a bailout method to make the analytic PSF under `name`.
         This is called whenever the empirical PSFs fail to converge."""
         print "FALLING BACK TO ANALYTIC PSF"
         self.daophot.set_option("VA", "-1")
-        pickPath = picker.getOutputPath()
-        fitText, psfPath, neiPath = self.daophot.make_psf(apPhot='last',
-                starList=pickPath, psfName='bail')
-        self.daophot.shutdown()
+        fitText, psfPath, neiPath = self.daophot.make_psf(apPhot=apPath,
+                starList=lstPath, psfName=name)
         return psfPath
     
     def _makeAllstarPaths(self, itername):
@@ -134,73 +317,115 @@ class PSFFactory(object):
         neiSubPath = "_".join((imageRoot, itername, "subnei.fits"))
         return alsPath, alsStarSubPath, neiSubPath
     
-    def _iteratePSF(self, varPSF, starPicker, neiPath, runAllstar, name=None):
+    def _iteratePSF(self, varPSF, starPicker, imagePath, psfPath, neiPath,
+            apPath, lstPath, name=None):
         """Performs a recipe of
-        * subtract neighbouring stars
+        * subtract neighbouring stars from `imagePath`
         * fit PSF
-        * make new allstar catalog
+        * cull the PSF stars flagged by the fit, and repeat
+        
+        The star list is written to `lstPath` and culled there.
         """
         if name is None:
             name = str(varPSF)
         alsPath, alsStarSubPath, neiSubPath = self._makeAllstarPaths(name)
-        pickPath = starPicker.getOutputPath()
+        starPicker.write(lstPath)
+        self.daophot.attach(imagePath)
 
         # had PSF fit be repeated; will reset to false if no stars are culled
         repeat = True
+        self.daophot.set_options({'VA': int(varPSF)})
         while repeat:
-            neiSubPath = self.daophot.substar(neiPath, 'last', neiSubPath,
-                    keepers=pickPath)
-            self.daophot.set_option('VA', int(varPSF))
+            neiSubPath = self.daophot.substar(neiPath, psfPath, neiSubPath,
+                    keepers=lstPath)
             self.daophot.attach(neiSubPath)  # use the nei-subtracted image
-            fitText, psfPath, neiPath = self.daophot.make_psf(apPhot='last',
-                    starList=pickPath, psfName=name)
+            fitText, psfPath, neiPath = self.daophot.make_psf(apPhot=apPath,
+                    starList=lstPath, psfName=name)
+            if fitText is None:
+                raise PSFNotConverged("The %s PSF did not converge" % name)
             if starPicker.cullWithFitResults(fitText):
                 repeat = True
                 print "repeating PSF fit after culling stars"
             else:
                 repeat = False
-        
-        if runAllstar:
-            allstar = owl.dao.Allstar(self.imagePath,
-                    self.daophot.get_path('last', 'psf'),
-                    self.daophot.get_path('last', 'ap'),
-                    alsPath, alsStarSubPath)
-            allstar.run()
-        
-        if self.findHiddenStars:
-            self.detectHiddenStars(self.daophot.get_path('last', 'psf'),
-                    self.daophot.get_path('last', 'ap'),
-                    alsPath, alsStarSubPath)
     
-    def detectHiddenStars(self, psfPath, apPhotPath, alsPath, alsStarSubPath):
+    
+    def detectHiddenStars(self, psfPath, apPhotPath, alsPath, alsStarSubPath,
+            outputApPath=None, runAllstar=True, matchRadius=2.):
         """Runs allstar with the most current psf model; runs daophot find
         on that star-subtracted image and attempts to uncover new stars.
+        Detections within `matchRadius` pixels of a star already in the
+        photometry catalog are residuals of that star, and are not
+        appended.
+        
+        :param outputApPath: path where the photometry catalog with the
+            hidden stars appended is written; by default `apPhotPath` is
+            overwritten.
+        :param runAllstar: set to False if allstar has already made
+            `alsStarSubPath` with the psf model.
+        :return: the :class:`catalogio.MatchStats` of the new detections.
         """
-        allstar = Allstar(self.imagePath, psfPath, apPhotPath,
-                alsPath, alsStarSubPath)
-        allstar.run()
-        
-        starSubDaophot = owl.dao.Daophot(alsStarSubPath)
-        starSubDaophot.startup()
-        starSubDaophot.find()
-        starSubDaophot.apphot('last', apRadPath="wirphoto.opt")
-        newApPath = starSubDaophot.get_path('last', 'ap')
+        if runAllstar:
+            allstar = Allstar(self.imagePath, psfPath, apPhotPath,
+                    alsPath, alsStarSubPath, supervisor=self.supervisor)
+            allstar.run()
         
-        originalApCatalog = owl.dao.ApPhotCatalog2()
+        # a session of its own rather than a pooled one: `self.daophot` is
+        # still held, so a second acquire could wait on it forever
+        starSubDaophot = self._openDaophot(alsStarSubPath, pooled=False)
+        try:
+            starSubDaophot.find()
+            starSubDaophot.apphot('last', apRadPath="wirphoto.opt")
+            newApPath = starSubDaophot.get_path('last', 'ap')
+        finally:
+            starSubDaophot.shutdown()
+        
+        originalApCatalog = ApPhotCatalog()
         originalApCatalog.open(apPhotPath)
         
-        newApCatalog = owl.dao.ApPhotCatalog2()
+        newApCatalog = ApPhotCatalog()
         newApCatalog.open(newApPath)
         
         imageRoot = os.path.splitext(alsStarSubPath)[0]
         regPath = imageRoot + "_hidden.reg"
-        newApCatalog.writeImageRegions(regPath)
-        print "==== Detected %s hidden stars ====" % newApCatalog.nStars
-        
-        originalApCatalog.appendCatalog(newApCatalog)
-        originalApCatalog.write(apPhotPath)  # write new catalog in place!
+        newApCatalog.write_regions(regPath)
+        
+        stats = originalApCatalog.append_unmatched(newApCatalog, matchRadius)
+        log.info("Detected %i hidden stars (%i of %i detections within "
+                "%.1f px of known stars, median %.2f px)", stats.nAppended,
+                stats.nMatched, stats.nStars, matchRadius,
+                stats.medianSeparation)
+        if outputApPath is None:
+            outputApPath = apPhotPath  # write new catalog in place!
+        originalApCatalog.write(outputApPath)
+        return stats
+    
+    def _openDaophot(self, imagePath, pooled=True):
+        """Returns a daophot session with `imagePath` attached, borrowed from
+        the pool if there is one.
         
-        starSubDaophot.shutdown()
+        :param pooled: set to False to start a session of its own, set up
+            like the pool's sessions, that is shut down rather than handed
+            back to the pool.
+        """
+        pool = self.pool
+        if pool is None:
+            return Daophot(imagePath, stepCache=self.stepCache,
+                    supervisor=self.supervisor)
+        if pooled:
+            return pool.acquire(imagePath)
+        return Daophot(imagePath, shell=pool.shell, cmd=pool.cmd,
+                options=pool.options, stepCache=pool.stepCache,
+                supervisor=pool.supervisor)
+    
+    def _closeDaophot(self, daophot, failed=False):
+        """Hands a session opened with `_openDaophot` back to the pool, or
+        shuts it down. A `failed` session is not reused by the pool.
+        """
+        if self.pool is not None:
+            self.pool.release(daophot, failed=failed)
+        else:
+            daophot.shutdown()
     
     def _clean(self):
         """Uses a simple recipe to guess/try the names of files that should be
@@ -304,6 +529,14 @@ class StarPicker(object):
         self.candidates = pickCatalog.getStarIDs()
         print "There are %i candidates on useDaophot" % len(self.candidates)
     
+    def useStarList(self, lstPath):
+        """Sets the candidate list to the stars of a .lst file, such as one
+        saved by :meth:`write`.
+        """
+        pickCatalog = owl.dao.PickCatalog()
+        pickCatalog.read(lstPath)
+        self.candidates = pickCatalog.getStarIDs()
+    
     def filterOnFlagMap(self, flagPath):
         """Applies the flagmap to filtering the PSF template stars. Any star
         whose centroid lies upon a flagged (>0) pixel will be rejected
@@ -330,14 +563,17 @@ class StarPicker(object):
         inputFITS = pyfits.open(self.inputImagePath)
         header = inputFITS[0].header
         wcs = astWCS.WCS(header, mode='pyfits')
-        alphaNW, deltaNW = wcs.pix2wcs(2048, 2048)
-        alphaSW, deltaSW = wcs.pix2wcs(2048, 1)
+        # corners of the frame, whatever its size (e.g. a mosaic tile)
+        nx = header['NAXIS1']
+        ny = header['NAXIS2']
+        alphaNW, deltaNW = wcs.pix2wcs(nx, ny)
+        alphaSW, deltaSW = wcs.pix2wcs(nx, 1)
         alphaSE, deltaSE = wcs.pix2wcs(1, 1)
-        alphaNE, deltaNE = wcs.pix2wcs(1, 2048)
-        raMin = min(alphaNW, alphaSW, alphaNE, alphaNW)
-        raMax = max(alphaNW, alphaSW, alphaNE, alphaNW)
-        decMin = min(deltaNW, deltaSW, deltaNE, deltaNW)
-        decMax = max(deltaNW, deltaSW, deltaNE, deltaNW)
+        alphaNE, deltaNE = wcs.pix2wcs(1, ny)
+        raMin = min(alphaNW, alphaSW, alphaSE, alphaNE)
+        raMax = max(alphaNW, alphaSW, alphaSE, alphaNE)
+        decMin = min(deltaNW, deltaSW, deltaSE, deltaNE)
+        decMax = max(deltaNW, deltaSW, deltaSE, deltaNE)
         catalog2MASS = owl.twomicron.Catalog2MASS()
         self.psc = catalog2MASS.getStarsInArea(raMin, raMax, decMin, decMax)
         inputFITS.close()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Non-interactive (scripted) daophot runs.
+
+Instead of waiting on every prompt, :class:`DaophotScript` records the lines
+that each daophot command would send, assuming the normal answer to every
+prompt, and pipes the whole script to daophot's stdin in a single process
+call (the way daophot is driven from a shell here-document). Outputs are
+checked and the transcript is parsed after the run.
+
+Scripts cannot branch on daophot's responses, so steps such as the iterative
+PSF fits in :class:`psfpipe.PSFFactory` should still use the interactive
+:class:`daophot.Daophot`.
+"""
+
+import os
+import threading
+import subprocess
+
+from daophot import Daophot
+
+
+class ScriptRecorder(object):
+    """Stand-in for a pexpect process that records the lines sent to it.
+    Every `expect` succeeds immediately on the first pattern.
+    """
+    def __init__(self):
+        super(ScriptRecorder, self).__init__()
+        self.lines = []
+        # (command line, index of the line in self.lines)
+        self.commands = []
+        self.before = ""
+        self.timeout = 30.
+        self.totalTimeout = 0.
+        self._atCommandPrompt = False
+
+    def sendline(self, line=""):
+        if self._atCommandPrompt:
+            self.commands.append((line, len(self.lines)))
+        self.lines.append(line)
+
+    def expect(self, pattern, timeout=-1):
+        if timeout is None or timeout == -1:
+            timeout = self.timeout
+        self.totalTimeout += timeout
+        patterns = pattern if isinstance(pattern, list) else [pattern]
+        # scripts always take the first branch of a dialogue
+        self._atCommandPrompt = patterns[0] == "Command:"
+        return 0
+
+    def isalive(self):
+        return True
+
+    def close(self, force=False):
+        pass
+
+
+class ScriptResult(object):
+    """Outcome of a :meth:`DaophotScript.run`.
+
+    :param script: the text piped to daophot.
+    :param transcript: everything daophot wrote to stdout/stderr.
+    :param returncode: daophot's exit status.
+    :param commands: the commands of the script, in order.
+    :param missingOutputs: expected output files that were not written.
+    :param timedOut: `True` if daophot was killed for running too long.
+    """
+    def __init__(self, script, transcript, returncode, commands,
+            missingOutputs, timedOut):
+        super(ScriptResult, self).__init__()
+        self.script = script
+        self.transcript = transcript
+        self.returncode = returncode
+        self.commands = commands
+        self.missingOutputs = missingOutputs
+        self.timedOut = timedOut
+
+    def psf_converged(self):
+        """Returns `False` if any PSF fit in the script failed to converge."""
+        return "Failed to converge." not in self.transcript
+
+    def succeeded(self):
+        """Returns `True` if daophot finished in time, every expected output
+        was written and every PSF fit converged.
+        """
+        return (not self.timedOut) and len(self.missingOutputs) == 0 \
+                and self.psf_converged()
+
+    def get_segments(self):
+        """Splits the transcript at daophot's command prompts.
+
+        :return: list of `(command, text)` pairs, where `text` is daophot's
+            output from the moment `command` was given until the next
+            command prompt.
+        """
+        chunks = self.transcript.split("Command:")
+        # chunks[0] is the banner, chunk i is the response to command i - 1
+        segments = []
+        for i, command in enumerate(self.commands):
+            if i + 1 < len(chunks):
+                segments.append((command, chunks[i + 1]))
+            else:
+                segments.append((command, ""))
+        return segments
+
+    def get_fitting_text(self):
+        """Returns the transcript of the last *PSF* command, which includes
+        daophot's report of the fit quality (as returned by
+        :meth:`daophot.Daophot.make_psf`), or `None` if there was none.
+        """
+        fittingText = None
+        for command, text in self.get_segments():
+            if command.strip().upper().startswith("PS"):
+                fittingText = text
+        return fittingText
+
+
+class DaophotScript(Daophot):
+    """Compiles daophot commands into one stdin script.
+
+    The interface is that of :class:`daophot.Daophot`; each method call
+    appends its prompt answers to the script instead of talking to daophot.
+    Nothing is run until :meth:`run` is called::
+
+        script = DaophotScript(imagePath)
+        script.find()
+        script.apphot('last', apRadPath='photo.opt')
+        script.pick_psf_stars(100, 'last')
+        script.make_psf('last', 'last')
+        result = script.run()
+        if not result.succeeded():
+            ...
+
+    Since daophot is not consulted while the script is compiled, methods that
+    return daophot output (e.g. the fitting text of :meth:`make_psf`) return
+    placeholders; use the :class:`ScriptResult` instead. Paths returned by
+    methods are valid once the script has run successfully.
+    """
+    def __init__(self, inputImagePath, shell="/bin/zsh", cmd="daophot",
+            options=None):
+        self._expectedOutputs = []
+        super(DaophotScript, self).__init__(inputImagePath, shell=shell,
+                cmd=cmd, options=options)
+
+    def _spawn(self):
+        return ScriptRecorder()
+
+    def shutdown(self):
+        """Scripts always end with daophot's *EXIT* command, added by
+        :meth:`run`; nothing needs to be shut down.
+        """
+        pass
+
+    def get_script(self):
+        """Returns the text that will be piped to daophot."""
+        return "\n".join(self._daophot.lines + ["exit"]) + "\n"
+
+    def run(self, timeout=None):
+        """Runs the script in a single daophot process.
+
+        :param timeout: seconds to allow daophot to run before it is killed.
+            By default, this is the sum of the timeouts of all the prompts in
+            the script.
+        :return: a :class:`ScriptResult`.
+        """
+        if timeout is None:
+            timeout = self._daophot.totalTimeout
+        script = self.get_script()
+        process = subprocess.Popen([self.shell, "-c",
+                "cd %s;%s" % (self._workDir, self.cmd)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, universal_newlines=True)
+        timedOut = []
+
+        def kill():
+            timedOut.append(True)
+            process.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            transcript = process.communicate(script)[0]
+        finally:
+            timer.cancel()
+        self._stats.transcript.write(transcript)
+
+        missingOutputs = [path for path in self._expectedOutputs
+                if not os.path.exists(path)]
+        commands = [command for command, i in self._daophot.commands]
+        return ScriptResult(script, transcript, process.returncode, commands,
+                missingOutputs, len(timedOut) > 0)
+
+    def _make_output_path(self, path, name, ext):
+        path = super(DaophotScript, self)._make_output_path(path, name, ext)
+        self._expectedOutputs.append(os.path.join(self._workDir, path))
+        return path
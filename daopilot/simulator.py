@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Stand-in for the daophot and allstar executables.
+
+The simulator reproduces the prompt dialogue of daophot (``Command:``,
+``OPT>``, ``PHO>``, the PSF ``.nei``/"Failed to converge." branches,
+"Good bye.") and of allstar, and writes synthetic output files in the
+DAOPHOT formats. It lets the drivers in this package be tested and
+benchmarked without the licensed binaries::
+
+    daophot = Daophot(imagePath, cmd="python simulator.py daophot")
+
+Installing the package also makes the ``daopilot-sim-daophot`` and
+``daopilot-sim-allstar`` commands, which take the same options::
+
+    daophot = Daophot(imagePath, cmd="daopilot-sim-daophot")
+
+Per-command delays simulate work, e.g. ``--delays FIND=0.5,PSF=2``; the same
+setting can be given with the ``DAOPILOT_SIM_DELAYS`` environment variable.
+Command names are those of daophot (``STARTUP``, ``ATTACH``, ``FIND``,
+``PHOTOMETRY``, ``PICK``, ``PSF``, ``SUBSTAR``) or ``ALLSTAR``.
+
+Run ``python simulator.py --help`` for all the options.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import optparse
+
+
+COO_HEADER = " NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE" \
+        "    FRAD\n  %i %5i %5i   100.0 30000.0   50.00    3.00    1.00" \
+        "    1.00    2.50\n\n"
+
+
+class SimulatedImage(object):
+    """Synthetic star list of an image, seeded by the image's name so that
+    every command sees the same stars.
+    """
+    def __init__(self, imageName, nStars, size):
+        super(SimulatedImage, self).__init__()
+        self.imageName = imageName
+        self.size = size
+        rng = random.Random(imageName)
+        self.stars = []
+        for i in range(nStars):
+            x = rng.uniform(1., size)
+            y = rng.uniform(1., size)
+            mag = rng.uniform(-8., 0.)
+            self.stars.append({'id': i + 1, 'x': x, 'y': y, 'mag': mag,
+                'sharp': rng.uniform(0.3, 0.9),
+                'round': rng.uniform(-0.5, 0.5),
+                'dround': rng.uniform(-0.5, 0.5),
+                'sky': rng.uniform(90., 110.),
+                'sigma': rng.uniform(2., 4.),
+                'skew': rng.uniform(-1., 1.),
+                'err': 10. ** (0.2 * mag) * 0.05 + 0.001})
+
+    def get_brightest(self, n):
+        return sorted(self.stars, key=lambda star: star['mag'])[:n]
+
+    def write_coo(self, path):
+        f = open(path, 'w')
+        f.write(COO_HEADER % (1, self.size, self.size))
+        for s in self.stars:
+            f.write("%7i%9.3f%9.3f%9.3f%9.3f%9.3f%9.3f\n" % (s['id'], s['x'],
+                s['y'], s['mag'], s['sharp'], s['round'], s['dround']))
+        f.close()
+
+    def write_ap(self, path, stars=None, nApertures=1):
+        if stars is None:
+            stars = self.stars
+        f = open(path, 'w')
+        f.write(COO_HEADER % (2, self.size, self.size))
+        for s in stars:
+            f.write("\n")  # like daophot, a blank line before each star
+            mags = "".join(["%9.3f" % (s['mag'] + 25. - 0.05 * j)
+                for j in range(nApertures)])
+            errs = "".join([("%8.4f" if j == 0 else "%9.4f") % s['err']
+                for j in range(nApertures)])
+            f.write("%7i%9.3f%9.3f%s\n%13.3f%6.2f%6.2f%s\n" % (s['id'],
+                s['x'], s['y'], mags, s['sky'], s['sigma'], s['skew'], errs))
+        f.close()
+
+    def write_lst(self, path, stars):
+        f = open(path, 'w')
+        f.write(COO_HEADER % (3, self.size, self.size))
+        for s in stars:
+            f.write("%7i%9.3f%9.3f%9.3f%9.3f\n" % (s['id'], s['x'], s['y'],
+                s['mag'] + 25., s['err']))
+        f.close()
+
+    def write_psf(self, path, nStars):
+        f = open(path, 'w')
+        f.write(" PENNY1    51    4    3    0   %9.3f %10.2f %8.1f %8.1f\n"
+                % (14.5, 12345.67, self.size / 2., self.size / 2.))
+        f.write(" %13.6E %13.6E %13.6E %13.6E\n" % (1.2345, 1.3456, 0.0312,
+            0.4567))
+        for i in range(nStars):
+            f.write(" %13.6E %13.6E %13.6E %13.6E %13.6E %13.6E\n"
+                    % tuple([1e-3 * (i + j) for j in range(6)]))
+        f.close()
+
+    def write_als(self, path):
+        f = open(path, 'w')
+        f.write(COO_HEADER % (1, self.size, self.size))
+        for s in self.stars:
+            f.write("%7i%9.3f%9.3f%9.3f%9.4f%9.3f%#9.0f%9.3f%9.3f\n"
+                    % (s['id'], s['x'], s['y'], s['mag'] + 25., s['err'],
+                    s['sky'], 5., 1.02, s['sharp'] - 0.5))
+        f.close()
+
+
+class Simulator(object):
+    """Runs the prompt dialogue of daophot or allstar on stdin/stdout."""
+    def __init__(self, delays, nStars, size, nApertures, failPSF):
+        super(Simulator, self).__init__()
+        self.delays = delays
+        self.nStars = nStars
+        self.size = size
+        self.nApertures = nApertures
+        self.failPSF = failPSF
+        self.image = None
+        self.imageName = None
+
+    def ask(self, prompt):
+        """Writes a prompt and returns the stripped answer; exits on EOF."""
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+        if len(line) == 0:
+            sys.exit(0)
+        return line.strip()
+
+    def say(self, text):
+        sys.stdout.write(text + "\n")
+        sys.stdout.flush()
+
+    def work(self, command):
+        delay = self.delays.get(command, 0.)
+        if delay > 0.:
+            time.sleep(delay)
+
+    def ask_output(self, prompt, default):
+        """Asks for an output file name; like daophot, offers to overwrite an
+        existing file under a new name.
+        """
+        path = self.ask(" %s (default %s): " % (prompt, default)) or default
+        while os.path.exists(path):
+            self.say("\n This file already exists: %s\n" % path)
+            answer = self.ask(" New output file name (default OVERWRITE): ")
+            if len(answer) == 0:
+                os.remove(path)
+            else:
+                path = answer
+        return path
+
+    def default_path(self, ext):
+        root = os.path.splitext(self.imageName or "image")[0]
+        return "%s.%s" % (root, ext)
+
+    def option_loop(self, prompt):
+        while len(self.ask(prompt)) > 0:
+            pass
+
+    def run_daophot(self):
+        self.work('STARTUP')
+        self.say("\n DAOPHOT simulator (daopilot)\n")
+        self.say("                  WATCH PROGRESS =     -2.00")
+        while True:
+            command = self.ask("\n Command: ").upper()
+            if len(command) == 0:
+                continue
+            name = command.split()[0]
+            if name.startswith("OP"):
+                self.ask(" File with parameters (default KEYBOARD INPUT): ")
+                self.option_loop(" OPT> ")
+            elif name.startswith("AT"):
+                self.attach(command)
+            elif name.startswith("FI"):
+                self.find()
+            elif name.startswith("PH"):
+                self.photometry()
+            elif name.startswith("PI"):
+                self.pick()
+            elif name.startswith("PS"):
+                self.psf()
+            elif name.startswith("SU"):
+                self.substar()
+            elif name.startswith("EX"):
+                self.say(" Good bye.")
+                return
+            else:
+                self.say(" Unrecognized command.")
+
+    def attach(self, command):
+        items = command.split()
+        if len(items) > 1:
+            self.imageName = os.path.basename(items[1]).lower()
+        else:
+            self.imageName = self.ask(" Enter file name: ").lower()
+        self.image = SimulatedImage(self.imageName, self.nStars, self.size)
+        self.work('ATTACH')
+        self.say("\n Your picture is %i by %i pixels." % (self.size,
+            self.size))
+
+    def find(self):
+        self.ask(" Number of frames averaged, summed: ")
+        path = self.ask_output("File for the positions",
+                self.default_path("coo"))
+        self.work('FIND')
+        self.image.write_coo(path)
+        self.say("\n %i stars." % len(self.image.stars))
+        self.ask(" Are you happy with this? ")
+
+    def photometry(self):
+        self.ask(" File with aperture radii (default photo.opt): ")
+        self.option_loop(" PHO> ")
+        self.ask(" Input position file (default %s): "
+                % self.default_path("coo"))
+        path = self.ask_output("Output file", self.default_path("ap"))
+        self.work('PHOTOMETRY')
+        self.image.write_ap(path, nApertures=self.nApertures)
+        self.say("\n Estimated magnitude limit (Ap. 1): 20.00 +- 0.10 per"
+                " star.")
+
+    def pick(self):
+        self.ask(" Input file name (default %s): " % self.default_path("ap"))
+        answer = self.ask(" Desired number of stars, faintest magnitude: ")
+        nStars = int(float(answer.split(",")[0] or 0))
+        path = self.ask_output("Output file name", self.default_path("lst"))
+        self.work('PICK')
+        self.image.write_lst(path, self.image.get_brightest(nStars))
+        self.say("\n %i suitable candidates were found." % nStars)
+
+    def psf(self):
+        self.ask(" File with aperture results (default %s): "
+                % self.default_path("ap"))
+        self.ask(" File with PSF stars (default %s): "
+                % self.default_path("lst"))
+        path = self.ask_output("File for the PSF", self.default_path("psf"))
+        self.work('PSF')
+        psfStars = self.image.get_brightest(25)
+        for s in psfStars:
+            self.say(" %6i %6.3f" % (s['id'], abs(s['sharp'] - 0.5)))
+        if self.failPSF:
+            self.say("\n Failed to converge.")
+            return
+        neiPath = os.path.splitext(path)[0] + ".nei"
+        if os.path.exists(neiPath):
+            os.remove(neiPath)
+        self.image.write_psf(path, len(psfStars))
+        self.image.write_ap(neiPath, stars=psfStars)
+        self.say("\n File with PSF stars and neighbors = %s\n" % neiPath)
+        self.ask("")
+
+    def substar(self):
+        self.ask(" File with the PSF (default %s): "
+                % self.default_path("psf"))
+        self.ask(" File with photometry (default %s): "
+                % self.default_path("nst"))
+        answer = self.ask(" Do you have stars to leave in? ")
+        if answer.upper().startswith("Y"):
+            self.ask(" File with star list (default %s): "
+                    % self.default_path("lst"))
+        root = os.path.splitext(self.imageName)[0]
+        path = self.ask_output("Name for subtracted image",
+                root + "s.fits")
+        self.work('SUBSTAR')
+        self.copy_image(path)
+
+    def copy_image(self, path):
+        if self.imageName is not None and os.path.exists(self.imageName):
+            shutil.copyfile(self.imageName, path)
+        else:
+            open(path, 'w').close()
+
+    def run_allstar(self):
+        self.work('STARTUP')
+        self.say("\n ALLSTAR simulator (daopilot)\n")
+        self.say("                  FITTING RADIUS =      2.50")
+        self.option_loop("\n OPT> ")
+        self.imageName = self.ask(" Input image name: ")
+        self.image = SimulatedImage(os.path.basename(self.imageName).lower(),
+                self.nStars, self.size)
+        self.ask(" File with the PSF (default %s): "
+                % self.default_path("psf"))
+        self.ask(" Input file (default %s): " % self.default_path("ap"))
+        alsPath = self.ask_output("File for results",
+                self.default_path("als"))
+        root = os.path.splitext(self.imageName)[0]
+        subPath = self.ask_output("Name for subtracted image",
+                root + "s.fits")
+        nIterations = 4
+        for i in range(nIterations):
+            self.work('ALLSTAR_ITERATION')
+            self.say("  %6i %8i %8i %8i" % (i + 1, len(self.image.stars),
+                len(self.image.stars) * (i + 1) // nIterations, 0))
+        self.work('ALLSTAR')
+        self.image.write_als(alsPath)
+        self.copy_image(subPath)
+        self.say("\n Good bye.")
+
+
+def parse_delays(text):
+    """Parses ``'FIND=0.5,PSF=2'`` into ``{'FIND': 0.5, 'PSF': 2.0}``."""
+    delays = {}
+    if not text:
+        return delays
+    for item in text.split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        delays[name.strip().upper()] = float(value)
+    return delays
+
+
+def main(argv=None, program=None):
+    """Entry point; `program` is 'daophot' or 'allstar', otherwise it is
+    taken from the first positional argument.
+    """
+    parser = optparse.OptionParser(
+            usage="%prog [options] {daophot,allstar}")
+    parser.add_option("--delays", default=None,
+            help="per-command delays in seconds, e.g. FIND=0.5,PSF=2")
+    parser.add_option("--stars", type="int", default=200,
+            help="number of synthetic stars per image")
+    parser.add_option("--size", type="int", default=2048,
+            help="width and height of the synthetic images")
+    parser.add_option("--apertures", type="int", default=1,
+            help="number of apertures in .ap files")
+    parser.add_option("--fail-psf", action="store_true", default=False,
+            help="make every PSF fit fail to converge")
+    options, args = parser.parse_args(argv)
+    if program is None:
+        if len(args) != 1 or args[0] not in ('daophot', 'allstar'):
+            parser.error("the program must be 'daophot' or 'allstar'")
+        program = args[0]
+
+    delays = parse_delays(os.environ.get('DAOPILOT_SIM_DELAYS'))
+    delays.update(parse_delays(options.delays))
+    simulator = Simulator(delays, options.stars, options.size,
+            options.apertures, options.fail_psf)
+    if program == 'daophot':
+        simulator.run_daophot()
+    else:
+        simulator.run_allstar()
+
+
+def daophot_main():
+    """Entry point of the ``daopilot-sim-daophot`` command."""
+    main(program='daophot')
+
+
+def allstar_main():
+    """Entry point of the ``daopilot-sim-allstar`` command."""
+    main(program='allstar')
+
+
+if __name__ == '__main__':
+    main()
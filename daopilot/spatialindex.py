@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Grid-hash index of star positions, for finding the stars near a position
+without scanning the whole catalog.
+
+A :class:`GridIndex` bins the stars into square cells and sorts them by
+cell, row after row of cells, so that the stars of any run of cells along a
+row are contiguous. A query gathers the stars of the rows of cells it
+overlaps and keeps those that pass an exact test. Queries are made for
+arrays of positions at once::
+
+    index = GridIndex(stars['x'], stars['y'])
+    queryRows, starRows, distances = index.query_radius(x, y, 2.)
+    distances, rows = index.query_nearest(x, y, k=3)
+    rows = index.query_box(100., 200., 300., 400.)
+
+Catalogs build an index of their stars when first asked for one (see
+:meth:`catalogio.DaoCatalogBase.get_spatial_index`).
+"""
+
+import numpy as np
+
+
+class GridIndex(object):
+    """Index of points `x`, `y` (e.g. the pixel positions of stars) in a
+    grid of square cells. Points with non-finite coordinates are not
+    indexed, and are never found.
+
+    :param x: array of x coordinates.
+    :param y: array of y coordinates.
+    :param cellSize: side of the cells; by default, cells hold
+        :attr:`starsPerCell` points on average.
+    """
+    # mean number of points in a cell of the default size
+    starsPerCell = 2.
+    # queries gathered at once, bounding the memory of a query
+    chunkSize = 65536
+
+    def __init__(self, x, y, cellSize=None):
+        super(GridIndex, self).__init__()
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.nStars = len(self.x)
+        rows = np.nonzero(np.isfinite(self.x) & np.isfinite(self.y))[0]
+        if len(rows) > 0:
+            self.x0 = self.x[rows].min()
+            self.y0 = self.y[rows].min()
+            width = self.x[rows].max() - self.x0
+            height = self.y[rows].max() - self.y0
+        else:
+            self.x0, self.y0, width, height = 0., 0., 0., 0.
+        if cellSize is None:
+            cellSize = self._default_cell_size(width, height, len(rows))
+        self.cellSize = float(cellSize)
+        self.nCellsX = int(width // self.cellSize) + 1
+        self.nCellsY = int(height // self.cellSize) + 1
+        keys = (np.floor((self.y[rows] - self.y0) / self.cellSize)
+                .astype(np.int64) * self.nCellsX
+                + np.floor((self.x[rows] - self.x0) / self.cellSize)
+                .astype(np.int64))
+        order = np.argsort(keys, kind='mergesort')
+        # indexed rows sorted by cell, and where each cell's rows start
+        self.order = rows[order]
+        self.cellStarts = np.zeros(self.nCellsX * self.nCellsY + 1,
+                dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=self.nCellsX * self.nCellsY),
+                out=self.cellStarts[1:])
+
+    def _default_cell_size(self, width, height, nStars):
+        """Returns the cell size for :attr:`starsPerCell` points per cell
+        over a `width` by `height` extent.
+        """
+        if nStars == 0:
+            return 1.
+        if width * height > 0.:
+            return np.sqrt(width * height * self.starsPerCell / nStars)
+        if max(width, height) > 0.:
+            # points along a line
+            return max(width, height) * self.starsPerCell / nStars
+        return 1.
+
+    def query_radius(self, x, y, radius):
+        """Finds the points within `radius` of each position `x`, `y`.
+
+        :return: arrays of the index of the position of each match (in `x`
+            and `y`), the row of the matched point and their distance,
+            sorted by position and then by distance.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        queryRows, starRows, distances = [], [], []
+        for first in range(0, len(x), self.chunkSize):
+            xq = x[first:first + self.chunkSize]
+            yq = y[first:first + self.chunkSize]
+            queries, rows = self._gather(xq - radius, xq + radius,
+                    yq - radius, yq + radius)
+            d = np.hypot(self.x[rows] - xq[queries],
+                    self.y[rows] - yq[queries])
+            isNear = d <= radius
+            queries, rows, d = queries[isNear], rows[isNear], d[isNear]
+            order = np.lexsort((d, queries))
+            queryRows.append(queries[order] + first)
+            starRows.append(rows[order])
+            distances.append(d[order])
+        if len(queryRows) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros(0))
+        return (np.concatenate(queryRows), np.concatenate(starRows),
+                np.concatenate(distances))
+
+    def query_pairs(self, radius):
+        """Finds all pairs of indexed points within `radius` of each other.
+
+        :return: arrays of the rows `i` and `j` (with `i < j`) of each pair
+            and their distance, sorted by `i` and then by distance.
+        """
+        first, second, distances = self.query_radius(self.x, self.y, radius)
+        isPair = first < second
+        return first[isPair], second[isPair], distances[isPair]
+
+    def query_nearest(self, x, y, k=1):
+        """Finds the `k` points nearest to each position `x`, `y`. A point
+        that is itself at the position is found at a distance of zero.
+
+        :return: arrays of shape `(len(x), k)` of the distances and the rows
+            of the nearest points, nearest first. Non-finite positions get
+            distances of `inf` and rows of -1.
+        :raises ValueError: if fewer than `k` points are indexed.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        if k > len(self.order):
+            raise ValueError("Cannot find %i nearest of %i points"
+                    % (k, len(self.order)))
+        distances = np.empty((len(x), k))
+        distances.fill(np.inf)
+        rows = np.empty((len(x), k), dtype=np.int64)
+        rows.fill(-1)
+        pending = np.nonzero(np.isfinite(x) & np.isfinite(y))[0]
+        # a radius expected to hold k points, doubled until each position
+        # has k points within it
+        meanPerCell = max(float(len(self.order)) / len(self.cellStarts), 1e-9)
+        radius = self.cellSize * np.sqrt(max(k / meanPerCell, 1.))
+        while len(pending) > 0:
+            queries, matches, d = self.query_radius(x[pending], y[pending],
+                    radius)
+            counts = np.bincount(queries, minlength=len(pending))
+            isFound = counts >= k
+            # the matches of each position are sorted by distance
+            starts = np.cumsum(counts) - counts
+            taken = starts[isFound][:, None] + np.arange(k)
+            distances[pending[isFound]] = d[taken]
+            rows[pending[isFound]] = matches[taken]
+            pending = pending[~isFound]
+            radius *= 2.
+        return distances, rows
+
+    def query_box(self, x0, x1, y0, y1):
+        """Returns the sorted rows of the points with `x0 <= x <= x1` and
+        `y0 <= y <= y1`.
+        """
+        queries, rows = self._gather(np.array([x0], dtype=np.float64),
+                np.array([x1], dtype=np.float64),
+                np.array([y0], dtype=np.float64),
+                np.array([y1], dtype=np.float64))
+        isInside = (self.x[rows] >= x0) & (self.x[rows] <= x1) \
+                & (self.y[rows] >= y0) & (self.y[rows] <= y1)
+        return np.sort(rows[isInside])
+
+    def _gather(self, x0, x1, y0, y1):
+        """Returns the index of each query and the row of each point in the
+        cells overlapping the query's box, given arrays of the edges of the
+        boxes.
+        """
+        cx0, cx1 = self._cell_range(x0, x1, self.x0, self.nCellsX)
+        cy0, cy1 = self._cell_range(y0, y1, self.y0, self.nCellsY)
+        nRows = np.where(cx0 <= cx1, np.maximum(cy1 - cy0 + 1, 0), 0)
+        # a run of cells along a row, for each row of cells of each query
+        queries, offsets = _expand(nRows)
+        cellRows = cy0[queries] + offsets
+        starts = self.cellStarts[cellRows * self.nCellsX + cx0[queries]]
+        ends = self.cellStarts[cellRows * self.nCellsX + cx1[queries] + 1]
+        runs, offsets = _expand(ends - starts)
+        return queries[runs], self.order[starts[runs] + offsets]
+
+    def _cell_range(self, low, high, origin, nCells):
+        """Returns the first and last cells (along one axis, within the
+        grid) overlapped by the intervals from `low` to `high`. Infinite
+        edges are clipped to the grid. Intervals outside the grid, or with
+        an edge that is not a number, have a first cell after their last.
+        """
+        first = np.floor((low - origin) / self.cellSize)
+        last = np.floor((high - origin) / self.cellSize)
+        isNumber = ~(np.isnan(first) | np.isnan(last))
+        first = np.where(isNumber, np.clip(first, 0, nCells), 1)
+        last = np.where(isNumber, np.clip(last, -1, nCells - 1), 0)
+        return first.astype(np.int64), last.astype(np.int64)
+
+
+def _expand(counts):
+    """Given the lengths `counts` of runs of items, returns the run of each
+    item and its position in the run.
+    """
+    runs = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(len(runs)) - np.repeat(np.cumsum(counts) - counts,
+            counts)
+    return runs, offsets
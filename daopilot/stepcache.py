@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Content-addressed on-disk cache of daophot step outputs.
+
+A daophot command such as *FIND* is a pure function of its input files (the
+attached image, the coordinate list, ...), the options in effect, the option
+files it reads (``daophot.opt``, ``photo.opt``) and its own parameters. The
+:class:`StepCache` keys the output files of a command (``.coo``, ``.ap``,
+``.lst``, ``.psf``, ``.nei``) by a hash of all of those, so that re-running a
+pipeline on an unchanged image restores the outputs instead of running
+daophot again::
+
+    cache = StepCache("/scratch/daopilot_cache")
+    daophot = Daophot(imagePath, stepCache=cache)
+    daophot.find()   # a miss: runs daophot and stores image.coo
+    ...
+    daophot = Daophot(imagePath, stepCache=cache)
+    daophot.find()   # a hit: image.coo is copied from the cache
+
+Since keys are computed from file contents rather than paths, an identical
+image in another directory also hits. The cache is bounded to `maxBytes`;
+the least-recently used entries are evicted first.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+from optfile import format_value, normalize_options
+
+
+# options that only change what daophot prints, not what it computes
+UNKEYED_OPTIONS = ('WA',)
+
+
+def file_digest(path):
+    """Returns the SHA-1 hex digest of the contents of the file at `path`."""
+    sha = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if len(chunk) == 0:
+                break
+            sha.update(chunk)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+
+class CachedStep(object):
+    """An entry restored from a :class:`StepCache`.
+
+    :param key: the entry's key.
+    :param outputPaths: paths the cached outputs were copied to.
+    :param text: text saved with the entry (e.g. daophot's report of a PSF
+        fit), or `None`.
+    """
+    def __init__(self, key, outputPaths, text):
+        super(CachedStep, self).__init__()
+        self.key = key
+        self.outputPaths = outputPaths
+        self.text = text
+
+
+class StepCache(object):
+    """Cache of daophot command outputs in the directory `cacheDir`.
+
+    Each entry is a directory named by its key, holding copies of the
+    command's output files and an ``entry.json`` manifest. The modification
+    time of the manifest is the entry's last use, which orders evictions.
+    Entries are written to a temporary directory and renamed into place, so
+    several processes may share a cache directory.
+
+    :param cacheDir: directory of the cache; created if necessary.
+    :type cacheDir: str
+    :param maxBytes: size of the cache beyond which least-recently used
+        entries are evicted.
+    :type maxBytes: int
+    """
+    def __init__(self, cacheDir, maxBytes=2 * 1024 ** 3):
+        super(StepCache, self).__init__()
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        self._lock = threading.Lock()
+        # file digests keyed by (path, size, mtime), so that large images
+        # are hashed once per session rather than once per command
+        self._digests = {}
+        self._nTemp = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def hash_file(self, path):
+        """Returns the SHA-1 hex digest of the contents of the file at
+        `path`, or ``'missing'`` if there is no such file.
+        """
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 'missing'
+        memo = (path, st.st_size, st.st_mtime)
+        with self._lock:
+            if memo in self._digests:
+                return self._digests[memo]
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[memo] = digest
+        return digest
+
+    def make_key(self, command, inputPaths, options=None, params=None):
+        """Returns the key of a daophot command run.
+
+        :param command: name of the daophot command, e.g. 'FIND'.
+        :param inputPaths: paths to every file the command reads, including
+            option files such as ``daophot.opt``; their contents are hashed.
+        :param options: mapping of the daophot options in effect.
+        :param params: sequence of the command's other parameters (e.g. the
+            number of PSF stars), in a fixed order.
+        """
+        options = normalize_options(options)
+        optionText = ",".join(["%s=%s" % (name, format_value(options[name]))
+                for name in sorted(options) if name not in UNKEYED_OPTIONS])
+        sha = hashlib.sha1()
+        sha.update(command.upper().encode('utf-8'))
+        for path in inputPaths:
+            sha.update(b"\0")
+            sha.update(self.hash_file(path).encode('ascii'))
+        sha.update(b"\0")
+        sha.update(optionText.encode('utf-8'))
+        for param in (params or ()):
+            sha.update(b"\0")
+            sha.update(repr(param).encode('utf-8'))
+        return sha.hexdigest()
+
+    def _get_entry_dir(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def get(self, key, outputPaths):
+        """Restores the outputs of the entry `key` to `outputPaths`
+        (overwriting existing files).
+
+        :return: a :class:`CachedStep` on a hit, `None` on a miss.
+        """
+        entryDir = self._get_entry_dir(key)
+        manifestPath = os.path.join(entryDir, "entry.json")
+        try:
+            f = open(manifestPath)
+            try:
+                manifest = json.load(f)
+            finally:
+                f.close()
+            if len(manifest['outputs']) != len(outputPaths):
+                raise ValueError("cached step has %i outputs"
+                        % len(manifest['outputs']))
+            for name, path in zip(manifest['outputs'], outputPaths):
+                shutil.copyfile(os.path.join(entryDir, name), path)
+            os.utime(manifestPath, None)
+        except (IOError, OSError, ValueError, KeyError):
+            # absent, evicted by another process meanwhile, or unreadable
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return CachedStep(key, list(outputPaths), manifest.get('text'))
+
+    def put(self, key, outputPaths, text=None, command=None):
+        """Stores copies of `outputPaths` as the entry `key`. Nothing is
+        stored unless every output exists (e.g. when a PSF failed to
+        converge).
+
+        :param text: optional text to keep with the entry.
+        :param command: optional command name, for the manifest.
+        :return: `True` if the entry was stored.
+        """
+        if not all(os.path.exists(path) for path in outputPaths):
+            return False
+        entryDir = self._get_entry_dir(key)
+        if os.path.exists(entryDir):
+            return True
+        with self._lock:
+            self._nTemp += 1
+            tempDir = "%s.tmp-%i-%i" % (entryDir, os.getpid(), self._nTemp)
+        os.makedirs(tempDir)
+        names = []
+        for i, path in enumerate(outputPaths):
+            name = "output%i%s" % (i, os.path.splitext(path)[1])
+            shutil.copyfile(path, os.path.join(tempDir, name))
+            names.append(name)
+        if isinstance(text, bytes) and not isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        manifest = {'command': command, 'outputs': names, 'text': text}
+        f = open(os.path.join(tempDir, "entry.json"), 'w')
+        json.dump(manifest, f)
+        f.close()
+        try:
+            os.rename(tempDir, entryDir)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tempDir, ignore_errors=True)
+            return True
+        with self._lock:
+            self.stores += 1
+        self.evict()
+        return True
+
+    def _list_entries(self):
+        """Returns a list of `(last use, size, entryDir)` of all entries."""
+        entries = []
+        for prefix in os.listdir(self.cacheDir):
+            prefixDir = os.path.join(self.cacheDir, prefix)
+            if not os.path.isdir(prefixDir):
+                continue
+            for key in os.listdir(prefixDir):
+                entryDir = os.path.join(prefixDir, key)
+                try:
+                    lastUse = os.path.getmtime(
+                            os.path.join(entryDir, "entry.json"))
+                    size = sum(os.path.getsize(os.path.join(entryDir, name))
+                            for name in os.listdir(entryDir))
+                except OSError:
+                    continue  # being written or removed
+                entries.append((lastUse, size, entryDir))
+        return entries
+
+    def get_size(self):
+        """Returns the total size (bytes) of the cached files."""
+        return sum(size for lastUse, size, entryDir in self._list_entries())
+
+    def evict(self):
+        """Removes least-recently used entries until the cache is no larger
+        than `maxBytes`.
+        """
+        entries = sorted(self._list_entries())
+        totalSize = sum(size for lastUse, size, entryDir in entries)
+        for lastUse, size, entryDir in entries:
+            if totalSize <= self.maxBytes:
+                break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalSize -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        """Removes every entry from the cache."""
+        for lastUse, size, entryDir in self._list_entries():
+            shutil.rmtree(entryDir, ignore_errors=True)
+
+    def stats(self):
+        """Returns a dictionary of cache usage counts: `hits`, `misses`,
+        `stores` and `evictions` made by this instance.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'stores': self.stores, 'evictions': self.evictions}
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tiled processing of images too large for a single daophot run.
+
+Daophot's memory and allstar's runtime grow quickly with the size of the
+frame and the number of stars. A :class:`TiledImage` cuts a large mosaic
+into overlapping tiles, runs a per-image recipe (by default
+:class:`parallel.PSFRecipe`) on all tiles in parallel, and merges the
+per-tile catalogs back into catalogs of the whole image::
+
+    tiled = TiledImage("mosaic.fits", "mosaic_tiles", tileSize=2048,
+            overlap=64)
+    tiled.cut()
+    tiled.run(PSFRecipe(nStars=50, runAllstar=True), workers=8)
+    tiled.merge('ap', "mosaic.ap")
+
+Tiles are read through a memory map, so the full frame is never loaded.
+
+Each tile has a *core*. The cores are a partition of the parent frame, and
+each tile extends `overlap` pixels beyond its core on every side, so that
+stars near a core's edge are found and measured with all of their
+neighbours. While merging, stars are moved into the parent frame's pixel
+coordinates, and a star is kept only from the tile whose core holds it.
+This removes the duplicates that neighbouring tiles measure in their
+overlap strips. Stars are then renumbered.
+"""
+
+import os
+import glob
+from collections import namedtuple
+
+import numpy as np
+import pyfits
+
+from catalogio import CoordCatalog, ApPhotCatalog, AllstarCatalog, \
+        CatalogBuilder
+from parallel import run_many, PSFRecipe
+
+
+class Tile(namedtuple('Tile', ['index', 'x0', 'y0', 'nx', 'ny', 'coreX0',
+        'coreY0', 'coreX1', 'coreY1'])):
+    """A rectangle of a parent image.
+
+    :param index: serial number of the tile.
+    :param x0: column of the parent image (from 0) where the tile starts.
+    :param y0: row of the parent image (from 0) where the tile starts.
+    :param nx: number of columns of the tile.
+    :param ny: number of rows of the tile.
+    :param coreX0: first column of the parent image in the tile's core.
+    :param coreY0: first row of the parent image in the tile's core.
+    :param coreX1: column of the parent image just past the tile's core.
+    :param coreY1: row of the parent image just past the tile's core.
+    """
+    __slots__ = ()
+
+    def to_parent(self, x, y):
+        """Converts daophot pixel coordinates of the tile into those of the
+        parent image.
+        """
+        return x + self.x0, y + self.y0
+
+    def in_core(self, x, y):
+        """Returns a boolean array that is `True` where the daophot pixel
+        coordinates `x`, `y` of the parent image fall in the tile's core.
+        """
+        # daophot's pixel i (from 1) spans coordinates [i - 0.5, i + 0.5)
+        x = np.asarray(x)
+        y = np.asarray(y)
+        return (x >= self.coreX0 + 0.5) & (x < self.coreX1 + 0.5) \
+                & (y >= self.coreY0 + 0.5) & (y < self.coreY1 + 0.5)
+
+
+def make_tiles(nx, ny, tileSize=2048, overlap=64):
+    """Divides an image of `nx` by `ny` pixels into tiles.
+
+    :param tileSize: largest width and height of a tile's core; the cores
+        are made as even as possible.
+    :param overlap: margin (pixels) that each tile extends beyond its core.
+        It should exceed the PSF radius plus the fitting radius.
+    :return: list of :class:`Tile`, row by row.
+    """
+    xEdges = _split(nx, tileSize)
+    yEdges = _split(ny, tileSize)
+    tiles = []
+    for coreY0, coreY1 in zip(yEdges[:-1], yEdges[1:]):
+        for coreX0, coreX1 in zip(xEdges[:-1], xEdges[1:]):
+            x0 = max(coreX0 - overlap, 0)
+            y0 = max(coreY0 - overlap, 0)
+            x1 = min(coreX1 + overlap, nx)
+            y1 = min(coreY1 + overlap, ny)
+            tiles.append(Tile(len(tiles), x0, y0, x1 - x0, y1 - y0,
+                coreX0, coreY0, coreX1, coreY1))
+    return tiles
+
+
+def _split(n, size):
+    """Returns the edges of the fewest (near) equal parts of at most `size`
+    that `n` pixels can be split into.
+    """
+    nParts = max(int(np.ceil(float(n) / size)), 1)
+    return [int(round(edge)) for edge in np.linspace(0, n, nParts + 1)]
+
+
+def merge_catalogs(catalogs, tiles, nx=None, ny=None):
+    """Merges catalogs measured on tiles into a catalog of the parent image.
+
+    Positions are shifted into the parent frame, only the stars in each
+    tile's core are kept, and the stars are renumbered from 1.
+
+    :param catalogs: catalogs of the tiles (all of the same
+        :mod:`catalogio` class), each with the header of its file.
+    :param tiles: the :class:`Tile` each catalog was measured on.
+    :param nx: width of the parent image, written in the merged header.
+    :param ny: height of the parent image, written in the merged header.
+    :return: a new catalog of the same class.
+    """
+    if len(catalogs) == 0:
+        raise ValueError("No tile catalogs to merge")
+    parts = []
+    for catalog, tile in zip(catalogs, tiles):
+        if catalog.stars is None or catalog.nStars == 0:
+            continue
+        x, y = tile.to_parent(catalog.stars['x'], catalog.stars['y'])
+        inCore = tile.in_core(x, y)
+        stars = catalog.stars[inCore]
+        stars['x'] = x[inCore]
+        stars['y'] = y[inCore]
+        parts.append(stars)
+    merged = catalogs[0].__class__()
+    if len(parts) > 0:
+        builder = CatalogBuilder(capacity=0)
+        builder.merge(parts)
+        builder.number_stars()
+        merged.stars = builder.get_stars()
+    else:
+        merged.stars = catalogs[0].stars[:0].copy()
+    merged.nStars = len(merged.stars)
+    headerText = catalogs[0].get_header()
+    if headerText is not None and nx is not None and ny is not None:
+        headerText = set_header_size(headerText, nx, ny)
+    merged.set_header(headerText)
+    if hasattr(catalogs[0], 'fullCatalog'):
+        merged.fullCatalog = catalogs[0].fullCatalog
+    return merged
+
+
+def set_header_size(headerText, nx, ny):
+    """Returns a daophot catalog header with the image size (NX and NY, the
+    second and third fields of the second line) replaced.
+    """
+    lines = headerText.split("\n")
+    if len(lines) > 1 and len(lines[1]) >= 15:
+        # Fortran format (1X, I2, 2I6, ...)
+        lines[1] = lines[1][:3] + "%6i%6i" % (nx, ny) + lines[1][15:]
+    return "\n".join(lines)
+
+
+# catalog classes of the products of a tile, by result key
+CATALOG_CLASSES = {
+    'coo': CoordCatalog,
+    'ap': ApPhotCatalog,
+    'als': AllstarCatalog,
+}
+
+
+class TiledImage(object):
+    """A large image processed as overlapping tiles.
+
+    :param imagePath: path of the FITS image.
+    :type imagePath: str
+    :param tileDir: directory that the tile images, and the working
+        directories of the tiles, are made in. Defaults to a ``_tiles``
+        directory next to the image.
+    :type tileDir: str (optional)
+    :param tileSize: largest width and height of a tile's core (pixels).
+    :param overlap: margin (pixels) by which tiles overlap their
+        neighbours' cores.
+    :param ext: index of the FITS extension holding the image.
+    """
+    def __init__(self, imagePath, tileDir=None, tileSize=2048, overlap=64,
+            ext=0):
+        super(TiledImage, self).__init__()
+        self.imagePath = imagePath
+        if tileDir is None:
+            tileDir = os.path.splitext(imagePath)[0] + "_tiles"
+        self.tileDir = tileDir
+        self.ext = ext
+        fits = pyfits.open(imagePath, memmap=True)
+        try:
+            header = fits[ext].header
+            self.nx = int(header['NAXIS1'])
+            self.ny = int(header['NAXIS2'])
+        finally:
+            fits.close()
+        self.tiles = make_tiles(self.nx, self.ny, tileSize=tileSize,
+                overlap=overlap)
+        self.tilePaths = []
+        # ImageResult of each tile, in tile order, once run
+        self.results = []
+
+    def get_tile_path(self, tile):
+        """Returns the path of the image of `tile`."""
+        root = os.path.splitext(os.path.basename(self.imagePath))[0]
+        return os.path.join(self.tileDir, "%s_t%03i.fits" % (root,
+                tile.index))
+
+    def cut(self):
+        """Writes the image of each tile. Only the pixels of one tile at a
+        time are read from the (memory-mapped) parent image.
+
+        The WCS reference pixel (``CRPIX1/2``) and IRAF's physical offset
+        (``LTV1/2``) of each tile's header are shifted to the tile.
+
+        :return: list of the tile image paths.
+        """
+        if not os.path.exists(self.tileDir):
+            os.makedirs(self.tileDir)
+        fits = pyfits.open(self.imagePath, memmap=True)
+        try:
+            hdu = fits[self.ext]
+            self.tilePaths = []
+            for tile in self.tiles:
+                data = hdu.data[tile.y0:tile.y0 + tile.ny,
+                        tile.x0:tile.x0 + tile.nx]
+                header = hdu.header.copy()
+                for key, offset in (('CRPIX1', tile.x0),
+                        ('CRPIX2', tile.y0)):
+                    if key in header:
+                        header[key] = header[key] - offset
+                for key, offset in (('LTV1', tile.x0), ('LTV2', tile.y0)):
+                    header[key] = header.get(key, 0.) - offset
+                path = self.get_tile_path(tile)
+                pyfits.writeto(path, data, header, clobber=True)
+                self.tilePaths.append(path)
+        finally:
+            fits.close()
+        return list(self.tilePaths)
+
+    def run(self, recipe=None, workers=None, auxPaths=None,
+            scratchRoot=None):
+        """Runs `recipe` on every tile with :func:`parallel.run_many`, each in
+        its own working directory in `tileDir`. The option files next to the
+        parent image are linked into each working directory.
+
+        :param recipe: picklable per-image recipe returning a dictionary of
+            product paths (see :class:`parallel.PSFRecipe`, the default).
+        :return: the :class:`parallel.ImageResult` of each tile, in tile
+            order.
+        :raises RuntimeError: if the recipe failed on any tile.
+        """
+        if recipe is None:
+            recipe = PSFRecipe()
+        if len(self.tilePaths) == 0:
+            self.cut()
+        imageDir = os.path.dirname(os.path.abspath(self.imagePath))
+        auxPaths = glob.glob(os.path.join(imageDir, "*.opt")) \
+                + list(auxPaths or [])
+        byPath = {}
+        for result in run_many(self.tilePaths, recipe, workers=workers,
+                workRoot=self.tileDir, auxPaths=auxPaths,
+                scratchRoot=scratchRoot):
+            byPath[result.imagePath] = result
+        self.results = [byPath[path] for path in self.tilePaths]
+        failures = [result for result in self.results
+                if not result.succeeded()]
+        if len(failures) > 0:
+            raise RuntimeError("%i of %i tiles failed; first: %s: %s"
+                    % (len(failures), len(self.results),
+                    failures[0].imagePath, failures[0].error))
+        return list(self.results)
+
+    def merge(self, kind, outputPath=None, catalogClass=None):
+        """Merges the catalogs of one kind made on every tile into a catalog
+        of the whole image (see :func:`merge_catalogs`).
+
+        :param kind: key of the catalog in the recipe's results: ``'coo'``,
+            ``'ap'`` or ``'als'``.
+        :param outputPath: optional path the merged catalog is written to.
+        :param catalogClass: :mod:`catalogio` class that reads the catalogs;
+            by default, looked up in :data:`CATALOG_CLASSES`.
+        :return: the merged catalog.
+        """
+        if catalogClass is None:
+            catalogClass = CATALOG_CLASSES[kind]
+        catalogs = []
+        for result in self.results:
+            catalog = catalogClass()
+            catalog.open(result.result[kind])
+            catalogs.append(catalog)
+        merged = merge_catalogs(catalogs, self.tiles, nx=self.nx, ny=self.ny)
+        if outputPath is not None:
+            merged.write(outputPath)
+        return merged
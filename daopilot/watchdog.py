@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Supervision of hung daophot and allstar processes.
+
+Instead of waiting a flat 10-30 minutes on the step of a command where
+daophot or allstar does its work, a :class:`Watchdog` estimates how long the
+command should take from the size of the image and the number of stars
+(a :class:`RuntimeModel`) and watches the process's output while it waits:
+
+* until the expected runtime has passed, the process is left alone;
+* after that, it may run on (up to `slack` times the expected runtime) as
+  long as it keeps printing output; a process that has been silent for
+  `stallTimeout` seconds is declared stalled.
+
+A :class:`Supervisor` adds recovery: a stalled or crashed process is killed,
+a clean session is started in the state of the last completed step (same
+options, attached image and known files), and the command is retried after
+an exponentially growing pause. Every kill and retry is logged::
+
+    supervisor = Supervisor(retries=2)
+    daophot = Daophot(imagePath, supervisor=supervisor)
+    ...
+    for event in supervisor.get_log():
+        print(event)
+"""
+
+import os
+import time
+import threading
+from collections import namedtuple
+
+import pexpect
+
+
+class Stalled(pexpect.TIMEOUT):
+    """Raised when a watched process stops making progress or runs far
+    beyond its expected runtime.
+    """
+    pass
+
+
+# seconds = base + perMegapixel * megapixels + perKiloStar * thousands of stars
+DEFAULT_RATES = {
+    'FIND': (30., 20., 0.),
+    'PHOTOMETRY': (30., 2., 20.),
+    'PICK': (10., 0., 5.),
+    'PSF': (30., 2., 60.),
+    'SUBSTAR': (30., 5., 20.),
+    'ALLSTAR': (60., 20., 120.),
+}
+
+
+class RuntimeModel(object):
+    """Expected wall time of daophot and allstar commands, linear in the
+    number of pixels in the image and the number of stars processed.
+
+    :param rates: mapping of command names to `(base, perMegapixel,
+        perKiloStar)` seconds, overriding :data:`DEFAULT_RATES`.
+    :param default: rates of commands that are not listed.
+    """
+    def __init__(self, rates=None, default=(60., 0., 0.)):
+        super(RuntimeModel, self).__init__()
+        self.rates = dict(DEFAULT_RATES)
+        if rates is not None:
+            self.rates.update(rates)
+        self.default = default
+
+    def expected(self, command, nPixels=0, nStars=0):
+        """Returns the expected runtime (seconds) of `command`."""
+        base, perMegapixel, perKiloStar = self.rates.get(command,
+                self.default)
+        return base + perMegapixel * nPixels / 1e6 \
+                + perKiloStar * nStars / 1e3
+
+
+class Watch(object):
+    """Waits on the working step(s) of one command; made by
+    :meth:`Watchdog.watch`. The runtime of the command is counted from the
+    first wait, so a command whose work is waited on in several steps (e.g.
+    one per allstar iteration) still gets one budget.
+
+    :param expected: expected runtime of the command (seconds).
+    :param limit: runtime after which the command is stalled regardless of
+        its progress.
+    :param stallTimeout: seconds without output, once the expected runtime
+        has passed, after which the command is stalled.
+    :param progress: callable returning a number that increases whenever
+        the process writes output.
+    :param poll: seconds between progress checks.
+    """
+    def __init__(self, command, expected, limit, stallTimeout, progress,
+            poll=1.):
+        super(Watch, self).__init__()
+        self.command = command
+        self.expected = expected
+        self.limit = limit
+        self.stallTimeout = stallTimeout
+        self.progress = progress
+        self.poll = poll
+        self.startTime = None
+        self._lastProgress = None
+        self._lastProgressTime = None
+
+    def expect(self, child, pattern):
+        """Waits for `pattern` (or a list of patterns) from the pexpect
+        process `child`, like :meth:`pexpect.spawn.expect`.
+
+        :return: the index of the matched pattern.
+        :raises Stalled: if the process stalls or runs out of time.
+        """
+        patterns = self.start_wait(pattern)
+        while True:
+            index = child.expect(patterns, timeout=self.poll)
+            if index < len(patterns) - 1:
+                return index
+            self.check()
+
+    def start_wait(self, pattern):
+        """Starts waiting for `pattern` (or a list of patterns). A driver
+        that does not block on the process (see :mod:`asyncdriver`) waits
+        for the returned patterns in turns of `poll` seconds, and calls
+        :meth:`check` whenever the last pattern, :data:`pexpect.TIMEOUT`,
+        matches.
+
+        :return: the list of patterns, followed by :data:`pexpect.TIMEOUT`.
+        """
+        patterns = list(pattern) if isinstance(pattern, list) else [pattern]
+        if self.startTime is None:
+            self.startTime = time.time()
+        self._lastProgress = self.progress()
+        self._lastProgressTime = time.time()
+        return patterns + [pexpect.TIMEOUT]
+
+    def check(self):
+        """Checks the progress of the process since :meth:`start_wait`.
+
+        :raises Stalled: if the process stalls or runs out of time.
+        """
+        now = time.time()
+        progress = self.progress()
+        if progress != self._lastProgress:
+            self._lastProgress = progress
+            self._lastProgressTime = now
+        elapsed = now - self.startTime
+        if elapsed > self.limit:
+            raise Stalled("%s still running after %.0f s (expected "
+                    "%.0f s)" % (self.command, elapsed, self.expected))
+        if elapsed > self.expected \
+                and now - self._lastProgressTime > self.stallTimeout:
+            raise Stalled("%s silent for %.0f s after %.0f s (expected "
+                    "%.0f s)" % (self.command, now - self._lastProgressTime,
+                    elapsed, self.expected))
+
+
+class Watchdog(object):
+    """Makes a :class:`Watch` for each command of a session.
+
+    :param model: :class:`RuntimeModel` of the expected runtimes.
+    :param slack: a command is stalled once it has run `slack` times its
+        expected runtime, even if it still makes progress.
+    :param stallTimeout: seconds of silence after the expected runtime
+        after which a command is stalled.
+    :param poll: seconds between progress checks.
+    """
+    def __init__(self, model=None, slack=3., stallTimeout=60., poll=1.):
+        super(Watchdog, self).__init__()
+        if model is None:
+            model = RuntimeModel()
+        self.model = model
+        self.slack = slack
+        self.stallTimeout = stallTimeout
+        self.poll = poll
+
+    def watch(self, command, progress, imagePath=None, catalogPath=None):
+        """Returns a :class:`Watch` for `command`, scaled by the size of the
+        image at `imagePath` and the number of stars in the catalog at
+        `catalogPath` (either may be `None` or missing).
+        """
+        expected = self.model.expected(command,
+                nPixels=get_image_size(imagePath),
+                nStars=count_stars(catalogPath))
+        return Watch(command, expected, self.slack * expected,
+                self.stallTimeout, progress, poll=self.poll)
+
+
+def get_image_size(path):
+    """Returns the number of pixels in the primary image of the FITS file at
+    `path`, read from its header, or 0 if it cannot be read.
+    """
+    if path is None or not os.path.exists(path):
+        return 0
+    axes = {}
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(2880)
+            if len(block) < 2880:
+                return 0
+            for i in range(0, 2880, 80):
+                card = block[i:i + 80].decode('ascii', 'replace')
+                keyword = card[:8].strip()
+                if keyword == 'END':
+                    size = 1
+                    for n in range(1, axes.get('NAXIS', 0) + 1):
+                        size *= axes.get('NAXIS%i' % n, 0)
+                    return size if axes.get('NAXIS', 0) > 0 else 0
+                if keyword.startswith('NAXIS') and card[8:10] == "= ":
+                    try:
+                        axes[keyword] = int(card[10:].split("/")[0])
+                    except ValueError:
+                        pass
+    finally:
+        f.close()
+
+
+def count_stars(path):
+    """Returns the number of stars in a daophot catalog (.coo, .ap, .lst,
+    .als...), or 0 if it cannot be read. Stars are the data lines that start
+    with an integer ID; the second lines of .ap records start with a sky
+    value instead.
+    """
+    if path is None or not os.path.exists(path):
+        return 0
+    nStars = 0
+    f = open(path)
+    try:
+        for lineNumber, line in enumerate(f):
+            if lineNumber < 3:
+                continue  # header
+            items = line.split(None, 1)
+            if len(items) > 0 and items[0].isdigit():
+                nStars += 1
+    finally:
+        f.close()
+    return nStars
+
+
+class SupervisorEvent(namedtuple('SupervisorEvent', ['time', 'label',
+        'command', 'action', 'attempt', 'reason'])):
+    """An entry of the :class:`Supervisor` log.
+
+    :param time: Unix time of the event.
+    :param label: the session's label, e.g. the input image path.
+    :param command: the command that failed, e.g. 'PSF'.
+    :param action: 'kill' when a failed process was killed, 'retry' when the
+        command is about to be retried, 'give up' when it is not.
+    :param attempt: number of failed attempts of the command so far.
+    :param reason: description of the failure.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return "%s %s %s (attempt %i): %s" % (time.strftime("%H:%M:%S",
+                time.localtime(self.time)), self.label, self.command,
+                self.attempt, "%s; %s" % (self.action, self.reason))
+
+
+class Supervisor(object):
+    """Watches daophot and allstar sessions, and retries commands whose
+    process stalled, timed out or died.
+
+    A supervisor can be shared by any number of sessions (and threads).
+
+    :param watchdog: the :class:`Watchdog` used to detect stalled commands;
+        a default one is made if `None`.
+    :param retries: number of times a failed command is retried.
+    :param backoff: seconds to wait before the first retry; the wait doubles
+        with each further retry, up to `maxBackoff`.
+    :param maxBackoff: longest wait between retries (seconds).
+    :param maxEvents: number of log events kept.
+    """
+    def __init__(self, watchdog=None, retries=2, backoff=5.,
+            maxBackoff=300., maxEvents=1000):
+        super(Supervisor, self).__init__()
+        if watchdog is None:
+            watchdog = Watchdog()
+        self.watchdog = watchdog
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.maxEvents = maxEvents
+        self._log = []
+        self._lock = threading.Lock()
+
+    def watch(self, command, progress, imagePath=None, catalogPath=None):
+        """Returns the watchdog's :class:`Watch` for a command."""
+        return self.watchdog.watch(command, progress, imagePath=imagePath,
+                catalogPath=catalogPath)
+
+    def retry(self, label, command, attempt, error):
+        """Called by a session after its process failed (and was killed) on
+        `command` for the `attempt`-th time. Logs the failure and, if the
+        command may be retried, sleeps for the backoff time.
+
+        :return: `True` if the session should restart and retry.
+        """
+        delay = self.get_retry_delay(label, command, attempt, error)
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
+
+    def get_retry_delay(self, label, command, attempt, error):
+        """Logs a failure as :meth:`retry` does, without sleeping.
+
+        :return: the seconds to wait before restarting and retrying, or
+            `None` if the command is not retried.
+        """
+        reason = "%s: %s" % (error.__class__.__name__,
+                str(error).split("\n")[0])
+        self._record(label, command, 'kill', attempt, reason)
+        if attempt > self.retries:
+            self._record(label, command, 'give up', attempt, reason)
+            return None
+        delay = min(self.backoff * 2 ** (attempt - 1), self.maxBackoff)
+        self._record(label, command, 'retry', attempt,
+                "restarting in %.0f s" % delay)
+        return delay
+
+    def _record(self, label, command, action, attempt, reason):
+        with self._lock:
+            self._log.append(SupervisorEvent(time.time(), label, command,
+                    action, attempt, reason))
+            del self._log[:-self.maxEvents]
+
+    def get_log(self):
+        """Returns the list of :class:`SupervisorEvent`, oldest first."""
+        with self._lock:
+            return list(self._log)
+
+    def count(self, action):
+        """Returns the number of logged events of an `action` ('kill',
+        'retry' or 'give up').
+        """
+        with self._lock:
+            return len([event for event in self._log
+                    if event.action == action])
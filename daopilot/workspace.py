@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Scratch workspaces for daophot and allstar runs.
+
+Daophot writes (and deletes) many intermediate files in its working
+directory. When images live on a slow shared filesystem, it pays to run in a
+:class:`Workspace` on fast local storage (an SSD or tmpfs) instead: inputs are
+staged into the workspace (symlinked, or copied), daophot and allstar are
+pointed at the staged paths, and only the final products are moved back::
+
+    with Workspace("/dev/shm") as ws:
+        daophot = Daophot(ws.stage_image(imagePath))
+        daophot.find()
+        daophot.apphot('last')
+        daophot.shutdown()
+        ws.collect(["*.ap"], outputDir)
+
+Staged files keep their names unless their root is longer than
+`maxRootLength`; such files get short names (``im1.fits``, ...) that leave
+room, within daophot's 30-character file names, for the suffixes that
+pipelines add to output names. :meth:`Workspace.collect` gives products
+named after a shortened file their original name back.
+"""
+
+import os
+import re
+import glob
+import shutil
+import tempfile
+
+
+class Workspace(object):
+    """A directory where daophot runs on staged copies of (or links to) its
+    inputs.
+
+    :param scratchRoot: directory on fast storage in which a new temporary
+        workspace directory is made. Defaults to ``$DAOPILOT_SCRATCH``, or
+        the system's temporary directory.
+    :type scratchRoot: str (optional)
+    :param path: use this (existing or new) directory as the workspace
+        instead of a temporary one. It is not removed by :meth:`close`.
+    :type path: str (optional)
+    :param copy: copy inputs into the workspace instead of symlinking them,
+        e.g. when inputs on a network filesystem are read many times.
+    :type copy: bool
+    :param maxRootLength: longest file name root (name without extension)
+        that is staged unchanged; `None` never shortens names.
+    :type maxRootLength: int
+    :param keep: keep the temporary directory on :meth:`close`, e.g. for
+        debugging.
+    :type keep: bool
+    """
+    def __init__(self, scratchRoot=None, path=None, copy=False,
+            maxRootLength=12, keep=False):
+        super(Workspace, self).__init__()
+        self.copy = copy
+        self.maxRootLength = maxRootLength
+        if path is not None:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.path = path
+            self.keep = True
+        else:
+            if scratchRoot is None:
+                scratchRoot = os.environ.get('DAOPILOT_SCRATCH')
+            if scratchRoot is not None and not os.path.exists(scratchRoot):
+                os.makedirs(scratchRoot)
+            self.path = tempfile.mkdtemp(prefix="dao", dir=scratchRoot)
+            self.keep = keep
+        # staged name -> original absolute path
+        self._sources = {}
+        # short name roots -> original name roots
+        self._roots = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def get_path(self, name):
+        """Returns the path of the file `name` in the workspace."""
+        return os.path.join(self.path, os.path.basename(name))
+
+    def stage(self, path, name=None, copy=None):
+        """Links or copies the file at `path` into the workspace.
+
+        :param name: name of the file in the workspace; by default the
+            original name, or a short name if its root is too long or
+            the name is already taken by another file.
+        :param copy: overrides the workspace's `copy` setting for this file.
+        :return: the path of the staged file.
+        """
+        source = os.path.abspath(path)
+        if name is None:
+            name = self._make_name(source)
+        stagedPath = self.get_path(name)
+        if self._sources.get(name) != source:
+            if os.path.lexists(stagedPath):
+                os.remove(stagedPath)
+            if copy is None:
+                copy = self.copy
+            if copy:
+                shutil.copyfile(source, stagedPath)
+            else:
+                os.symlink(source, stagedPath)
+            self._sources[name] = source
+        return stagedPath
+
+    def stage_image(self, imagePath, auxPaths=(), copy=None):
+        """Stages a FITS image together with the option files (``*.opt``)
+        next to it, which daophot and allstar read from their working
+        directory, and any other `auxPaths`. Relative auxiliary paths that
+        do not exist are looked up in the image's directory.
+
+        :return: the path of the staged image.
+        """
+        imageDir = os.path.dirname(os.path.abspath(imagePath))
+        for path in glob.glob(os.path.join(imageDir, "*.opt")) \
+                + list(auxPaths):
+            if not os.path.isabs(path) and not os.path.exists(path):
+                path = os.path.join(imageDir, path)
+            # option files are looked up by name, so must keep it
+            self.stage(path, name=os.path.basename(path), copy=copy)
+        return self.stage(imagePath, copy=copy)
+
+    def _make_name(self, source):
+        """Returns the workspace name for the file at `source`."""
+        name = os.path.basename(source)
+        root, ext = os.path.splitext(name)
+        taken = name in self._sources and self._sources[name] != source
+        tooLong = self.maxRootLength is not None \
+                and len(root) > self.maxRootLength
+        if not (taken or tooLong):
+            return name
+        for staged, original in self._sources.items():
+            if original == source:
+                return staged  # staged before
+        i = len(self._roots) + 1
+        while ("im%i%s" % (i, ext)) in self._sources:
+            i += 1
+        shortRoot = "im%i" % i
+        self._roots[shortRoot] = root
+        return shortRoot + ext
+
+    def get_original_name(self, name):
+        """Returns the name of a workspace file with the root of a shortened
+        input name replaced by the original root, e.g. ``im1_init.psf`` for
+        ``a_long_image_name.fits`` becomes ``a_long_image_name_init.psf``.
+        """
+        name = os.path.basename(name)
+        for shortRoot in sorted(self._roots, key=len, reverse=True):
+            match = re.match(re.escape(shortRoot) + r"(?=[._]|$)", name)
+            if match is not None:
+                return self._roots[shortRoot] + name[match.end():]
+        return name
+
+    def collect(self, products, destDir, restoreNames=True):
+        """Moves final products out of the workspace into `destDir`, all at
+        once at the end of a run.
+
+        :param products: names (or paths) of files in the workspace, or glob
+            patterns of names, or a dictionary of such names to destination
+            paths.
+        :param restoreNames: give products named after a shortened input the
+            original name (see :meth:`get_original_name`).
+        :return: list of the destination paths of the moved files.
+        """
+        if isinstance(products, dict):
+            moves = [(self.get_path(name), dest)
+                    for name, dest in products.items()]
+        else:
+            moves = []
+            for pattern in products:
+                for path in sorted(glob.glob(self.get_path(pattern))):
+                    name = os.path.basename(path)
+                    if restoreNames:
+                        name = self.get_original_name(name)
+                    moves.append((path, os.path.join(destDir, name)))
+        if not os.path.exists(destDir):
+            os.makedirs(destDir)
+        destPaths = []
+        for path, dest in moves:
+            if os.path.basename(path) in self._sources:
+                # an input; never move the original out from under the user
+                shutil.copyfile(path, dest)
+            else:
+                if os.path.exists(dest):
+                    os.remove(dest)
+                shutil.move(path, dest)
+            destPaths.append(dest)
+        return destPaths
+
+    def collect_result(self, result, destDir):
+        """Moves every workspace file referred to in a recipe result to
+        `destDir`, and returns a copy of the result with those paths
+        replaced by the destination paths. Results may be paths, or
+        (nested) lists, tuples and dictionaries containing paths.
+        """
+        products = {}
+        self._find_paths(result, products, destDir)
+        self.collect(products, destDir)
+        return self._replace_paths(result, products)
+
+    def _find_paths(self, value, products, destDir):
+        if isinstance(value, dict):
+            for item in value.values():
+                self._find_paths(item, products, destDir)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                self._find_paths(item, products, destDir)
+        elif isinstance(value, str) and os.path.dirname(
+                os.path.abspath(value)) == os.path.abspath(self.path) \
+                and os.path.exists(value):
+            products[os.path.basename(value)] = os.path.join(destDir,
+                    self.get_original_name(value))
+
+    def _replace_paths(self, value, products):
+        if isinstance(value, dict):
+            return dict((key, self._replace_paths(item, products))
+                    for key, item in value.items())
+        elif isinstance(value, (list, tuple)):
+            items = [self._replace_paths(item, products) for item in value]
+            if hasattr(value, '_fields'):
+                return type(value)(*items)  # a namedtuple
+            return type(value)(items)
+        elif isinstance(value, str) and os.path.basename(value) in products \
+                and os.path.dirname(os.path.abspath(value)) \
+                == os.path.abspath(self.path):
+            return products[os.path.basename(value)]
+        return value
+
+    def close(self):
+        """Removes the workspace directory, with everything left in it,
+        unless it is to be kept.
+        """
+        if not self.keep and os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
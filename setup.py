@@ -20,4 +20,7 @@ setup(name='daopilot',
     license='BSD',
     install_requires=dependencies.split(),
     cmdclass=cmdclass,
-    packages=['daopilot'])
+    packages=['daopilot'],
+    entry_points={'console_scripts': [
+        'daopilot-sim-daophot = daopilot.simulator:daophot_main',
+        'daopilot-sim-allstar = daopilot.simulator:allstar_main']})
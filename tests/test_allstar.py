@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of allstar runs, alone and in a :class:`parallel.AllstarBatch`, with
+allstar played by :mod:`simulator`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+import simulator
+from catalogio import AllstarCatalog
+from allstar import Allstar
+from parallel import AllstarBatch, AllstarJob
+
+ALLSTAR = "%s %s allstar --stars 20 --size 256" % (sys.executable,
+        os.path.abspath(simulator.__file__).replace(".pyc", ".py"))
+
+
+def make_inputs(workDir, root):
+    """Writes an (empty) image and the PSF and photometry files of a
+    simulated image; returns their paths.
+    """
+    image = simulator.SimulatedImage(root, 20, 256)
+    imagePath = os.path.join(workDir, root + ".fits")
+    open(imagePath, 'w').close()
+    psfPath = os.path.join(workDir, root + ".psf")
+    image.write_psf(psfPath, 5)
+    apPath = os.path.join(workDir, root + ".ap")
+    image.write_ap(apPath)
+    return imagePath, psfPath, apPath
+
+
+class Abandoned(Exception):
+    pass
+
+
+class AllstarTest(unittest.TestCase):
+    """Allstar fits the stars and reports each iteration."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        imagePath, psfPath, apPath = make_inputs(self.workDir, "image")
+        self.allstar = Allstar(imagePath, psfPath, apPath,
+                os.path.join(self.workDir, "image.als"),
+                os.path.join(self.workDir, "images.fits"), shell="/bin/sh",
+                cmd=ALLSTAR)
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def test_progress(self):
+        events = []
+        self.allstar.run(progress=events.append)
+        self.assertEqual([event.iteration for event in events], [1, 2, 3, 4])
+        self.assertEqual(events[-1].nConverged, 20)
+        self.assertEqual(self.allstar.progress, events[-1])
+        als = AllstarCatalog()
+        als.open(self.allstar.alsOutputPath)
+        self.assertEqual(als.nStars, 20)
+        self.assertTrue(os.path.exists(self.allstar.outputImagePath))
+
+    def test_abandon(self):
+        def progress(event):
+            if event.iteration == 2:
+                raise Abandoned()
+
+        self.assertRaises(Abandoned, self.allstar.run, progress=progress)
+        self.assertTrue(self.allstar.allstar is None)
+        self.assertEqual(self.allstar.progress.iteration, 2)
+        # a later run starts from scratch
+        self.allstar.run()
+        self.assertEqual(self.allstar.progress.iteration, 4)
+
+
+class AllstarBatchTest(unittest.TestCase):
+    """Jobs of a batch run in their own directories."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.jobs = []
+        for i in range(3):
+            root = "image%i" % i
+            paths = make_inputs(self.workDir, root)
+            outputPaths = [os.path.join(self.workDir, "out", name)
+                    for name in (root + ".als", root + "s.fits")]
+            self.jobs.append(AllstarJob(*(paths + tuple(outputPaths))))
+        os.mkdir(os.path.join(self.workDir, "out"))
+        self.scratchRoot = os.path.join(self.workDir, "scratch")
+        os.mkdir(self.scratchRoot)
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def test_run(self):
+        events = []
+        batch = AllstarBatch(workers=2, scratchRoot=self.scratchRoot,
+                shell="/bin/sh", cmd=ALLSTAR)
+        results = list(batch.run(self.jobs,
+                progress=lambda job, event: events.append((job, event))))
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertTrue(result.succeeded(), result.traceback)
+        self.assertEqual(sorted(result.imagePath for result in results),
+                [job.imagePath for job in self.jobs])
+        for job in self.jobs:
+            self.assertTrue(os.path.exists(job.alsOutputPath))
+            self.assertTrue(os.path.exists(job.outputImagePath))
+            self.assertEqual(len([e for j, e in events if j == job]), 4)
+        # the temporary working directories are gone
+        self.assertEqual(os.listdir(self.scratchRoot), [])
+
+    def test_missing_input(self):
+        job = self.jobs[0]._replace(psfPath=os.path.join(self.workDir,
+                "missing.psf"))
+        batch = AllstarBatch(workers=1, scratchRoot=self.scratchRoot,
+                shell="/bin/sh", cmd=ALLSTAR)
+        results = list(batch.run([job, self.jobs[1]]))
+        failed = [result for result in results if not result.succeeded()]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0].imagePath, job.imagePath)
+        self.assertTrue(failed[0].error.startswith("IOError")
+                or failed[0].error.startswith("OSError"))
+        self.assertTrue(os.path.exists(self.jobs[1].alsOutputPath))
+
+
+if __name__ == '__main__':
+    unittest.main()
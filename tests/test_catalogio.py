@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of reading back the catalogs written by :mod:`catalogio`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+from catalogio import ApPhotCatalog, AllstarCatalog, CatalogBuilder, \
+        PickCatalog
+from simulator import SimulatedImage
+
+AP_HEADER = (" NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE"
+        "    FRAD\n  2  2048  2048   100.0 32000.0    20.0     3.0    1.00"
+        "    5.00    2.00\n\n\n")
+
+
+class ApPhotRoundTripTest(unittest.TestCase):
+    """Catalogs written by :meth:`ApPhotCatalog.write` open unchanged."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workDir, "round.ap")
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def make_catalog(self, nStars, nApertures, seed=0):
+        rng = np.random.RandomState(seed)
+        catalog = ApPhotCatalog()
+        catalog.stars = np.zeros(nStars,
+                dtype=catalog.make_dtype(nApertures))
+        catalog.nStars = nStars
+        catalog.headerText = AP_HEADER
+        stars = catalog.stars
+        stars['id'] = np.arange(1, nStars + 1)
+        stars['x'] = rng.uniform(1., 2048., nStars)
+        stars['y'] = rng.uniform(1., 2048., nStars)
+        # sky of 100-999, sigma below 10 and non-negative skew make the
+        # second line as wide as daophot's
+        stars['modal_sky'] = rng.uniform(100., 999., nStars)
+        stars['sky_sigma'] = rng.uniform(0.5, 9.5, nStars)
+        stars['sky_skew'] = rng.uniform(0., 5., nStars)
+        for name in stars.dtype.names:
+            if name.startswith('mag_err'):
+                stars[name] = rng.uniform(0.001, 0.5, nStars)
+            elif name.startswith('mag'):
+                stars[name] = rng.uniform(12., 22., nStars)
+        return catalog
+
+    def assert_round_trip(self, catalog, reread):
+        self.assertEqual(reread.stars.dtype.names,
+                catalog.stars.dtype.names)
+        self.assertEqual(reread.nStars, catalog.nStars)
+        self.assertTrue(np.all(reread.stars['id'] == catalog.stars['id']))
+        for name in catalog.stars.dtype.names[1:]:
+            # written with 2 to 4 decimals
+            self.assertTrue(np.allclose(reread.stars[name],
+                catalog.stars[name], atol=0.006), name)
+
+    def test_open(self):
+        for nApertures in (1, 2, 9):
+            catalog = self.make_catalog(3000, nApertures)
+            catalog.write(self.path)
+            reread = ApPhotCatalog()
+            reread.open(self.path)
+            self.assert_round_trip(catalog, reread)
+            # written in daophot's layout, so read through a memory map
+            self.assertTrue(ApPhotCatalog().read_mapped(self.path))
+
+    def test_few_stars(self):
+        catalog = self.make_catalog(5, 1, seed=1)
+        catalog.write(self.path)
+        reread = ApPhotCatalog()
+        reread.open(self.path)
+        self.assert_round_trip(catalog, reread)
+
+    def test_iter_chunks(self):
+        catalog = self.make_catalog(3000, 2, seed=2)
+        catalog.write(self.path)
+        reread = ApPhotCatalog()
+        chunks = list(reread.iter_chunks(self.path, rows=100))
+        reread.stars = np.concatenate(chunks)
+        reread.nStars = len(reread.stars)
+        self.assert_round_trip(catalog, reread)
+
+
+class SidecarTest(unittest.TestCase):
+    """Catalogs opened with `cache=True` reload from their binary sidecar
+    while the file is unchanged.
+    """
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workDir, "image.als")
+        SimulatedImage("image", 200, 1024).write_als(self.path)
+        AllstarCatalog().open(self.path, cache=True)
+        self.arrayPath = AllstarCatalog().get_cache_paths(self.path)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def rewrite(self, old, new, mtime=None):
+        """Replaces text in the file, keeping its modification time."""
+        status = os.stat(self.path)
+        text = open(self.path).read()
+        open(self.path, 'w').write(text.replace(old, new, 1))
+        os.utime(self.path, (status.st_atime, mtime or status.st_mtime))
+
+    def test_unchanged_file_is_not_read(self):
+        # same path, size and modification time: the content is not hashed
+        self.rewrite("\n      1 ", "\n      9 ")
+        catalog = AllstarCatalog()
+        catalog.open(self.path, cache=True)
+        self.assertTrue(isinstance(catalog.stars, np.memmap))
+        self.assertEqual(catalog.stars['id'][0], 1)
+
+    def test_touched_file(self):
+        # only the modification time differs: the digest still matches
+        sidecarTime = os.stat(self.arrayPath).st_mtime
+        self.rewrite("", "", mtime=os.stat(self.path).st_mtime + 10.)
+        catalog = AllstarCatalog()
+        catalog.open(self.path, cache=True)
+        self.assertTrue(isinstance(catalog.stars, np.memmap))
+        self.assertEqual(os.stat(self.arrayPath).st_mtime, sidecarTime)
+
+    def test_changed_file(self):
+        self.rewrite("\n      1 ", "\n      9 ",
+                mtime=os.stat(self.path).st_mtime + 10.)
+        catalog = AllstarCatalog()
+        catalog.open(self.path, cache=True)
+        self.assertEqual(catalog.stars['id'][0], 9)
+        catalog = AllstarCatalog()
+        catalog.open(self.path, cache=True)
+        self.assertEqual(catalog.stars['id'][0], 9)
+
+
+class AllstarRewriteTest(unittest.TestCase):
+    """An .als file written back by :meth:`AllstarCatalog.write` is the same
+    as allstar's.
+    """
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def test_write(self):
+        path = os.path.join(self.workDir, "image.als")
+        outputPath = os.path.join(self.workDir, "rewritten.als")
+        SimulatedImage("image", 500, 1024).write_als(path)
+        catalog = AllstarCatalog()
+        catalog.open(path)
+        self.assertTrue(np.all(catalog.stars['niter'] == 5))
+        catalog.write(outputPath)
+        text = open(outputPath).read()
+        self.assertEqual(text, open(path).read())
+        # niter is written as F9.0
+        self.assertEqual(text.splitlines()[3][52:61], "       5.")
+
+
+class PickRoundTripTest(unittest.TestCase):
+    """A star list made with :meth:`PickCatalog.set_stars` reads back whole.
+    """
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def test_write(self):
+        path = os.path.join(self.workDir, "stars.lst")
+        catalog = PickCatalog()
+        catalog.set_stars([3, 7, 8, 12], [10., 20., 30., 40.],
+                [15., 25., 35., 45.], [14.1, 15.2, 16.3, 17.4],
+                [0.01, 0.02, 0.03, 0.04])
+        catalog.write(path)
+        reread = PickCatalog()
+        reread.read(path)
+        self.assertEqual(reread.get_star_ids(), [3, 7, 8, 12])
+        self.assertTrue(np.allclose(reread.stars['y'], catalog.stars['y']))
+        self.assertEqual(reread.get_header(), PickCatalog.defaultHeader)
+
+
+class CatalogBuilderTest(unittest.TestCase):
+    """Stars gathered by :class:`CatalogBuilder`, including none at all."""
+    def make_stars(self, ids):
+        stars = np.zeros(len(ids), dtype=AllstarCatalog().dt)
+        stars['id'] = ids
+        return stars
+
+    def test_append_empty(self):
+        builder = CatalogBuilder(capacity=0)
+        builder.append(self.make_stars([]))
+        self.assertEqual(len(builder.get_stars()), 0)
+        builder.merge([self.make_stars([]), self.make_stars([4, 5])],
+                renumber=True)
+        self.assertEqual(builder.get_stars()['id'].tolist(), [4, 5])
+
+    def test_append_to_empty_catalog(self):
+        catalog = AllstarCatalog()
+        catalog.stars = self.make_stars([])
+        newCatalog = AllstarCatalog()
+        newCatalog.stars = self.make_stars([1, 2])
+        stats = catalog.append_unmatched(newCatalog, 2.)
+        self.assertEqual(stats.nAppended, 2)
+        catalog.append_catalog(newCatalog)
+        self.assertEqual(catalog.stars['id'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(newCatalog.stars['id'].tolist(), [1, 2])
+
+
+class AppendUnmatchedTest(unittest.TestCase):
+    """Only new stars away from the catalog's stars are appended."""
+    def make_catalog(self, x, y):
+        catalog = AllstarCatalog()
+        catalog.stars = np.zeros(len(x), dtype=catalog.dt)
+        catalog.stars['id'] = np.arange(1, len(x) + 1)
+        catalog.stars['x'] = x
+        catalog.stars['y'] = y
+        catalog.nStars = len(x)
+        return catalog
+
+    def test_append_unmatched(self):
+        catalog = self.make_catalog([10., 50., 90.], [10., 50., 90.])
+        newCatalog = self.make_catalog([10.5, 50., 70., 91., 200.],
+                [10., 51.5, 70., 91., 5.])
+        stats = catalog.append_unmatched(newCatalog, 2.)
+        self.assertEqual((stats.nStars, stats.nMatched, stats.nAppended),
+                (5, 3, 2))
+        self.assertEqual(stats.radius, 2.)
+        self.assertAlmostEqual(stats.medianSeparation, np.sqrt(2.))
+        # ids of the appended stars are offset past the catalog's
+        self.assertEqual(catalog.stars['id'].tolist(), [1, 2, 3, 6, 8])
+        self.assertEqual(catalog.stars['x'].tolist()[3:], [70., 200.])
+        # the appended stars are matched from then on
+        stats = catalog.append_unmatched(newCatalog, 2.)
+        self.assertEqual(stats.nAppended, 0)
+
+    def test_no_matches(self):
+        catalog = self.make_catalog([10.], [10.])
+        stats = catalog.append_unmatched(self.make_catalog([30.], [30.]),
+                2.)
+        self.assertEqual(stats.nAppended, 1)
+        self.assertTrue(np.isnan(stats.medianSeparation))
+
+
+if __name__ == '__main__':
+    unittest.main()
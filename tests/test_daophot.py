@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of driving daophot sessions, alone and from a :class:`pool.DaophotPool`,
+with the daophot dialogue played by :mod:`simulator`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+import simulator
+from catalogio import CoordCatalog, ApPhotCatalog, PickCatalog
+from daophot import Daophot
+from pool import DaophotPool
+
+SIMULATOR = "%s %s daophot --stars 30 --size 256" % (sys.executable,
+        os.path.abspath(simulator.__file__).replace(".pyc", ".py"))
+
+
+def make_image(workDir, name="image.fits"):
+    """Makes an (empty) image file for the simulator to attach."""
+    imagePath = os.path.join(workDir, name)
+    open(imagePath, 'w').close()
+    return imagePath
+
+
+class DaophotTest(unittest.TestCase):
+    """Daophot commands write the catalogs of the attached image."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.imagePath = make_image(self.workDir)
+        self.daophot = Daophot(self.imagePath, shell="/bin/sh",
+                cmd=SIMULATOR)
+
+    def tearDown(self):
+        self.daophot.shutdown()
+        shutil.rmtree(self.workDir)
+
+    def test_psf_pipeline(self):
+        daophot = self.daophot
+        daophot.find()
+        cooPath = daophot.get_path('last', 'coo')
+        self.assertEqual(cooPath, os.path.join(self.workDir, "image.coo"))
+        coo = CoordCatalog()
+        coo.open(cooPath)
+        self.assertEqual(coo.nStars, 30)
+
+        daophot.apphot('last', photOutputName='init')
+        apPath = daophot.get_path('init', 'ap')
+        self.assertEqual(apPath, os.path.join(self.workDir,
+                "image_init.ap"))
+        ap = ApPhotCatalog()
+        ap.open(apPath)
+        self.assertEqual(ap.nStars, 30)
+
+        daophot.pick_psf_stars(10, 'init')
+        lst = PickCatalog()
+        lst.read(daophot.get_path('last', 'lst'))
+        self.assertEqual(lst.nStars, 10)
+
+        fittingText, psfPath, neiPath = daophot.make_psf('init', 'last')
+        self.assertTrue(os.path.exists(psfPath))
+        self.assertTrue(os.path.exists(neiPath))
+        # the fitting text lists the PSF stars
+        self.assertTrue(str(lst.stars['id'][0]) in fittingText)
+
+        subPath = os.path.join(self.workDir, "images.fits")
+        self.assertEqual(daophot.substar(neiPath, 'last', subPath), subPath)
+        self.assertTrue(os.path.exists(subPath))
+
+    def test_rerun_overwrites(self):
+        self.daophot.find()
+        self.daophot.find()
+        self.assertTrue(os.path.exists(self.daophot.get_path('last', 'coo')))
+        self.assertEqual(
+                self.daophot.get_stats().commands.get('FIND').n, 2)
+
+    def test_options_sent_once(self):
+        self.daophot.set_options({'FW': 3.5, 'TH': 4.})
+        self.assertEqual(self.daophot.get_options()['FW'], 3.5)
+        nPrompts = self.daophot.get_transcript().count("OPT>")
+        # nothing changes, so there is no OPTION round trip
+        self.daophot.set_options({'fw': 3.5})
+        self.assertEqual(self.daophot.get_transcript().count("OPT>"),
+                nPrompts)
+
+    def test_retarget(self):
+        otherPath = make_image(self.workDir, "other.fits")
+        self.daophot.find()
+        self.daophot.retarget(otherPath)
+        self.daophot.find()
+        self.assertEqual(self.daophot.get_path('last', 'coo'),
+                os.path.join(self.workDir, "other.coo"))
+        self.assertRaises(ValueError, self.daophot.retarget,
+                os.path.join(self.workDir, "sub", "image.fits"))
+
+
+class FailedPSFTest(unittest.TestCase):
+    """A PSF fit that does not converge returns no paths."""
+    def test_make_psf(self):
+        workDir = tempfile.mkdtemp()
+        daophot = Daophot(make_image(workDir), shell="/bin/sh",
+                cmd=SIMULATOR + " --fail-psf")
+        try:
+            daophot.find()
+            daophot.apphot('last')
+            daophot.pick_psf_stars(5, 'last')
+            self.assertEqual(daophot.make_psf('last', 'last'),
+                    (None, None, None))
+            # the session is still at the command prompt
+            daophot.find()
+        finally:
+            daophot.shutdown()
+            shutil.rmtree(workDir)
+
+
+class DaophotPoolTest(unittest.TestCase):
+    """Sessions are reused for images in the same directory."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.imagePaths = [make_image(self.workDir, "image%i.fits" % i)
+                for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def make_pool(self, size):
+        return DaophotPool(size=size, shell="/bin/sh", cmd=SIMULATOR)
+
+    def test_reuse(self):
+        with self.make_pool(2) as pool:
+            for imagePath in self.imagePaths:
+                with pool.session(imagePath) as daophot:
+                    daophot.find()
+                    self.assertEqual(daophot.get_path('last', 'coo'),
+                            os.path.splitext(imagePath)[0] + ".coo")
+            stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        for imagePath in self.imagePaths:
+            self.assertTrue(os.path.exists(
+                    os.path.splitext(imagePath)[0] + ".coo"))
+
+    def test_other_directory(self):
+        otherDir = os.path.join(self.workDir, "other")
+        os.mkdir(otherDir)
+        with self.make_pool(1) as pool:
+            for imagePath in (self.imagePaths[0], make_image(otherDir)):
+                with pool.session(imagePath) as daophot:
+                    daophot.find()
+            stats = pool.stats()
+        # the idle session was evicted to start one in the other directory
+        self.assertEqual((stats['hits'], stats['misses'], stats['live']),
+                (0, 2, 1))
+        self.assertEqual(stats['recycles'], 1)
+
+    def test_failed_session_is_recycled(self):
+        with self.make_pool(2) as pool:
+            try:
+                with pool.session(self.imagePaths[0]) as daophot:
+                    raise RuntimeError("failed")
+            except RuntimeError:
+                pass
+            self.assertFalse(daophot.is_alive())
+            with pool.session(self.imagePaths[1]) as daophot:
+                daophot.find()
+            stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 2))
+
+    def test_threads_share_one_session(self):
+        errors = []
+
+        def work(pool, imagePath):
+            try:
+                with pool.session(imagePath) as daophot:
+                    daophot.find()
+            except Exception as e:
+                errors.append(e)
+
+        with self.make_pool(1) as pool:
+            threads = [threading.Thread(target=work, args=(pool, path))
+                    for path in self.imagePaths]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(60.)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+            stats = pool.stats()
+        self.assertEqual(errors, [])
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
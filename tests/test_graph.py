@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of incremental runs of a :class:`graph.TaskGraph`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+from graph import Task, TaskFailed, TaskGraph
+
+
+def write(path, text):
+    f = open(path, 'w')
+    f.write(text)
+    f.close()
+
+
+def read(path):
+    f = open(path)
+    text = f.read()
+    f.close()
+    return text
+
+
+class TaskGraphTest(unittest.TestCase):
+    """Only out-of-date tasks are run.
+
+    The graph is ``source -> upper -> count``: `upper` writes an upper case
+    copy of the source file, and `count` writes its length.
+    """
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.statePath = os.path.join(self.workDir, "state.json")
+        self.sourcePath = self.get_path("source.txt")
+        self.upperPath = self.get_path("upper.txt")
+        self.countPath = self.get_path("count.txt")
+        write(self.sourcePath, "stars")
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def get_path(self, name):
+        return os.path.join(self.workDir, name)
+
+    def make_graph(self, params=None):
+        graph = TaskGraph(self.statePath)
+
+        def upper():
+            text = read(self.sourcePath).upper()
+            write(self.upperPath, text)
+            return text
+
+        def count():
+            write(self.countPath, str(len(read(self.upperPath))))
+
+        graph.add(Task('count', count, inputs=[self.upperPath],
+                outputs=[self.countPath]))
+        graph.add(Task('upper', upper, inputs=[self.sourcePath],
+                outputs=[self.upperPath], params=params))
+        return graph
+
+    def test_order(self):
+        self.assertEqual(self.make_graph().get_order(), ['upper', 'count'])
+
+    def test_incremental(self):
+        self.assertEqual(self.make_graph().run(), ['upper', 'count'])
+        self.assertEqual(read(self.countPath), "5")
+        graph = self.make_graph()
+        self.assertEqual(graph.run(), [])
+        self.assertEqual(graph.skipped, ['upper', 'count'])
+        # the result is kept from the run before
+        self.assertEqual(graph.get_result('upper'), "STARS")
+
+    def test_changed_input(self):
+        self.make_graph().run()
+        write(self.sourcePath, "more stars")
+        self.assertEqual(self.make_graph().run(), ['upper', 'count'])
+        self.assertEqual(read(self.countPath), "10")
+
+    def test_identical_output(self):
+        self.make_graph().run()
+        write(self.sourcePath, "STARS")
+        # upper rewrites the same text, so count is up to date
+        graph = self.make_graph()
+        self.assertEqual(graph.run(), ['upper'])
+        self.assertEqual(graph.skipped, ['count'])
+
+    def test_changed_params(self):
+        self.make_graph(params={'case': 'upper'}).run()
+        graph = self.make_graph(params={'case': 'UPPER'})
+        self.assertTrue(graph.is_stale('upper'))
+        self.assertFalse(graph.is_stale('count'))
+        self.assertEqual(graph.run(), ['upper'])
+
+    def test_missing_output(self):
+        self.make_graph().run()
+        os.remove(self.countPath)
+        self.assertEqual(self.make_graph().run(), ['count'])
+
+    def test_targets(self):
+        self.assertEqual(self.make_graph().run(targets=['upper']), ['upper'])
+        self.assertFalse(os.path.exists(self.countPath))
+
+    def test_failure(self):
+        graph = self.make_graph()
+        graph.add(Task('fail', lambda: 1 / 0, after=['upper']))
+        try:
+            graph.run()
+        except TaskFailed as e:
+            self.assertEqual(e.taskName, 'fail')
+            self.assertTrue(isinstance(e.error, ZeroDivisionError))
+            self.assertTrue("ZeroDivisionError" in e.traceback)
+        else:
+            self.fail("TaskFailed not raised")
+        # the failed task is not recorded, so it is run again
+        graph = self.make_graph()
+        graph.add(Task('fail', lambda: None, after=['upper']))
+        self.assertEqual(graph.run(), ['fail'])
+
+    def test_cycle(self):
+        graph = TaskGraph()
+        graph.add(Task('a', lambda: None, inputs=["b.txt"],
+                outputs=["a.txt"]))
+        graph.add(Task('b', lambda: None, inputs=["a.txt"],
+                outputs=["b.txt"]))
+        self.assertRaises(ValueError, graph.run)
+
+    def test_resource(self):
+        graph = TaskGraph()
+        lock = threading.Lock()
+        overlaps = []
+
+        def use():
+            if not lock.acquire(False):
+                overlaps.append(True)
+                return
+            try:
+                threading.Event().wait(0.05)
+            finally:
+                lock.release()
+
+        for i in range(4):
+            graph.add(Task('use%i' % i, use, resource='daophot'))
+        self.assertEqual(sorted(graph.run(workers=4)),
+                ['use0', 'use1', 'use2', 'use3'])
+        self.assertEqual(overlaps, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
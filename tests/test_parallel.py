@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of running a recipe on many images with :func:`parallel.run_many`, with
+daophot and allstar played by :mod:`simulator`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+import simulator
+from catalogio import PickCatalog
+from parallel import PSFRecipe, run_many
+
+SIMULATOR = "%s %s" % (sys.executable,
+        os.path.abspath(simulator.__file__).replace(".pyc", ".py"))
+DAOPHOT = SIMULATOR + " daophot --stars 20 --size 256"
+ALLSTAR = SIMULATOR + " allstar --stars 20 --size 256"
+
+
+class RunManyTest(unittest.TestCase):
+    """Each image is run in its own working directory."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.imagePaths = []
+        for i in range(3):
+            imagePath = os.path.join(self.workDir, "image%i.fits" % i)
+            open(imagePath, 'w').close()
+            self.imagePaths.append(imagePath)
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def test_psf_recipe(self):
+        recipe = PSFRecipe(nStars=5, shell="/bin/sh", cmd=DAOPHOT,
+                runAllstar=True, allstarCmd=ALLSTAR)
+        workRoot = os.path.join(self.workDir, "work")
+        results = list(run_many(self.imagePaths, recipe, workers=2,
+                workRoot=workRoot))
+        self.assertEqual(sorted(result.imagePath for result in results),
+                self.imagePaths)
+        for result in results:
+            self.assertTrue(result.succeeded(), result.traceback)
+            self.assertEqual(os.path.dirname(result.workDir), workRoot)
+            for key in ('coo', 'ap', 'lst', 'psf', 'nei', 'als', 'sub'):
+                path = result.result[key]
+                self.assertEqual(os.path.dirname(path), result.workDir)
+                self.assertTrue(os.path.exists(path), key)
+            lst = PickCatalog()
+            lst.read(result.result['lst'])
+            self.assertEqual(lst.nStars, 5)
+
+    def test_scratch(self):
+        recipe = PSFRecipe(nStars=5, shell="/bin/sh", cmd=DAOPHOT)
+        scratchRoot = os.path.join(self.workDir, "scratch")
+        os.mkdir(scratchRoot)
+        results = list(run_many(self.imagePaths[:1], recipe, workers=1,
+                scratchRoot=scratchRoot))
+        result = results[0]
+        self.assertTrue(result.succeeded(), result.traceback)
+        self.assertEqual(result.result['psf'],
+                os.path.join(result.workDir, "image0.psf"))
+        self.assertTrue(os.path.exists(result.result['psf']))
+        self.assertEqual(os.listdir(scratchRoot), [])
+
+    def test_failure(self):
+        recipe = PSFRecipe(nStars=5, shell="/bin/sh",
+                cmd=DAOPHOT + " --fail-psf")
+        results = list(run_many(self.imagePaths[:2], recipe, workers=2))
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertFalse(result.succeeded())
+            self.assertTrue(result.result is None)
+            self.assertTrue("did not converge" in result.error)
+            self.assertTrue(result.traceback is not None)
+
+
+if __name__ == '__main__':
+    unittest.main()
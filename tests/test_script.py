@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of running daophot commands as one :class:`script.DaophotScript`, with
+daophot played by :mod:`simulator`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+import simulator
+from catalogio import CoordCatalog
+from script import DaophotScript
+
+SIMULATOR = "%s %s daophot --stars 30 --size 256" % (sys.executable,
+        os.path.abspath(simulator.__file__).replace(".pyc", ".py"))
+
+
+class DaophotScriptTest(unittest.TestCase):
+    """A compiled script runs the PSF pipeline in one daophot process."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.imagePath = os.path.join(self.workDir, "image.fits")
+        open(self.imagePath, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def make_script(self, cmd=SIMULATOR):
+        script = DaophotScript(self.imagePath, shell="/bin/sh", cmd=cmd,
+                options={'FW': 3.5})
+        script.find()
+        script.apphot('last')
+        script.pick_psf_stars(5, 'last')
+        script.make_psf('last', 'last')
+        return script
+
+    def test_run(self):
+        script = self.make_script()
+        # nothing runs until the script is complete
+        self.assertFalse(os.path.exists(os.path.join(self.workDir,
+                "image.coo")))
+        result = script.run(timeout=60.)
+        self.assertTrue(result.succeeded(), result.transcript)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual([command.strip().upper()[:2]
+                for command in result.commands],
+                ["OP", "AT", "FI", "PH", "PI", "PS"])
+        self.assertEqual(result.missingOutputs, [])
+        self.assertTrue("Failed to converge." not in
+                result.get_fitting_text())
+        coo = CoordCatalog()
+        coo.open(script.get_path('last', 'coo'))
+        self.assertEqual(coo.nStars, 30)
+        self.assertTrue(os.path.exists(script.get_path('last', 'psf')))
+
+    def test_failed_psf(self):
+        result = self.make_script(SIMULATOR + " --fail-psf").run(timeout=60.)
+        self.assertFalse(result.psf_converged())
+        self.assertFalse(result.succeeded())
+        self.assertTrue("Failed to converge." in result.get_fitting_text())
+
+    def test_timeout(self):
+        result = self.make_script(SIMULATOR + " --delays FIND=30").run(
+                timeout=1.)
+        self.assertTrue(result.timedOut)
+        self.assertFalse(result.succeeded())
+
+
+if __name__ == '__main__':
+    unittest.main()
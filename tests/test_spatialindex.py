@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of :class:`spatialindex.GridIndex` queries against brute force.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+from spatialindex import GridIndex
+
+
+class GridIndexTest(unittest.TestCase):
+    """Queries find the same points as a scan of all the points."""
+    def setUp(self):
+        random = np.random.RandomState(42)
+        self.x = random.uniform(0., 500., 400)
+        self.y = random.uniform(0., 300., 400)
+        # stars without a position are never found
+        self.x[[3, 17]] = np.nan
+        self.y[40] = np.inf
+        self.index = GridIndex(self.x, self.y)
+        self.xq = random.uniform(-20., 520., 50)
+        self.yq = random.uniform(-20., 320., 50)
+
+    def get_distances(self, x, y):
+        with np.errstate(invalid='ignore'):
+            d = np.hypot(self.x - x, self.y - y)
+        d[~np.isfinite(d)] = np.inf
+        return d
+
+    def test_query_radius(self):
+        queryRows, starRows, distances = self.index.query_radius(self.xq,
+                self.yq, 15.)
+        for i in range(len(self.xq)):
+            d = self.get_distances(self.xq[i], self.yq[i])
+            expected = np.nonzero(d <= 15.)[0]
+            expected = expected[np.argsort(d[expected], kind='mergesort')]
+            isQuery = queryRows == i
+            self.assertEqual(list(starRows[isQuery]), list(expected))
+            self.assertTrue(np.allclose(distances[isQuery], d[expected]))
+
+    def test_query_pairs(self):
+        first, second, distances = self.index.query_pairs(10.)
+        pairs = set(zip(first, second))
+        expected = set()
+        for i in range(len(self.x)):
+            d = self.get_distances(self.x[i], self.y[i])
+            expected.update((i, j) for j in np.nonzero(d <= 10.)[0] if i < j)
+        self.assertEqual(pairs, expected)
+
+    def test_query_nearest(self):
+        distances, rows = self.index.query_nearest(self.xq, self.yq, k=3)
+        self.assertEqual(rows.shape, (len(self.xq), 3))
+        for i in range(len(self.xq)):
+            d = self.get_distances(self.xq[i], self.yq[i])
+            self.assertTrue(np.allclose(distances[i], np.sort(d)[:3]))
+            self.assertTrue(np.allclose(d[rows[i]], distances[i]))
+
+    def test_query_nearest_self(self):
+        distances, rows = self.index.query_nearest(self.x[:10],
+                self.y[:10])
+        self.assertEqual(distances[0, 0], 0.)
+        self.assertEqual(rows[0, 0], 0)
+        # positions that are not finite find nothing
+        self.assertEqual(distances[3, 0], np.inf)
+        self.assertEqual(rows[3, 0], -1)
+        self.assertRaises(ValueError, self.index.query_nearest, 0., 0., 398)
+
+    def test_query_box(self):
+        rows = self.index.query_box(100., 250.5, 20., 80.)
+        with np.errstate(invalid='ignore'):
+            expected = np.nonzero((self.x >= 100.) & (self.x <= 250.5)
+                    & (self.y >= 20.) & (self.y <= 80.))[0]
+        self.assertEqual(list(rows), list(expected))
+        self.assertEqual(len(self.index.query_box(600., 700., 0., 300.)), 0)
+        self.assertEqual(len(self.index.query_box(-np.inf, np.inf,
+                -np.inf, np.inf)), 397)
+
+    def test_empty(self):
+        index = GridIndex([], [])
+        queryRows, starRows, distances = index.query_radius([1.], [1.], 5.)
+        self.assertEqual(len(starRows), 0)
+        self.assertEqual(len(index.query_box(0., 1., 0., 1.)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of restoring daophot steps from a :class:`stepcache.StepCache`, with
+the daophot dialogue played by :mod:`simulator`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+import simulator
+from daophot import Daophot
+from stepcache import StepCache
+
+SIMULATOR = "%s %s daophot --stars 40 --size 512" % (sys.executable,
+        os.path.abspath(simulator.__file__).replace(".pyc", ".py"))
+
+
+class StepCacheTest(unittest.TestCase):
+    """Outputs of daophot commands are restored from the step cache."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.imagePath = os.path.join(self.workDir, "image.fits")
+        open(self.imagePath, 'w').close()
+        self.cache = StepCache(os.path.join(self.workDir, "cache"))
+        image = simulator.SimulatedImage("image", 40, 512)
+        image.write_lst(os.path.join(self.workDir, "image.lst"),
+                image.get_brightest(5))
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def run_pipeline(self, cmd=SIMULATOR):
+        daophot = Daophot(self.imagePath, shell="/bin/sh", cmd=cmd,
+                stepCache=self.cache)
+        try:
+            daophot.find()
+            daophot.apphot('last')
+            return daophot.make_psf('last', "image.lst")
+        finally:
+            daophot.shutdown()
+
+    def test_restore(self):
+        first = self.run_pipeline()
+        self.assertEqual(self.cache.stats()['stores'], 3)
+        os.remove(first[1])
+        second = self.run_pipeline()
+        self.assertEqual(self.cache.stats()['hits'], 3)
+        self.assertEqual(second, first)
+        self.assertTrue(os.path.exists(second[1]))
+
+    def test_failed_psf(self):
+        failing = SIMULATOR + " --fail-psf"
+        self.assertEqual(self.run_pipeline(failing), (None, None, None))
+        # the failed fit is not stored, so it is run again
+        self.assertEqual(self.run_pipeline(failing), (None, None, None))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['stores']), (2, 2))
+        fittingText, psfPath, neiPath = self.run_pipeline()
+        self.assertTrue(os.path.exists(psfPath))
+
+
+if __name__ == '__main__':
+    unittest.main()
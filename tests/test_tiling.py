@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of cutting images into tiles and merging the tiles' catalogs with
+:mod:`tiling`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+from catalogio import CoordCatalog
+from simulator import COO_HEADER
+
+try:
+    import tiling
+except ImportError:
+    # tiling reads images with pyfits
+    tiling = None
+
+
+@unittest.skipIf(tiling is None, "requires pyfits")
+class MakeTilesTest(unittest.TestCase):
+    """The cores of the tiles are a partition of the image."""
+    def test_partition(self):
+        nx, ny = 1000, 700
+        tiles = tiling.make_tiles(nx, ny, tileSize=300, overlap=20)
+        self.assertEqual(len(tiles), 4 * 3)
+        coverage = np.zeros((ny, nx), dtype=int)
+        for tile in tiles:
+            coverage[tile.coreY0:tile.coreY1, tile.coreX0:tile.coreX1] += 1
+            self.assertTrue(tile.coreX1 - tile.coreX0 <= 300)
+            # the tile extends the overlap beyond its core, within the image
+            self.assertEqual(tile.x0, max(tile.coreX0 - 20, 0))
+            self.assertEqual(tile.x0 + tile.nx, min(tile.coreX1 + 20, nx))
+        self.assertTrue(np.all(coverage == 1))
+
+    def test_small_image(self):
+        tiles = tiling.make_tiles(100, 50, tileSize=2048, overlap=64)
+        self.assertEqual(len(tiles), 1)
+        self.assertEqual(tiles[0][1:], (0, 0, 100, 50, 0, 0, 100, 50))
+
+
+@unittest.skipIf(tiling is None, "requires pyfits")
+class MergeCatalogsTest(unittest.TestCase):
+    """Stars measured in the overlaps of tiles are kept once."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def make_catalog(self, tile, x, y):
+        """Writes and opens the catalog of the stars at parent coordinates
+        `x`, `y` that fall on `tile`.
+        """
+        onTile = (x >= tile.x0 + 0.5) & (x < tile.x0 + tile.nx + 0.5) \
+                & (y >= tile.y0 + 0.5) & (y < tile.y0 + tile.ny + 0.5)
+        path = os.path.join(self.workDir, "tile%i.coo" % tile.index)
+        f = open(path, 'w')
+        f.write(COO_HEADER % (1, tile.nx, tile.ny))
+        for i, (xs, ys) in enumerate(zip(x[onTile], y[onTile])):
+            f.write("%7i%9.3f%9.3f%9.3f%9.3f%9.3f%9.3f\n" % (i + 1,
+                xs - tile.x0, ys - tile.y0, -5., 0.5, 0., 0.))
+        f.close()
+        catalog = CoordCatalog()
+        catalog.open(path)
+        return catalog
+
+    def test_merge(self):
+        nx, ny = 300, 200
+        tiles = tiling.make_tiles(nx, ny, tileSize=150, overlap=10)
+        random = np.random.RandomState(1)
+        x = np.round(random.uniform(1., nx, 200), 3)
+        y = np.round(random.uniform(1., ny, 200), 3)
+        catalogs = [self.make_catalog(tile, x, y) for tile in tiles]
+        # the overlaps hold duplicates
+        self.assertTrue(sum(catalog.nStars for catalog in catalogs) > 200)
+        merged = tiling.merge_catalogs(catalogs, tiles, nx, ny)
+        self.assertTrue(isinstance(merged, CoordCatalog))
+        self.assertEqual(merged.nStars, 200)
+        self.assertEqual(list(merged.stars['id']), list(range(1, 201)))
+        # every star is found once, at its position in the parent image
+        found = np.array(sorted(zip(merged.stars['x'], merged.stars['y'])))
+        self.assertTrue(np.allclose(found, sorted(zip(x, y)), atol=1e-3))
+        self.assertEqual(merged.get_header().split("\n")[1][3:15],
+                "%6i%6i" % (nx, ny))
+
+    def test_set_header_size(self):
+        header = COO_HEADER % (1, 150, 160)
+        line = tiling.set_header_size(header, 3000, 4000).split("\n")[1]
+        self.assertEqual(line[3:15], "  3000  4000")
+        self.assertEqual(line[15:], header.split("\n")[1][15:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of the supervision of stalled daophot and allstar processes, played by
+:mod:`simulator`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+import simulator
+from daophot import Daophot
+from allstar import Allstar
+from watchdog import RuntimeModel, Stalled, Supervisor, Watchdog
+
+try:
+    import asyncio
+    from asyncdriver import AsyncDaophot, AsyncAllstar
+except (ImportError, SyntaxError):
+    # Python 2
+    asyncio = None
+
+SIMULATOR = "%s %s" % (sys.executable,
+        os.path.abspath(simulator.__file__).replace(".pyc", ".py"))
+DAOPHOT = SIMULATOR + " daophot --stars 20 --size 256"
+ALLSTAR = SIMULATOR + " allstar --stars 20 --size 256"
+
+
+def stall_once(cmd, delays):
+    """Returns a shell command that runs `cmd` with `delays` the first time
+    it is run in a directory, and without delays after that.
+    """
+    return "if test -e stalled; then %s; else touch stalled; %s --delays %s;" \
+            " fi" % (cmd, cmd, delays)
+
+
+def make_supervisor():
+    """Returns a supervisor that declares FIND and ALLSTAR stalled after a
+    second of silence, and retries once without waiting.
+    """
+    model = RuntimeModel({'FIND': (0.5, 0., 0.), 'ALLSTAR': (0.5, 0., 0.)})
+    watchdog = Watchdog(model, slack=10., stallTimeout=0.5, poll=0.1)
+    return Supervisor(watchdog, retries=1, backoff=0.)
+
+
+class SupervisorTest(unittest.TestCase):
+    """Stalled commands are killed, and retried or given up."""
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.imagePath = os.path.join(self.workDir, "image.fits")
+        open(self.imagePath, 'w').close()
+        self.supervisor = make_supervisor()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def make_allstar(self, cls, cmd):
+        paths = [os.path.join(self.workDir, name) for name in ("image.psf",
+            "image.ap", "image.als", "images.fits")]
+        return cls(self.imagePath, *paths, shell="/bin/sh", cmd=cmd,
+                supervisor=self.supervisor)
+
+    def assert_events(self, nRetries, nGiveUps):
+        self.assertEqual(self.supervisor.count('kill'), nRetries + nGiveUps)
+        self.assertEqual(self.supervisor.count('retry'), nRetries)
+        self.assertEqual(self.supervisor.count('give up'), nGiveUps)
+
+    def test_daophot_retry(self):
+        daophot = Daophot(self.imagePath, shell="/bin/sh",
+                cmd=stall_once(DAOPHOT, "FIND=30"),
+                supervisor=self.supervisor)
+        try:
+            daophot.find()
+        finally:
+            daophot.shutdown()
+        self.assertTrue(os.path.exists(daophot.get_path('last', 'coo')))
+        self.assert_events(1, 0)
+
+    def test_daophot_give_up(self):
+        daophot = Daophot(self.imagePath, shell="/bin/sh",
+                cmd=DAOPHOT + " --delays FIND=30", supervisor=self.supervisor)
+        try:
+            self.assertRaises(Stalled, daophot.find)
+        finally:
+            daophot.shutdown()
+        self.assert_events(1, 1)
+
+    def test_allstar_retry(self):
+        allstar = self.make_allstar(Allstar,
+                stall_once(ALLSTAR, "ALLSTAR=30"))
+        allstar.run()
+        self.assertTrue(os.path.exists(allstar.alsOutputPath))
+        self.assertEqual(allstar.progress.iteration, 4)
+        self.assert_events(1, 0)
+
+    @unittest.skipIf(asyncio is None, "requires asyncio")
+    def test_async_daophot_retry(self):
+        loop = asyncio.new_event_loop()
+        daophot = AsyncDaophot(self.imagePath, shell="/bin/sh",
+                cmd=stall_once(DAOPHOT, "FIND=30"),
+                supervisor=self.supervisor)
+        try:
+            loop.run_until_complete(daophot.startup())
+            loop.run_until_complete(daophot.find())
+            loop.run_until_complete(daophot.shutdown())
+        finally:
+            daophot.kill()
+            loop.close()
+        self.assertTrue(os.path.exists(daophot.get_path('last', 'coo')))
+        self.assert_events(1, 0)
+
+    @unittest.skipIf(asyncio is None, "requires asyncio")
+    def test_async_allstar_give_up(self):
+        loop = asyncio.new_event_loop()
+        allstar = self.make_allstar(AsyncAllstar,
+                ALLSTAR + " --delays ALLSTAR=30")
+        try:
+            self.assertRaises(Stalled, loop.run_until_complete,
+                    allstar.run())
+        finally:
+            loop.close()
+        self.assertTrue(allstar.allstar is None)
+        self.assert_events(1, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of staging inputs into, and collecting products from, a
+:class:`workspace.Workspace`.
+
+Usage::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "daopilot"))
+
+from workspace import Workspace
+
+
+def write(path, text):
+    f = open(path, 'w')
+    f.write(text)
+    f.close()
+
+
+def read(path):
+    f = open(path)
+    text = f.read()
+    f.close()
+    return text
+
+
+class WorkspaceTest(unittest.TestCase):
+    """Inputs are staged under short names and products get the original
+    names back.
+    """
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.dataDir = os.path.join(self.workDir, "data")
+        os.mkdir(self.dataDir)
+        self.imagePath = os.path.join(self.dataDir,
+                "a_long_image_name.fits")
+        write(self.imagePath, "image")
+        write(os.path.join(self.dataDir, "daophot.opt"), "FW = 3.5\n")
+        self.scratchRoot = os.path.join(self.workDir, "scratch")
+        os.mkdir(self.scratchRoot)
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def test_stage_image(self):
+        with Workspace(self.scratchRoot) as workspace:
+            stagedPath = workspace.stage_image(self.imagePath)
+            self.assertEqual(os.path.basename(stagedPath), "im1.fits")
+            self.assertTrue(os.path.islink(stagedPath))
+            self.assertEqual(read(stagedPath), "image")
+            # option files keep their names
+            self.assertTrue(os.path.exists(
+                    workspace.get_path("daophot.opt")))
+            # staging again reuses the name
+            self.assertEqual(workspace.stage_image(self.imagePath),
+                    stagedPath)
+            path = workspace.path
+            self.assertEqual(os.path.dirname(path), self.scratchRoot)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(self.imagePath))
+
+    def test_copy(self):
+        with Workspace(self.scratchRoot, copy=True) as workspace:
+            stagedPath = workspace.stage(self.imagePath)
+            self.assertFalse(os.path.islink(stagedPath))
+            self.assertEqual(read(stagedPath), "image")
+
+    def test_collect(self):
+        outputDir = os.path.join(self.workDir, "output")
+        with Workspace(self.scratchRoot) as workspace:
+            stagedPath = workspace.stage_image(self.imagePath)
+            write(workspace.get_path("im1_init.ap"), "photometry")
+            write(workspace.get_path("im1.coo"), "coordinates")
+            destPaths = workspace.collect(["*.ap", "*.coo", "im1.fits"],
+                    outputDir)
+            self.assertEqual(sorted(os.path.basename(path)
+                    for path in destPaths), ["a_long_image_name.coo",
+                    "a_long_image_name.fits", "a_long_image_name_init.ap"])
+            # products are moved, inputs are copied
+            self.assertFalse(os.path.exists(workspace.get_path(
+                    "im1_init.ap")))
+            self.assertTrue(os.path.exists(stagedPath))
+        self.assertEqual(read(os.path.join(outputDir,
+                "a_long_image_name_init.ap")), "photometry")
+        self.assertTrue(os.path.exists(self.imagePath))
+
+    def test_collect_result(self):
+        outputDir = os.path.join(self.workDir, "output")
+        with Workspace(self.scratchRoot) as workspace:
+            stagedPath = workspace.stage_image(self.imagePath)
+            psfPath = workspace.get_path("im1.psf")
+            write(psfPath, "psf")
+            result = workspace.collect_result({'psf': psfPath,
+                    'paths': [psfPath, "elsewhere.txt"], 'n': 3}, outputDir)
+        psfPath = os.path.join(outputDir, "a_long_image_name.psf")
+        self.assertEqual(result, {'psf': psfPath,
+                'paths': [psfPath, "elsewhere.txt"], 'n': 3})
+        self.assertEqual(read(psfPath), "psf")
+
+    def test_path(self):
+        path = os.path.join(self.workDir, "kept")
+        with Workspace(path=path, maxRootLength=None) as workspace:
+            stagedPath = workspace.stage_image(self.imagePath)
+            self.assertEqual(stagedPath, os.path.join(path,
+                    "a_long_image_name.fits"))
+        self.assertTrue(os.path.exists(stagedPath))
+
+
+if __name__ == '__main__':
+    unittest.main()